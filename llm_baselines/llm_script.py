@@ -1,14 +1,24 @@
 #!/usr/bin/env python3
 import os
+import sys
 import base64
 import io
+import functools
 from typing import List, Dict, Any, Tuple
 from PIL import Image
 import json
 import re
 import time
 import concurrent.futures
-from openai import OpenAI
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'synthesis'))
+from frame_store import load_frames
+from rate_limiter import rate_limiter
+from response_cache import configure_response_cache
+from mock_llm import MockBackend, MockOpenAIClient
+from call_budget import CallBudget
+from llm_providers import GEMINI_OPENAI_BASE_URL, OpenAIProvider, RetryPolicy
+from telemetry import DEFAULT_TRACE_PATH, configure_telemetry
 
 # Constants and model definitions
 MODELS = [
@@ -17,16 +27,38 @@ MODELS = [
     "gemini-2.0-flash-001",
 ]
 
-# Initialize clients - we'll create these in each worker process to avoid sharing connections
-def get_openai_client():
-    return OpenAI(
-        api_key=''
+# Recorded responses are reused on reruns ("record"), used exclusively ("replay") or ignored ("off").
+# A rerun with record or replay gets the same answers back instead of sampling new ones.
+LLM_CACHE_MODE = "off"
+# Set to a JSONL file, e.g. DEFAULT_TRACE_PATH, to trace every API call (summarize it with synthesis/telemetry.py); None leaves tracing off
+LLM_TRACE_PATH = None
+# "api" calls OpenAI and Gemini; "mock" answers from the local mock backend (see synthesis/mock_llm.py)
+LLM_BACKEND = "api"
+MOCK_LATENCY = "lognormal:2.0:0.5"
+# Seconds a single API call and a whole (domain, model, method, run) task may take; None for no limit
+CALL_TIMEOUT_SECONDS = 120
+TASK_DEADLINE_SECONDS = 2 * 3600
+# Three attempts per stimulus, 2s then 4s apart
+RETRY_POLICY = RetryPolicy(max_attempts=3, initial_delay_seconds=2, max_delay_seconds=8, backoff_factor=2)
+
+# Clients are created once and shared by all worker threads, so their connections are pooled
+@functools.lru_cache(maxsize=None)
+def get_openai_client() -> OpenAIProvider:
+    if LLM_BACKEND == "mock":
+        return OpenAIProvider(client=MockOpenAIClient(MockBackend(latency=MOCK_LATENCY)), retry=RETRY_POLICY)
+    return OpenAIProvider(
+        api_key='',
+        retry=RETRY_POLICY
     )
 
-def get_google_client():
-    return OpenAI(
+@functools.lru_cache(maxsize=None)
+def get_google_client() -> OpenAIProvider:
+    if LLM_BACKEND == "mock":
+        return OpenAIProvider(client=MockOpenAIClient(MockBackend(latency=MOCK_LATENCY)), retry=RETRY_POLICY)
+    return OpenAIProvider(
         api_key='',
-        base_url='https://generativelanguage.googleapis.com/v1beta/openai/'
+        base_url=GEMINI_OPENAI_BASE_URL,
+        retry=RETRY_POLICY
     )
 
 # Get the project directory
@@ -48,13 +80,11 @@ def get_folders(domain: str) -> List[str]:
 
 def extract_gif_frames(gif_path: str) -> List[str]:
     """Extract all frames from a GIF and convert them to base64 strings"""
-    gif = Image.open(gif_path)
+    # Frames come from the shared decoded frame store, so only the PNG encoding is redone per run
     frames = []
     
-    for frame_idx in range(gif.n_frames):
-        gif.seek(frame_idx)
-        # Convert frame to RGB if it's not already
-        frame = gif.convert('RGB')
+    for frame_array in load_frames(gif_path):
+        frame = Image.fromarray(frame_array)
         
         # Save frame to bytes
         img_byte_arr = io.BytesIO()
@@ -115,20 +145,18 @@ def run_baseline(config: Tuple[str, str, str, int]) -> Dict[str, Any]:
     """
     domain, model, method, run_num = config
     
-    # Create clients for this process
+    # Shared clients (see get_openai_client)
     openai_client = get_openai_client()
     google_client = get_google_client()
     
     print(f"\n[STARTING] Domain: {domain}, Model: {model}, Method: {method}, Run: {run_num}")
+    budget = CallBudget(deadline_seconds=TASK_DEADLINE_SECONDS, call_timeout_seconds=CALL_TIMEOUT_SECONDS)
     
     # Get folders and stimulus files
     print(f"  [INFO] Getting folders for {domain}...")
     folders = get_folders(domain)
     print(f"  [INFO] Found {len(folders)} folders")
     
-    print(f"  [INFO] Loading stimulus files...")
-    all_files = [get_stimulus_files(domain, folder) for folder in folders]
-    print(f"  [INFO] Loaded {len(all_files)} stimulus files")
 
     if "ablated" in method:
 
@@ -169,11 +197,12 @@ def run_baseline(config: Tuple[str, str, str, int]) -> Dict[str, Any]:
     tokens = {}
     
     # Process each stimulus
-    print(f"  [INFO] Processing {len(all_files)} stimulus files...")
-    for i in range(len(all_files)):
-        description, gif_frames = all_files[i]
+    # Stimuli are loaded one at a time, so only the current stimulus's encoded frames are held
+    print(f"  [INFO] Processing {len(folders)} stimulus files...")
+    for i in range(len(folders)):
+        description, gif_frames = get_stimulus_files(domain, folders[i])
         index = folders[i].rsplit('_', 1)[1]
-        print(f"  [PROGRESS] Processing stimulus {index} ({i+1}/{len(all_files)})")
+        print(f"  [PROGRESS] Processing stimulus {index} ({i+1}/{len(folders)})")
         
         # Create message with text and images
         messages = [
@@ -252,59 +281,29 @@ def run_baseline(config: Tuple[str, str, str, int]) -> Dict[str, Any]:
         # Select client based on model
         client = google_client if 'gemini' in model else openai_client
         
-        # Call API with retry mechanism
-        max_retries = 3
-        retry_count = 0
-        while retry_count < max_retries:
-            try:
-                print(f"    [API] Sending request to {model}...")
-                start_time = time.time()
-                
-                if 'o3' in model:
-                    response = client.chat.completions.create(
-                        model=model,
-                        messages=messages
-                    )
-                else:
-                    response = client.chat.completions.create(
-                        model=model,
-                        messages=messages,
-                        temperature=1.0
-                    )
-                
-                elapsed_time = time.time() - start_time
-                print(f"    [API] Response received in {elapsed_time:.2f} seconds")
-                
-                # Extract answer
-                answer = response.choices[0].message.content
-                final_answer = extract_answer_content(answer, method)
-                output_tokens = response.usage.total_tokens
-                
-                # Store results
-                results[domain+'_'+index] = final_answer
-                tokens[domain+'_'+index] = output_tokens
-                
-                print(f"    [RESULT] {domain} {index} (Run {run_num}): {final_answer}")
-                break  # Success, exit retry loop
-                
-            except Exception as e:
-                retry_count += 1
-                print(f"    [ERROR] Processing {domain} {index} (Run {run_num}, attempt {retry_count}/{max_retries}): {str(e)}")
-                
-                if retry_count < max_retries:
-                    # Wait before retrying with exponential backoff
-                    wait_time = 2 ** retry_count  # 2, 4, 8... seconds
-                    print(f"    [RETRY] Waiting {wait_time} seconds before retry...")
-                    time.sleep(wait_time)
-                else:
-                    # All retries failed
-                    print(f"    [FAILED] Could not process {domain} {index} (Run {run_num}) after {max_retries} attempts")
-                    results[domain+'_'+index] = f"ERROR: {str(e)}"
-                    tokens[domain+'_'+index] = 0
-        
-        # Add a small delay between requests to avoid rate limiting
-        print(f"    [DELAY] Waiting 0.5 seconds before next request...")
-        time.sleep(0.5)
+        # Each run is its own sample of the request, so reruns replay run k's answer for run k
+        request_config = {} if 'o3' in model else {"temperature": 1.0}
+        try:
+            print(f"    [API] Sending request to {model}...")
+            response = client.generate(model, messages, request_config, budget=budget, sample=run_num, trace={
+                "stage": f"baseline_{method}", "domain": domain, "problem": f"{domain}_{index}",
+                "backend": LLM_BACKEND,
+            })
+        except Exception as e:
+            # Retries are spent, or the budget or the model's circuit breaker stopped the call
+            print(f"    [FAILED] Could not process {domain} {index} (Run {run_num}): {str(e)}")
+            results[domain+'_'+index] = f"ERROR: {str(e)}"
+            tokens[domain+'_'+index] = 0
+            continue
+
+        final_answer = extract_answer_content(response.text, method)
+        results[domain+'_'+index] = final_answer
+        tokens[domain+'_'+index] = response.usage.total_tokens or 0
+        if response.cached:
+            print(f"    [CACHED] {domain} {index} (Run {run_num}): {final_answer}")
+        else:
+            print(f"    [API] Response received in {response.seconds:.2f} seconds")
+            print(f"    [RESULT] {domain} {index} (Run {run_num}): {final_answer}")
     
     # Save results with run number in filename
     result_file = f'{domain}_{model}_{method}_run_{run_num}.json'
@@ -327,8 +326,9 @@ def run_baseline(config: Tuple[str, str, str, int]) -> Dict[str, Any]:
         "run_num": run_num,
         "result_file": result_file,
         "token_file": token_file,
-        "stimulus_count": len(all_files),
-        "success_count": len([r for r in results.values() if not str(r).startswith("ERROR")])
+        "stimulus_count": len(folders),
+        "success_count": len([r for r in results.values() if not str(r).startswith("ERROR")]),
+        "budget": budget.summary()
     }
 
 def main():
@@ -367,6 +367,9 @@ def main():
         # }
     ]
     
+    configure_response_cache(LLM_CACHE_MODE)
+    configure_telemetry(LLM_TRACE_PATH)
+
     # Number of runs for each configuration
     num_runs = 5
     
@@ -391,13 +394,11 @@ def main():
     print(f"Total number of tasks: {total_tasks}")
     print("=============================\n")
     
-    # Maximum number of concurrent workers per model
-    # Adjust this based on your system's capabilities and API rate limits
-    concurrent_tasks_per_model = 3
-    
     # Process model by model to avoid running the same model concurrently
     all_results = []
     for model, tasks in model_tasks.items():
+        # Enough workers for the rate limiter's largest concurrency; it decides how many calls are in flight
+        concurrent_tasks_per_model = rate_limiter(model).max_concurrency
         print(f"\n[MODEL GROUP] Starting tasks for model: {model}")
         print(f"[MODEL GROUP] {len(tasks)} tasks to run with {concurrent_tasks_per_model} concurrent workers")
         
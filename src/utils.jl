@@ -2,6 +2,8 @@ using PDDL, SymbolicPlanners
 using IterTools
 using Combinatorics
 using Distributions, Random
+using JSON3
+using DataStructures: OrderedDict
 
 "Returns the location of an object."
 function get_obj_loc(state::State, obj::Const;)
@@ -265,17 +267,55 @@ end
 
 
 
+"Rebuild the frame problems of a `trajectory.jsonl` written by synthesis/trajectory.py."
+function load_trajectory_problems(temp_path)
+    lines = readlines(joinpath(temp_path, "trajectory.jsonl"))
+    problem_header = JSON3.read(lines[1]).problem_header
+    state = OrderedDict{String, Union{String, Nothing}}()
+    objects_str = ""
+    problems = []
+    for line in lines[2:end]
+        record = JSON3.read(line)
+        if haskey(record, :facts)
+            empty!(state)
+            for (key, value) in record.facts
+                state[key] = value
+            end
+        else
+            for key in record.removed
+                delete!(state, key)
+            end
+            for (key, value) in vcat(record.changed, record.added)
+                state[key] = value
+            end
+        end
+        objects_str = get(record, :objects, objects_str)
+        # Keys with no value are whole facts; set-index updates go last as they depend on order
+        facts = [isnothing(value) ? key : "(= $key $value)" for (key, value) in state]
+        facts = vcat(filter(f -> !occursin("set-index", f), facts), filter(f -> occursin("set-index", f), facts))
+        objects_block = isempty(objects_str) ? "" : objects_str * "\n"
+        problem_str = problem_header * "\n" * objects_block * "(:init \n" * join(facts, "\n") * "\n)\n(:goal (true)) \n)"
+        push!(problems, parse_problem(problem_str))
+    end
+    return problems
+end
+
 function load_domain_states(temp_path)
     frame_files = filter(f -> occursin("frame", f) && occursin(".pddl", f), readdir(temp_path))
     num_frame_files = length(frame_files)
 
     states = []
 
-
+    # Problems synthesized with --output_format trajectory have no frame files
+    use_trajectory = num_frame_files == 0 && isfile(joinpath(temp_path, "trajectory.jsonl"))
+    if use_trajectory
+        trajectory_problems = load_trajectory_problems(temp_path)
+        num_frame_files = length(trajectory_problems)
+    end
 
     for i in 0: num_frame_files-1
         domain = load_domain(joinpath(temp_path, "domain.pddl"))
-        new_frame = load_problem(joinpath(temp_path, "frame_$(i).pddl"))
+        new_frame = use_trajectory ? trajectory_problems[i+1] : load_problem(joinpath(temp_path, "frame_$(i).pddl"))
         new_frame = add_domain_constants(domain, new_frame)
         domain = remove_domain_constants(domain)
         state = initstate(domain, new_frame)
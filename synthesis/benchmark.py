@@ -0,0 +1,183 @@
+import argparse
+import contextlib
+import json
+import os
+import tempfile
+import time
+from typing import Any, Dict, List
+from utils import extract_objects, synthesize_domain, synthesize_config, check_valid_synthesis
+from segment_cells import generate_problem_pddl
+from problem_context import ProblemContext
+from mock_llm import MockBackend, MockGeminiClient, canned_response_dir
+from llm_providers import GeminiProvider
+from rate_limiter import configure_rate_limits
+from response_cache import configure_response_cache
+from telemetry import configure_telemetry, trace_context
+from call_budget import BudgetExceeded, CallBudget, CircuitOpen, configure_circuit_breakers
+
+base_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+
+STAGES = ("objects", "domain", "config", "check", "problem")
+# Same bound on synthesis attempts as synthesis.py
+MAX_SYNTHESIS_RETRIES = 7
+
+
+def stimulus_problems(domain_name: str) -> List[str]:
+    """The problem folders of a domain in dataset/stimuli, in numeric order."""
+    path = f"{base_dir}/dataset/stimuli/{domain_name}"
+    problems = [p for p in os.listdir(path) if os.path.exists(f"{path}/{p}/{p}.gif")]
+    return sorted(problems, key=lambda p: int(p.rsplit("_", 1)[1]) if p.rsplit("_", 1)[-1].isdigit() else 0)
+
+
+def _stage_stats(before: Dict[str, float], after: Dict[str, float], seconds: float) -> Dict[str, float]:
+    calls = {key: after[key] - before[key] for key in after}
+    return {
+        "seconds": seconds,
+        "mock_latency_seconds": calls["latency_seconds"],
+        "calls": calls["calls"],
+        # call_gemini_with_retry retries 5xx and 429 responses
+        "retries": calls["server_error"] + calls["rate_limit"],
+        "malformed": calls["malformed"],
+    }
+
+
+def benchmark_problem(backend: MockBackend, destination_folder: str, domain_name: str, problem_name: str, args) -> Dict[str, Any]:
+    """Run the synthesis.py stages for one problem against the mock backend, timing each stage."""
+    client = GeminiProvider(client=MockGeminiClient(backend), context_caching=not args.no_context_cache)
+    budget = CallBudget(
+        deadline_seconds=args.deadline or None,
+        max_calls=args.max_calls or None,
+        max_tokens=args.max_tokens or None,
+        call_timeout_seconds=args.call_timeout or None,
+    )
+    context = ProblemContext(destination_folder, domain_name, problem_name, budget=budget)
+    stages = {stage: {"seconds": 0.0, "mock_latency_seconds": 0.0, "calls": 0, "retries": 0, "malformed": 0} for stage in STAGES}
+    result = {"domain": domain_name, "problem": problem_name, "status": "ok", "synthesis_attempts": 0, "stages": stages}
+
+    def _run(stage: str, fn, *fn_args, **fn_kwargs):
+        before = backend.snapshot()
+        start = time.perf_counter()
+        try:
+            return fn(*fn_args, **fn_kwargs)
+        finally:
+            for key, value in _stage_stats(before, backend.snapshot(), time.perf_counter() - start).items():
+                stages[stage][key] += value
+
+    try:
+        valid_synthesis = False
+        while not valid_synthesis and result["synthesis_attempts"] < MAX_SYNTHESIS_RETRIES:
+            result["synthesis_attempts"] += 1
+            _run("objects", extract_objects, client, destination_folder, domain_name, problem_name, context=context)
+            _run("domain", synthesize_domain, client, destination_folder, domain_name, problem_name, context=context)
+            _run("config", synthesize_config, client, destination_folder, domain_name, problem_name, grid_check=args.grid_check, context=context)
+            valid_synthesis = _run("check", check_valid_synthesis, destination_folder, domain_name, problem_name, context=context)
+        if not valid_synthesis:
+            result["status"] = "invalid synthesis"
+        _run(
+            "problem", generate_problem_pddl, client, destination_folder, domain_name, problem_name,
+            delta=args.delta, use_cell_cache=args.cell_cache, grid_check=args.grid_check, output_format=args.output_format,
+            workers=args.workers, concurrency=args.concurrency, batch_size=args.batch_size, context=context
+        )
+    except (BudgetExceeded, CircuitOpen) as e:
+        result["status"] = f"{e.__class__.__name__}: {e}"
+    except Exception as e:
+        result["status"] = f"error: {e.__class__.__name__}: {e}"
+    finally:
+        client.close()
+    result["seconds"] = sum(stage["seconds"] for stage in stages.values())
+    result["budget"] = budget.summary()
+    return result
+
+
+def summarize(results: List[Dict[str, Any]]) -> Dict[str, Dict[str, float]]:
+    """Per-stage totals over all problems, plus a total row."""
+    summary = {}
+    for stage in STAGES + ("total",):
+        rows = [r["stages"].values() if stage == "total" else [r["stages"][stage]] for r in results]
+        summary[stage] = {
+            key: sum(row[key] for problem_rows in rows for row in problem_rows)
+            for key in ("seconds", "mock_latency_seconds", "calls", "retries", "malformed")
+        }
+        summary[stage]["mean_seconds"] = summary[stage]["seconds"] / len(results) if results else 0.0
+    return summary
+
+
+def print_summary(results: List[Dict[str, Any]], summary: Dict[str, Dict[str, float]]):
+    failed = [r for r in results if r["status"] != "ok"]
+    print(f"\n===== BENCHMARK: {len(results)} problems, {len(failed)} not ok =====")
+    print(f"{'stage':<10}{'wall s':>10}{'mean s':>10}{'mock lat s':>12}{'calls':>8}{'retries':>9}{'malformed':>11}")
+    for stage, row in summary.items():
+        print(f"{stage:<10}{row['seconds']:>10.2f}{row['mean_seconds']:>10.3f}{row['mock_latency_seconds']:>12.2f}{row['calls']:>8.0f}{row['retries']:>9.0f}{row['malformed']:>11.0f}")
+    for r in failed:
+        print(f"  {r['domain']}/{r['problem']}: {r['status']}")
+
+
+def __main__():
+    parser = argparse.ArgumentParser(description="Benchmark the synthesis pipeline over dataset/stimuli against a local mock LLM backend.")
+    parser.add_argument("--domains", type=str, nargs="+", default=None, help="Domains in dataset/stimuli to run (default: all).")
+    parser.add_argument("--problems_per_domain", type=int, default=0, help="Run only the first N problems of each domain; 0 runs all.")
+    parser.add_argument("--destination_folder", type=str, default="_benchmark", help="Folder the synthesized files are written to.")
+    parser.add_argument("--latency", type=str, default="0", help="Mock call latency: SECONDS, uniform:LOW:HIGH, normal:MEAN:STD or lognormal:MEDIAN:SIGMA. 0 measures the pipeline's own overhead.")
+    parser.add_argument("--server_error_rate", type=float, default=0.0, help="Fraction of calls failing with a 503.")
+    parser.add_argument("--rate_limit_rate", type=float, default=0.0, help="Fraction of calls failing with a 429.")
+    parser.add_argument("--malformed_rate", type=float, default=0.0, help="Fraction of calls returning a truncated response.")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the latency and error draws.")
+    parser.add_argument("--recorded", type=str, default=None, help="Response cache (see response_cache.py) whose recorded responses are served before canned ones.")
+    parser.add_argument("--delta", action="store_true", help="Only re-segment the cells that changed since the previous frame.")
+    parser.add_argument("--concurrency", type=int, default=8, help="Cell classification calls in flight at once.")
+    parser.add_argument("--batch_size", type=int, default=1, help="Cells classified per call.")
+    parser.add_argument("--workers", type=int, default=1, help="Processes writing the frame PDDL files; 0 uses every core.")
+    parser.add_argument("--output_format", type=str, default="frames", choices=["frames", "trajectory"])
+    parser.add_argument("--grid_check", type=str, default="override", choices=["override", "validate", "off"])
+    parser.add_argument("--no_context_cache", action="store_true", help="Send the static prompt prefixes inline instead of through the mock's context cache.")
+    parser.add_argument("--cell_cache", action="store_true", help="Reuse cached cell classifications (off by default so every cell is classified).")
+    parser.add_argument("--deadline", type=float, default=0, help="Seconds each problem may take; 0 for no deadline.")
+    parser.add_argument("--max_calls", type=int, default=0, help="Model calls each problem may make; 0 for no limit.")
+    parser.add_argument("--max_tokens", type=int, default=0, help="Tokens each problem may use; 0 for no limit.")
+    parser.add_argument("--call_timeout", type=float, default=0, help="Seconds a single model call may take; 0 for no timeout.")
+    parser.add_argument("--circuit_breaker_failures", type=int, default=10, help="Consecutive failed calls after which calls fail fast.")
+    parser.add_argument("--circuit_breaker_cooldown", type=float, default=60, help="Seconds calls fail fast once the circuit breaker has opened.")
+    parser.add_argument("--trace", type=str, default=None, help="Also trace every model call to this JSONL file (summarize it with telemetry.py).")
+    parser.add_argument("--output", type=str, default=None, help="Write the per-problem results and summary to this JSON file.")
+    parser.add_argument("--verbose", action="store_true", help="Show the pipeline's own output.")
+    args = parser.parse_args()
+
+    # Every call goes to the mock, against a quota of its own
+    configure_response_cache("off")
+    configure_rate_limits(tempfile.mkdtemp(prefix="rate_limits_"))
+    configure_telemetry(args.trace)
+
+    domains = args.domains or sorted(d for d in os.listdir(f"{base_dir}/dataset/stimuli") if os.path.isdir(f"{base_dir}/dataset/stimuli/{d}"))
+    results = []
+    for domain_name in domains:
+        problems = stimulus_problems(domain_name)
+        if args.problems_per_domain:
+            problems = problems[:args.problems_per_domain]
+        for problem_name in problems:
+            backend = MockBackend(
+                canned_dir=canned_response_dir(domain_name, problem_name),
+                recorded_path=args.recorded,
+                latency=args.latency,
+                server_error_rate=args.server_error_rate,
+                rate_limit_rate=args.rate_limit_rate,
+                malformed_rate=args.malformed_rate,
+                seed=args.seed,
+            )
+            # Each problem starts with closed circuits, so one degraded problem does not fail the next
+            configure_circuit_breakers(args.circuit_breaker_failures, args.circuit_breaker_cooldown)
+            with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull) if not args.verbose else contextlib.nullcontext(), \
+                    trace_context(domain=domain_name, problem=problem_name, backend="mock"):
+                result = benchmark_problem(backend, args.destination_folder, domain_name, problem_name, args)
+            results.append(result)
+            print(f"{domain_name}/{problem_name}: {result['seconds']:.2f}s, {sum(s['calls'] for s in result['stages'].values()):.0f} calls, {result['status']}")
+
+    summary = summarize(results)
+    print_summary(results, summary)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"args": vars(args), "summary": summary, "problems": results}, f, indent=2)
+        print(f"Results saved to: {args.output}")
+
+
+if __name__ == "__main__":
+    __main__()
@@ -0,0 +1,143 @@
+import asyncio
+import threading
+import time
+from typing import Any, Dict, Optional
+import httpx
+
+# What a model call that ran past its timeout raises: httpx for the SDK clients, asyncio for wait_for
+TIMEOUT_ERRORS = (asyncio.TimeoutError, httpx.TimeoutException)
+DEFAULT_FAILURE_THRESHOLD = 10
+DEFAULT_COOLDOWN_SECONDS = 60.0
+
+
+class BudgetExceeded(RuntimeError):
+    """A problem ran out of time, model calls or tokens."""
+
+
+class CircuitOpen(RuntimeError):
+    """A model failed too many calls in a row; its calls fail fast until the cooldown has passed."""
+
+
+class CallBudget:
+    """The time, model calls and tokens one problem may spend across all its stages.
+
+    Every model call checks the budget before each attempt and raises BudgetExceeded once
+    the deadline has passed or the calls or tokens are used up, so regeneration loops and
+    retries cannot run on forever. call_timeout_seconds bounds a single attempt, and never
+    reaches past the deadline. None means no limit.
+    """
+
+    def __init__(
+        self,
+        deadline_seconds: Optional[float] = None,
+        max_calls: Optional[int] = None,
+        max_tokens: Optional[int] = None,
+        call_timeout_seconds: Optional[float] = None,
+    ):
+        self.deadline_seconds = deadline_seconds
+        self.max_calls = max_calls
+        self.max_tokens = max_tokens
+        self.call_timeout_seconds = call_timeout_seconds
+        self.started = time.monotonic()
+        self.calls = 0
+        self.tokens = 0
+        self.timeouts = 0
+        self.exceeded: Optional[str] = None
+
+    def elapsed_seconds(self) -> float:
+        return time.monotonic() - self.started
+
+    def remaining_seconds(self) -> Optional[float]:
+        if self.deadline_seconds is None:
+            return None
+        return max(0.0, self.deadline_seconds - self.elapsed_seconds())
+
+    def check(self):
+        """Raise BudgetExceeded if another call would go over the budget."""
+        if self.exceeded is None:
+            if self.deadline_seconds is not None and self.elapsed_seconds() >= self.deadline_seconds:
+                self.exceeded = f"deadline of {self.deadline_seconds:g}s passed"
+            elif self.max_calls is not None and self.calls >= self.max_calls:
+                self.exceeded = f"{self.calls} of {self.max_calls} model calls used"
+            elif self.max_tokens is not None and self.tokens >= self.max_tokens:
+                self.exceeded = f"{self.tokens} of {self.max_tokens} tokens used"
+        if self.exceeded is not None:
+            raise BudgetExceeded(f"Budget exceeded: {self.exceeded}.")
+
+    def call_timeout(self) -> Optional[float]:
+        """Seconds the next attempt may take."""
+        timeouts = [t for t in (self.call_timeout_seconds, self.remaining_seconds()) if t is not None]
+        return min(timeouts) if timeouts else None
+
+    def record_call(self):
+        self.calls += 1
+
+    def record_tokens(self, tokens: int):
+        self.tokens += tokens
+
+    def summary(self) -> Dict[str, Any]:
+        """Limits and usage, for the results of a run."""
+        return {
+            "deadline_seconds": self.deadline_seconds,
+            "max_calls": self.max_calls,
+            "max_tokens": self.max_tokens,
+            "call_timeout_seconds": self.call_timeout_seconds,
+            "elapsed_seconds": round(self.elapsed_seconds(), 3),
+            "calls": self.calls,
+            "tokens": self.tokens,
+            "timeouts": self.timeouts,
+            "exceeded": self.exceeded,
+        }
+
+
+class CircuitBreaker:
+    """Fails a model's calls fast while its provider is degraded.
+
+    After failure_threshold consecutive failed attempts (5xx errors and timeouts; 429s are
+    left to the rate limiter) the circuit opens and every call raises CircuitOpen for
+    cooldown_seconds. Then calls are let through again; the first success closes the
+    circuit, and another failure opens it again right away.
+    """
+
+    def __init__(self, model: str, failure_threshold: int = DEFAULT_FAILURE_THRESHOLD, cooldown_seconds: float = DEFAULT_COOLDOWN_SECONDS):
+        self.model = model
+        self.failure_threshold = failure_threshold
+        self.cooldown_seconds = cooldown_seconds
+        self.failures = 0
+        self.open_until = 0.0
+        self._lock = threading.Lock()
+
+    def before_call(self):
+        remaining = self.open_until - time.monotonic()
+        if remaining > 0:
+            raise CircuitOpen(f"{self.model} failed {self.failures} calls in a row; not calling it for another {remaining:.0f}s.")
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.failures >= self.failure_threshold:
+                self.open_until = time.monotonic() + self.cooldown_seconds
+
+
+_breakers: Dict[str, CircuitBreaker] = {}
+_breakers_lock = threading.Lock()
+_breaker_settings = {"failure_threshold": DEFAULT_FAILURE_THRESHOLD, "cooldown_seconds": DEFAULT_COOLDOWN_SECONDS}
+
+
+def configure_circuit_breakers(failure_threshold: int = DEFAULT_FAILURE_THRESHOLD, cooldown_seconds: float = DEFAULT_COOLDOWN_SECONDS):
+    """Set the thresholds of the circuit breakers this process creates from now on."""
+    with _breakers_lock:
+        _breaker_settings.update(failure_threshold=failure_threshold, cooldown_seconds=cooldown_seconds)
+        _breakers.clear()
+
+
+def circuit_breaker(model: str) -> CircuitBreaker:
+    """The CircuitBreaker of a model, shared by this process's calls to it."""
+    with _breakers_lock:
+        if model not in _breakers:
+            _breakers[model] = CircuitBreaker(model, **_breaker_settings)
+        return _breakers[model]
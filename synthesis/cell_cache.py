@@ -0,0 +1,85 @@
+import hashlib
+import json
+import os
+import sqlite3
+import time
+from typing import Any, Dict, Optional
+
+base_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+DEFAULT_CELL_CACHE_PATH = f"{base_dir}/.cache/cell_classifications.sqlite"
+
+
+def prompt_context_hash(*parts: str) -> str:
+    """Hash of everything a classification depends on besides the cell itself (prompt templates, domain vocabulary, model settings)."""
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(part.encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()[:16]
+
+
+class CellClassificationCache:
+    """On-disk cell classification cache shared across problems.
+
+    Entries are keyed by (cell fingerprint, domain family, prompt context hash) and the
+    least recently used entries are evicted once the cache holds more than max_entries.
+    A classification is reused by every problem of the domain family whose prompt
+    context hash matches (see segment_cells.classification_context_hash).
+    """
+
+    def __init__(self, path: str = DEFAULT_CELL_CACHE_PATH, max_entries: int = 20000):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._conn = sqlite3.connect(path, timeout=30)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS cells ("
+            "fingerprint TEXT, domain_family TEXT, context_hash TEXT, "
+            "classification TEXT, last_used REAL, "
+            "PRIMARY KEY (fingerprint, domain_family, context_hash))"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS cells_last_used ON cells (last_used)")
+        self._conn.commit()
+
+    def get(self, fingerprint: str, domain_family: str, context_hash: str) -> Optional[Dict[str, Any]]:
+        key = (fingerprint, domain_family, context_hash)
+        row = self._conn.execute(
+            "SELECT classification FROM cells WHERE fingerprint = ? AND domain_family = ? AND context_hash = ?", key
+        ).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self._conn.execute(
+            "UPDATE cells SET last_used = ? WHERE fingerprint = ? AND domain_family = ? AND context_hash = ?", (time.time(), *key)
+        )
+        self._conn.commit()
+        self.hits += 1
+        return json.loads(row[0])
+
+    def put(self, fingerprint: str, domain_family: str, context_hash: str, classification: Dict[str, Any]):
+        self._conn.execute(
+            "INSERT OR REPLACE INTO cells VALUES (?, ?, ?, ?, ?)",
+            (fingerprint, domain_family, context_hash, json.dumps(classification), time.time()),
+        )
+        self._evict()
+        self._conn.commit()
+
+    def _evict(self):
+        (num_entries,) = self._conn.execute("SELECT COUNT(*) FROM cells").fetchone()
+        if num_entries > self.max_entries:
+            self._conn.execute(
+                "DELETE FROM cells WHERE rowid IN (SELECT rowid FROM cells ORDER BY last_used ASC LIMIT ?)",
+                (num_entries - self.max_entries,),
+            )
+
+    def clear(self, domain_family: Optional[str] = None):
+        if domain_family is None:
+            self._conn.execute("DELETE FROM cells")
+        else:
+            self._conn.execute("DELETE FROM cells WHERE domain_family = ?", (domain_family,))
+        self._conn.commit()
+
+    def close(self):
+        self._conn.close()
@@ -0,0 +1,95 @@
+import hashlib
+from typing import List, Dict, Tuple
+import numpy as np
+
+EXACT_HASH_SIZE = 8
+EXACT_HASH_LEVELS = 8
+PHASH_SIZE = 32
+PHASH_BITS = 8
+
+
+def _area_downsample(cells: np.ndarray, size: int) -> np.ndarray:
+    """Average (n, h, w, C) cells down to (n, size, size, C) blocks."""
+    height, width = cells.shape[1], cells.shape[2]
+    size_h = min(size, height)
+    size_w = min(size, width)
+    edges_h = np.linspace(0, height, size_h + 1).astype(int)
+    edges_w = np.linspace(0, width, size_w + 1).astype(int)
+
+    summed = np.add.reduceat(cells.astype(np.float64), edges_h[:-1], axis=1)
+    summed = np.add.reduceat(summed, edges_w[:-1], axis=2)
+    counts = np.outer(np.diff(edges_h), np.diff(edges_w))[None, :, :, None]
+    return summed / counts
+
+
+def exact_cell_hashes(cells: np.ndarray) -> List[str]:
+    """Hash of each (n, h, w, 3) cell after downsampling to 8x8 and quantizing to 8 levels per channel."""
+    if len(cells) == 0:
+        return []
+    quantized = (_area_downsample(cells, EXACT_HASH_SIZE) * EXACT_HASH_LEVELS / 256).astype(np.uint8)
+    return [hashlib.blake2b(cell.tobytes(), digest_size=8).hexdigest() for cell in quantized]
+
+
+def _dct_matrix(size: int) -> np.ndarray:
+    k = np.arange(size)[:, None]
+    n = np.arange(size)[None, :]
+    return np.cos(np.pi * (2 * n + 1) * k / (2 * size))
+
+
+def perceptual_cell_hashes(cells: np.ndarray) -> List[int]:
+    """64-bit DCT perceptual hash of each (n, h, w, 3) cell."""
+    if len(cells) == 0:
+        return []
+    gray = _area_downsample(cells, PHASH_SIZE) @ np.array([0.299, 0.587, 0.114])
+    dct = _dct_matrix(gray.shape[1])
+    dct_w = _dct_matrix(gray.shape[2])
+    coeffs = np.einsum("ij,njk,lk->nil", dct, gray, dct_w)[:, :PHASH_BITS, :PHASH_BITS].reshape(len(cells), -1)
+    # Compare against the median of the AC coefficients so flat cells share one hash whatever their color
+    bits = coeffs > np.median(coeffs[:, 1:], axis=1, keepdims=True) + 1e-6
+    return [int.from_bytes(packed.tobytes(), "big") for packed in np.packbits(bits, axis=1)]
+
+
+class CellFingerprintIndex:
+    """Maps cells to content-addressed class keys, merging near-duplicate tiles.
+
+    A cell's exact key is the hash of its downsampled, quantized pixels. A new exact key
+    joins an existing class when its perceptual hash is within hamming_radius bits and
+    its mean color within color_tolerance levels of that class's first member; the class
+    key is the exact key of that first member.
+    """
+
+    def __init__(self, hamming_radius: int = 4, color_tolerance: float = 6.0):
+        self.hamming_radius = hamming_radius
+        self.color_tolerance = color_tolerance
+        self.exact_to_key: Dict[str, str] = {}
+        self.classes: List[Tuple[str, int, np.ndarray]] = []
+
+    def __len__(self) -> int:
+        return len(self.classes)
+
+    def _lookup_near_duplicate(self, phash: int, mean_color: np.ndarray) -> str:
+        for key, class_phash, class_color in self.classes:
+            if bin(phash ^ class_phash).count("1") <= self.hamming_radius and np.abs(mean_color - class_color).max() <= self.color_tolerance:
+                return key
+        return ""
+
+    def assign(self, cells: np.ndarray) -> List[str]:
+        """Return the class key of every (n, h, w, 3) cell, registering new classes as needed."""
+        exact_hashes = exact_cell_hashes(cells)
+        new_positions = {}
+        for position, exact_hash in enumerate(exact_hashes):
+            if exact_hash not in self.exact_to_key and exact_hash not in new_positions:
+                new_positions[exact_hash] = position
+
+        if new_positions:
+            new_cells = cells[list(new_positions.values())]
+            phashes = perceptual_cell_hashes(new_cells)
+            mean_colors = new_cells.mean(axis=(1, 2))
+            for exact_hash, phash, mean_color in zip(new_positions, phashes, mean_colors):
+                key = self._lookup_near_duplicate(phash, mean_color)
+                if not key:
+                    key = exact_hash
+                    self.classes.append((key, phash, mean_color))
+                self.exact_to_key[exact_hash] = key
+
+        return [self.exact_to_key[exact_hash] for exact_hash in exact_hashes]
@@ -0,0 +1,143 @@
+from typing import Dict, List, Optional, Sequence, Tuple
+import numpy as np
+
+# Cells whose std is at most this are treated as plain background without objects
+OBJECT_STD_THRESHOLD = np.float32(0.1)
+
+
+class CellGrid:
+    """Cell statistics of one (rows, cols) frame.
+
+    means is the ceil(mean pixel value) of each cell, stds the per-channel standard
+    deviation averaged over channels and ids the index of each cell's key in the key
+    table of the FrameStack the grid belongs to.
+    """
+
+    __slots__ = ("frame_idx", "means", "stds", "ids", "changed_cells")
+
+    def __init__(self, frame_idx: int, means: np.ndarray, stds: np.ndarray, ids: np.ndarray, changed_cells: Optional[List[Tuple[int, int]]] = None):
+        self.frame_idx = frame_idx
+        self.means = np.asarray(means, dtype=np.uint16)
+        self.stds = np.asarray(stds, dtype=np.float32)
+        self.ids = np.asarray(ids, dtype=np.int32)
+        # The (row, col) cells that changed since the previous frame, or None if the frame was fully segmented
+        self.changed_cells = changed_cells
+
+    @property
+    def shape(self) -> Tuple[int, int]:
+        return self.ids.shape
+
+    def has_objects(self, row: int, col: int) -> bool:
+        return bool(self.stds[row, col] > OBJECT_STD_THRESHOLD)
+
+
+CELL_OCCURRENCE_DTYPE = np.dtype([("frame", np.int32), ("id", np.int32), ("row", np.int16), ("col", np.int16)])
+
+
+class CellIndex:
+    """Frame-keyed inverted index over the cells of consecutive CellGrids.
+
+    occurrences holds every cell as a (frame, id, row, col) record, sorted by frame,
+    then key id, then row-major position. Each frame occupies a fixed-size slice and
+    group_starts marks where each (frame, id) run begins, so the cells of one frame
+    are grouped by key without touching any other frame.
+    """
+
+    __slots__ = ("first_frame_idx", "num_frames", "cells_per_frame", "occurrences", "group_starts", "group_frame_offsets")
+
+    def __init__(self, grids: List[CellGrid]):
+        self.first_frame_idx = grids[0].frame_idx if grids else 0
+        self.num_frames = len(grids)
+        rows, cols = grids[0].shape if grids else (0, 0)
+        self.cells_per_frame = rows * cols
+
+        flat_ids = np.stack([grid.ids for grid in grids]).reshape(self.num_frames, -1) if grids else np.empty((0, 0), dtype=np.int32)
+        cell_order = np.argsort(flat_ids, axis=1, kind="stable")
+        sorted_ids = np.take_along_axis(flat_ids, cell_order, axis=1)
+
+        self.occurrences = np.empty(flat_ids.size, dtype=CELL_OCCURRENCE_DTYPE)
+        self.occurrences["frame"] = np.repeat(np.arange(self.first_frame_idx, self.first_frame_idx + self.num_frames), self.cells_per_frame)
+        self.occurrences["id"] = sorted_ids.ravel()
+        self.occurrences["row"], self.occurrences["col"] = np.divmod(cell_order.ravel(), max(cols, 1))
+
+        run_starts = np.ones(sorted_ids.shape, dtype=bool)
+        run_starts[:, 1:] = sorted_ids[:, 1:] != sorted_ids[:, :-1]
+        self.group_starts = np.flatnonzero(run_starts.ravel())
+        self.group_frame_offsets = np.searchsorted(self.group_starts, np.arange(self.num_frames + 1) * self.cells_per_frame)
+
+    def covers(self, first_frame_idx: int, num_frames: int) -> bool:
+        return self.first_frame_idx == first_frame_idx and self.num_frames == num_frames
+
+    def cells_by_key(self, frame_idx: int) -> Dict[int, List[Tuple[int, int]]]:
+        """Map each key id in frame frame_idx to its (row, col) cells, in id and row-major order."""
+        frame_pos = frame_idx - self.first_frame_idx
+        starts = self.group_starts[self.group_frame_offsets[frame_pos]:self.group_frame_offsets[frame_pos + 1]].tolist()
+        ends = starts[1:] + [(frame_pos + 1) * self.cells_per_frame]
+        frame_cells = {}
+        for start, end in zip(starts, ends):
+            group = self.occurrences[start:end]
+            frame_cells[int(group["id"][0])] = list(zip(group["row"].tolist(), group["col"].tolist()))
+        return frame_cells
+
+
+class FrameStack:
+    """CellGrids of consecutive frames sharing one table of cell keys.
+
+    Keys (cell fingerprints or ceil(mean) strings) are numbered in order of first
+    appearance and first_seen[id] is the (frame_idx, row, col) where key id first
+    appeared. With a window, only the most recent window grids are kept.
+    """
+
+    __slots__ = ("dim", "window", "keys", "key_ids", "first_seen", "grids", "first_frame_idx", "_cell_index")
+
+    def __init__(self, dim: Tuple[int, int], window: Optional[int] = None):
+        self.dim = (int(dim[0]), int(dim[1]))
+        self.window = window
+        self.keys: List[str] = []
+        self.key_ids: Dict[str, int] = {}
+        self.first_seen: List[Tuple[int, int, int]] = []
+        self.grids: List[CellGrid] = []
+        self.first_frame_idx = 0
+        self._cell_index: Optional[CellIndex] = None
+
+    def __len__(self) -> int:
+        return self.first_frame_idx + len(self.grids)
+
+    def __getitem__(self, frame_idx: int) -> CellGrid:
+        return self.grids[frame_idx - self.first_frame_idx]
+
+    def register_keys(self, frame_idx: int, keys: Sequence[str], cells: Sequence[Tuple[int, int]]) -> np.ndarray:
+        """Return the ids of keys found at cells of frame frame_idx, numbering new keys."""
+        ids = np.empty(len(keys), dtype=np.int32)
+        for n, (key, (row, col)) in enumerate(zip(keys, cells)):
+            key_id = self.key_ids.get(key)
+            if key_id is None:
+                key_id = len(self.keys)
+                self.key_ids[key] = key_id
+                self.keys.append(key)
+                self.first_seen.append((frame_idx, row, col))
+            ids[n] = key_id
+        return ids
+
+    def append(self, grid: CellGrid):
+        self.grids.append(grid)
+        if self.window is not None and len(self.grids) > self.window:
+            self.grids.pop(0)
+            self.first_frame_idx += 1
+
+    def cell_index(self) -> CellIndex:
+        """Inverted index over the held grids, rebuilt only after grids were appended."""
+        if self._cell_index is None or not self._cell_index.covers(self.first_frame_idx, len(self.grids)):
+            self._cell_index = CellIndex(self.grids)
+        return self._cell_index
+
+    def cells_by_key(self, frame_idx: int) -> Dict[int, List[Tuple[int, int]]]:
+        return self.cell_index().cells_by_key(frame_idx)
+
+    def slice(self, start: int, stop: int) -> "FrameStack":
+        """A FrameStack of frames start to stop - 1 sharing this stack's key table, e.g. to hand a frame range to a worker process."""
+        frame_stack = FrameStack(self.dim)
+        frame_stack.keys = self.keys
+        frame_stack.grids = self.grids[start - self.first_frame_idx:stop - self.first_frame_idx]
+        frame_stack.first_frame_idx = start
+        return frame_stack
@@ -0,0 +1,84 @@
+import argparse
+import glob
+import os
+import re
+import time
+from typing import List, Tuple
+import numpy as np
+from pddl_problem import parse_sexprs
+from segment_cells import bit_matrix_literal
+
+NEW_BIT_MATRIX_RE = re.compile(r"^\(= \((\S+)\) \(new-bit-matrix false (\d+) (\d+)\)\)$")
+SET_INDEX_RE = re.compile(r"^\(= \((\S+)\) \(set-index \S+ true (\d+) (\d+)\)\)$")
+
+
+def literal_encode_frame_pddl(pddl_str: str) -> str:
+    """Rewrite the new-bit-matrix/set-index facts of a frame problem as one bit-mat literal per matrix."""
+    matrices = {}
+    literal_positions = {}
+    out_lines = []
+    for line in pddl_str.split("\n"):
+        new_matrix = NEW_BIT_MATRIX_RE.match(line.strip())
+        set_index = SET_INDEX_RE.match(line.strip())
+        if new_matrix:
+            name, rows, cols = new_matrix.group(1), int(new_matrix.group(2)), int(new_matrix.group(3))
+            matrices[name] = np.zeros((rows, cols), dtype=bool)
+            literal_positions[name] = len(out_lines)
+            out_lines.append(None)
+        elif set_index and set_index.group(1) in matrices:
+            matrices[set_index.group(1)][int(set_index.group(2)) - 1, int(set_index.group(3)) - 1] = True
+        else:
+            out_lines.append(line)
+    for name, matrix in matrices.items():
+        out_lines[literal_positions[name]] = f"(= ({name}) {bit_matrix_literal(matrix)})"
+    return "\n".join(out_lines)
+
+
+def _time_parse(pddl_strs: List[str], repeats: int) -> float:
+    best = float("inf")
+    for _ in range(repeats):
+        start = time.perf_counter()
+        for pddl_str in pddl_strs:
+            parse_sexprs(pddl_str)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def compare_problem(problem_dir: str, repeats: int = 5) -> Tuple[int, dict, dict]:
+    frame_paths = sorted(glob.glob(os.path.join(problem_dir, "frame_*.pddl")))
+    set_index_strs = []
+    for frame_path in frame_paths:
+        with open(frame_path, "r") as f:
+            set_index_strs.append(f.read())
+    literal_strs = [literal_encode_frame_pddl(pddl_str) for pddl_str in set_index_strs]
+
+    stats = []
+    for pddl_strs in (set_index_strs, literal_strs):
+        stats.append({
+            "bytes": sum(len(pddl_str.encode("utf-8")) for pddl_str in pddl_strs),
+            "lines": sum(pddl_str.count("\n") + 1 for pddl_str in pddl_strs),
+            "parse_s": _time_parse(pddl_strs, repeats),
+        })
+    return len(frame_paths), stats[0], stats[1]
+
+
+def __main__():
+    parser = argparse.ArgumentParser(description="Compare set-index and bit-mat literal encodings of generated frame PDDL files.")
+    parser.add_argument("problem_dirs", nargs="+", help="Folders holding frame_k.pddl files.")
+    parser.add_argument("--repeats", type=int, default=5, help="Parse timing repeats; the best run is reported.")
+    args = parser.parse_args()
+
+    print(f"{'problem':<40} {'frames':>6} {'set-index B':>12} {'literal B':>10} {'lines':>13} {'parse ms':>15}")
+    for problem_dir in args.problem_dirs:
+        num_frames, set_index_stats, literal_stats = compare_problem(problem_dir, args.repeats)
+        if num_frames == 0:
+            continue
+        print(
+            f"{problem_dir:<40} {num_frames:>6} {set_index_stats['bytes']:>12} {literal_stats['bytes']:>10} "
+            f"{set_index_stats['lines']:>6}/{literal_stats['lines']:<6} "
+            f"{set_index_stats['parse_s'] * 1000:>7.2f}/{literal_stats['parse_s'] * 1000:<7.2f}"
+        )
+
+
+if __name__ == "__main__":
+    __main__()
@@ -0,0 +1,128 @@
+import asyncio
+import hashlib
+import json
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
+from rate_limiter import estimate_tokens
+from response_cache import canonical_contents
+
+# Lifetime of an uploaded prefix; one problem's classification calls fit well within it
+CONTEXT_CACHE_TTL_SECONDS = 900
+# A prefix this close to expiring is uploaded again rather than referenced
+CONTEXT_CACHE_REFRESH_SECONDS = 60
+# Shorter prefixes are sent inline: Gemini does not cache fewer tokens than this (more for some models)
+MIN_CACHED_TOKENS = 1024
+# Context caching needs a model version with a fixed number
+CACHED_MODEL_VERSIONS = {
+    "gemini-2.0-flash": "gemini-2.0-flash-001",
+}
+
+
+class CachedPrefix:
+    __slots__ = ("name", "model", "expires")
+
+    def __init__(self, name: str, model: str, expires: float):
+        self.name = name
+        self.model = model
+        self.expires = expires
+
+
+def prefix_key(model: str, prefix: List[Any]) -> str:
+    return hashlib.sha256(json.dumps([model, canonical_contents(prefix)], sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+class ContextCache:
+    """Static prompt prefixes uploaded once as provider-side cached content (Gemini context caching).
+
+    lookup returns the cached content a request can reference in place of its prefix,
+    uploading the prefix on first use and again shortly before it expires, when the
+    replaced upload is deleted. It returns None, and the request sends its prefix
+    inline, when the client has no caching, the prefix is too short to cache, or the
+    upload or a request using it failed; such prefixes are not tried again.
+    lookup_async uploads on a worker thread, so the event loop keeps running meanwhile.
+    """
+
+    def __init__(self, client: Any, ttl_seconds: float = CONTEXT_CACHE_TTL_SECONDS, enabled: bool = True):
+        self.client = client
+        self.ttl_seconds = ttl_seconds
+        self.enabled = enabled and getattr(client, "caches", None) is not None
+        self._prefixes: Dict[str, Optional[CachedPrefix]] = {}
+        self._lock = threading.Lock()
+        # One lock per prefix, so a prefix is uploaded once however many requests wait for it
+        self._upload_locks: Dict[str, threading.Lock] = {}
+
+    def _current(self, key: str) -> Tuple[bool, Optional[CachedPrefix]]:
+        """(whether the prefix's entry can be used as it is, the entry)."""
+        with self._lock:
+            if key not in self._prefixes:
+                return False, None
+            cached = self._prefixes[key]
+        return cached is None or cached.expires - time.monotonic() > CONTEXT_CACHE_REFRESH_SECONDS, cached
+
+    def lookup(self, model: str, prefix: List[Any]) -> Optional[CachedPrefix]:
+        if not self.enabled:
+            return None
+        key = prefix_key(model, prefix)
+        usable, cached = self._current(key)
+        if usable:
+            return cached
+        with self._lock:
+            upload_lock = self._upload_locks.setdefault(key, threading.Lock())
+        with upload_lock:
+            # Another request may have uploaded the prefix while this one waited
+            usable, cached = self._current(key)
+            if usable:
+                return cached
+            uploaded = self._upload(model, prefix)
+            with self._lock:
+                self._prefixes[key] = uploaded
+        if cached is not None:
+            self._delete(cached)
+        return uploaded
+
+    async def lookup_async(self, model: str, prefix: List[Any]) -> Optional[CachedPrefix]:
+        if not self.enabled:
+            return None
+        usable, cached = self._current(prefix_key(model, prefix))
+        if usable:
+            return cached
+        return await asyncio.to_thread(self.lookup, model, prefix)
+
+    def _upload(self, model: str, prefix: List[Any]) -> Optional[CachedPrefix]:
+        if estimate_tokens(prefix) < MIN_CACHED_TOKENS:
+            return None
+        from google.genai import types
+
+        cached_model = CACHED_MODEL_VERSIONS.get(model, model)
+        try:
+            cached_content = self.client.caches.create(model=cached_model, config=types.CreateCachedContentConfig(
+                contents=prefix,
+                ttl=f"{int(self.ttl_seconds)}s",
+            ))
+        except Exception as e:
+            print(f"Could not cache the prompt prefix on {cached_model} ({e.__class__.__name__}: {e}); sending it inline.")
+            return None
+        print(f"Cached the prompt prefix as {cached_content.name} for {int(self.ttl_seconds)}s.")
+        return CachedPrefix(cached_content.name, cached_model, time.monotonic() + self.ttl_seconds)
+
+    def _delete(self, cached: CachedPrefix):
+        try:
+            self.client.caches.delete(name=cached.name)
+        except Exception as e:
+            print(f"Could not delete cached content {cached.name}: {e}")
+
+    def discard(self, model: str, prefix: List[Any], cached: CachedPrefix):
+        """Send prefix inline from now on after its cached content was rejected, unless that content was already replaced."""
+        key = prefix_key(model, prefix)
+        with self._lock:
+            if self._prefixes.get(key) is cached:
+                self._prefixes[key] = None
+
+    def close(self):
+        """Delete the uploaded prefixes that have not expired yet."""
+        with self._lock:
+            cached = [c for c in self._prefixes.values() if c is not None and c.expires > time.monotonic()]
+            self._prefixes.clear()
+        for c in cached:
+            self._delete(c)
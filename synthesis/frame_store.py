@@ -0,0 +1,77 @@
+import json
+import os
+from typing import Any, Dict, Tuple
+import numpy as np
+from PIL import Image, ImageSequence
+
+FRAME_STORE_VERSION = 1
+
+
+def frame_store_paths(gif_path: str) -> Tuple[str, str]:
+    """Paths of the decoded frame array and its metadata header, next to the GIF."""
+    root, _ = os.path.splitext(gif_path)
+    return f"{root}.frames.npy", f"{root}.frames.json"
+
+
+def _source_stamp(gif_path: str) -> Dict[str, Any]:
+    stat = os.stat(gif_path)
+    return {"source": os.path.basename(gif_path), "source_size": stat.st_size, "source_mtime_ns": stat.st_mtime_ns}
+
+
+def read_frame_store_header(gif_path: str) -> Dict[str, Any]:
+    _, meta_path = frame_store_paths(gif_path)
+    with open(meta_path, "r") as f:
+        return json.load(f)
+
+
+def is_frame_store_fresh(gif_path: str) -> bool:
+    npy_path, meta_path = frame_store_paths(gif_path)
+    if not (os.path.exists(npy_path) and os.path.exists(meta_path)):
+        return False
+    try:
+        header = read_frame_store_header(gif_path)
+    except (OSError, json.JSONDecodeError):
+        return False
+    return header.get("version") == FRAME_STORE_VERSION and all(header.get(k) == v for k, v in _source_stamp(gif_path).items())
+
+
+def build_frame_store(gif_path: str) -> Dict[str, Any]:
+    """Decode every GIF frame to RGB once and write them to a (frames, height, width, 3) uint8 .npy file."""
+    npy_path, meta_path = frame_store_paths(gif_path)
+    with Image.open(gif_path) as gif:
+        num_frames = getattr(gif, "n_frames", 1)
+        width, height = gif.size
+        durations = []
+
+        # Write to temporary files first so concurrent readers never see a partial store
+        tmp_npy_path = f"{npy_path}.{os.getpid()}.tmp"
+        frames = np.lib.format.open_memmap(tmp_npy_path, mode="w+", dtype=np.uint8, shape=(num_frames, height, width, 3))
+        for frame_idx, frame in enumerate(ImageSequence.Iterator(gif)):
+            frames[frame_idx] = np.asarray(frame.convert("RGB"))
+            durations.append(frame.info.get("duration", 0))
+        frames.flush()
+        del frames
+
+    header = {
+        "version": FRAME_STORE_VERSION,
+        **_source_stamp(gif_path),
+        "num_frames": num_frames,
+        "height": height,
+        "width": width,
+        "dtype": "uint8",
+        "durations": durations,
+    }
+    tmp_meta_path = f"{meta_path}.{os.getpid()}.tmp"
+    with open(tmp_meta_path, "w") as f:
+        json.dump(header, f, indent=4)
+    os.replace(tmp_npy_path, npy_path)
+    os.replace(tmp_meta_path, meta_path)
+    return header
+
+
+def load_frames(gif_path: str) -> np.ndarray:
+    """Return the RGB frames of a GIF as a read-only memory map, decoding the GIF only if its store is missing or stale."""
+    if not is_frame_store_fresh(gif_path):
+        build_frame_store(gif_path)
+    npy_path, _ = frame_store_paths(gif_path)
+    return np.load(npy_path, mmap_mode="r")
@@ -0,0 +1,98 @@
+import os
+from typing import List, Optional, Tuple
+import numpy as np
+from frame_store import load_frames
+
+MIN_CELL_PX = 8
+MAX_CELLS = 50
+HIGHPASS_WIDTH = 15
+HARMONIC_TOLERANCE = 0.8
+
+
+def _edge_profiles(frame_array: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Summed absolute intensity change between neighbouring pixel rows and columns."""
+    gray = frame_array.astype(np.float32).mean(axis=-1)
+    row_profile = np.abs(np.diff(gray, axis=0)).sum(axis=1)
+    col_profile = np.abs(np.diff(gray, axis=1)).sum(axis=0)
+    return row_profile, col_profile
+
+
+def _autocorrelation(profile: np.ndarray) -> np.ndarray:
+    """Normalized autocorrelation of the sharp peaks of an edge profile."""
+    x = np.sqrt(profile.astype(np.float64))
+    # Subtract a running median so only thin lines (gridlines, wall edges) remain
+    padded = np.pad(x, HIGHPASS_WIDTH // 2, mode="edge")
+    running_median = np.median(np.lib.stride_tricks.sliding_window_view(padded, HIGHPASS_WIDTH), axis=1)
+    x = np.clip(x - running_median, 0, None)
+
+    spectrum = np.fft.rfft(x, 2 * len(x))
+    acf = np.fft.irfft(spectrum * np.conj(spectrum))[:len(x)]
+    return acf / acf[0] if acf[0] > 0 else acf
+
+
+def detect_cells_along_axis(profile: np.ndarray, max_cells: int = MAX_CELLS) -> Tuple[int, float]:
+    """Number of cells along one axis and the autocorrelation backing it.
+
+    Every cell boundary is a multiple of the cell size, so the autocorrelation of the edge
+    profile peaks at the cell size and its multiples (fewer cells). The largest cell count
+    whose lag scores close to the best one is taken.
+    """
+    length = len(profile) + 1
+    acf = _autocorrelation(profile)
+    scores = {}
+    for num_cells in range(2, min(max_cells, length // MIN_CELL_PX) + 1):
+        lag = int(round(length / num_cells))
+        scores[num_cells] = float(acf[max(lag - 2, 0):lag + 3].max())
+    if not scores:
+        return 1, 0.0
+    best_score = max(scores.values())
+    num_cells = max(n for n, score in scores.items() if score >= HARMONIC_TOLERANCE * best_score)
+    return num_cells, scores[num_cells]
+
+
+def detect_grid_size(frames: np.ndarray, max_frames: int = 3, min_score: float = 0.3) -> Optional[Tuple[int, int]]:
+    """Infer (rows, cols) of a gridworld recording from the periodicity of its gridlines and cell edges.
+
+    frames is a (frames, height, width, 3) array. Returns None if no periodic structure
+    is clearly visible.
+    """
+    row_profile = np.zeros(frames.shape[1] - 1, dtype=np.float64)
+    col_profile = np.zeros(frames.shape[2] - 1, dtype=np.float64)
+    for frame_array in frames[:max_frames]:
+        frame_row_profile, frame_col_profile = _edge_profiles(frame_array)
+        row_profile += frame_row_profile
+        col_profile += frame_col_profile
+
+    rows, row_score = detect_cells_along_axis(row_profile)
+    cols, col_score = detect_cells_along_axis(col_profile)
+    if row_score < min_score or col_score < min_score:
+        return None
+    return rows, cols
+
+
+GRID_CHECK_MODES = ("override", "validate", "off")
+
+
+def check_grid_size(gif_path: str, grid_size: List[int], mode: str = "override") -> List[int]:
+    """Compare a configured [rows, cols] against the grid detected in the GIF.
+
+    In "override" mode a confidently detected grid replaces a mismatching grid_size,
+    "validate" only reports the mismatch and "off" skips detection.
+    """
+    if mode not in GRID_CHECK_MODES:
+        raise ValueError(f"Unknown grid check mode: {mode}. Expected one of {GRID_CHECK_MODES}.")
+    if mode == "off":
+        return grid_size
+
+    detected = detect_grid_size(load_frames(gif_path))
+    if detected is None:
+        print(f"Grid detection inconclusive for {os.path.basename(gif_path)}, keeping grid_size {grid_size}")
+        return grid_size
+    if list(detected) == list(grid_size or []):
+        return grid_size
+
+    print(f"Warning: configured grid_size {grid_size} does not match detected grid {list(detected)} in {os.path.basename(gif_path)}")
+    if mode == "override":
+        print(f"Overriding grid_size with {list(detected)}")
+        return list(detected)
+    return grid_size
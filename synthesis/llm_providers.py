@@ -0,0 +1,466 @@
+import asyncio
+import threading
+import time
+import weakref
+from typing import Any, Dict, Optional, Tuple
+import httpx
+from google import genai
+from google.genai import errors as genai_errors
+from google.genai import types
+from call_budget import TIMEOUT_ERRORS, CallBudget, circuit_breaker
+from context_cache import CachedPrefix, ContextCache
+from rate_limiter import estimate_tokens, is_rate_limit_error, rate_limiter
+from response_cache import response_cache
+from telemetry import payload_bytes, record_call, telemetry
+
+# Connection pool shared by every provider of the process (httpx defaults: 100, 20, 5s)
+POOL_MAX_CONNECTIONS = 100
+POOL_MAX_KEEPALIVE_CONNECTIONS = 32
+POOL_KEEPALIVE_SECONDS = 60.0
+GEMINI_OPENAI_BASE_URL = "https://generativelanguage.googleapis.com/v1beta/openai/"
+# 429s one call retries before giving up; with the limiter's backoff capped at a minute, at most about 20 minutes
+MAX_RATE_LIMITED_ATTEMPTS = 20
+
+
+class RetryPolicy:
+    """How a provider retries failed attempts: 5xx errors, connection errors and timeouts.
+
+    Waits initial_delay_seconds after the first failure, backoff_factor times longer after
+    each further one, up to max_delay_seconds. max_attempts=None retries until the budget
+    or the circuit breaker stops the call. 429s are paced by the rate limiter and never
+    count as failed attempts; a call gives up after max_rate_limited of them instead
+    (None retries them until the budget stops the call).
+    """
+    __slots__ = ("max_attempts", "max_rate_limited", "initial_delay_seconds", "max_delay_seconds", "backoff_factor")
+
+    def __init__(self, max_attempts: Optional[int] = None, max_rate_limited: Optional[int] = MAX_RATE_LIMITED_ATTEMPTS, initial_delay_seconds: float = 1.0, max_delay_seconds: float = 20.0, backoff_factor: float = 1.1):
+        self.max_attempts = max_attempts
+        self.max_rate_limited = max_rate_limited
+        self.initial_delay_seconds = initial_delay_seconds
+        self.max_delay_seconds = max_delay_seconds
+        self.backoff_factor = backoff_factor
+
+
+class Usage:
+    """Tokens of one response; fields the provider does not report are None. cached_tokens
+    are the input tokens served from a provider-side cache."""
+    __slots__ = ("input_tokens", "output_tokens", "total_tokens", "cached_tokens")
+
+    def __init__(self, input_tokens: Optional[int] = None, output_tokens: Optional[int] = None, total_tokens: Optional[int] = None, cached_tokens: Optional[int] = None):
+        self.input_tokens = input_tokens
+        self.output_tokens = output_tokens
+        if total_tokens is None and input_tokens is not None and output_tokens is not None:
+            total_tokens = input_tokens + output_tokens
+        self.total_tokens = total_tokens
+        self.cached_tokens = cached_tokens
+
+
+class LLMResponse:
+    """A model's answer, whichever provider gave it. attempts is 0 for a cached response."""
+    __slots__ = ("text", "usage", "model", "attempts", "cached", "seconds")
+
+    def __init__(self, text: str, usage: Usage, model: str, attempts: int, cached: bool, seconds: float):
+        self.text = text
+        self.usage = usage
+        self.model = model
+        self.attempts = attempts
+        self.cached = cached
+        self.seconds = seconds
+
+
+_pool_limits = httpx.Limits(
+    max_connections=POOL_MAX_CONNECTIONS,
+    max_keepalive_connections=POOL_MAX_KEEPALIVE_CONNECTIONS,
+    keepalive_expiry=POOL_KEEPALIVE_SECONDS,
+)
+_http_client: Optional[httpx.Client] = None
+
+
+def configure_http_pool(
+    max_connections: int = POOL_MAX_CONNECTIONS,
+    max_keepalive_connections: int = POOL_MAX_KEEPALIVE_CONNECTIONS,
+    keepalive_seconds: float = POOL_KEEPALIVE_SECONDS,
+):
+    """Set the limits of the connection pool; providers created from now on use the new pool."""
+    global _pool_limits, _http_client
+    _pool_limits = httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_keepalive_connections, keepalive_expiry=keepalive_seconds)
+    _http_client = None
+
+
+def http_client() -> httpx.Client:
+    """The process's pooled HTTP client. It has no timeout of its own: every request brings one."""
+    global _http_client
+    if _http_client is None:
+        _http_client = httpx.Client(limits=_pool_limits, timeout=None)
+    return _http_client
+
+
+class _Attempts:
+    """The retry state of one request: pacing, budget, circuit breaker and cache bookkeeping around each attempt."""
+
+    def __init__(self, provider: "LLMProvider", model: str, contents: Any, budget: Optional[CallBudget], retry: RetryPolicy, entry_key, trace: Optional[Dict[str, Any]]):
+        self.provider = provider
+        self.model = model
+        self.contents = contents
+        self.trace = trace
+        self.budget = budget
+        self.retry = retry
+        self.entry_key = entry_key
+        self.limiter = rate_limiter(model)
+        self.breaker = circuit_breaker(model)
+        self.estimated_tokens = estimate_tokens(contents)
+        self.started = time.monotonic()
+        self.attempts = 0
+        self.failures = 0
+        self.rate_limited = 0
+        self.delay = retry.initial_delay_seconds
+        self.timeout: Optional[float] = None
+
+    def start(self) -> Optional[float]:
+        """Check the budget and the circuit breaker before an attempt; the attempt's timeout."""
+        self.timeout = None
+        if self.budget is not None:
+            self.budget.check()
+            self.timeout = self.budget.call_timeout()
+        self.breaker.before_call()
+        self.attempts += 1
+        if self.budget is not None:
+            self.budget.record_call()
+        return self.timeout
+
+    def succeeded(self, text: str, usage: Usage) -> LLMResponse:
+        self.breaker.record_success()
+        if self.budget is not None:
+            self.budget.record_tokens(usage.total_tokens or self.estimated_tokens)
+        if self.attempts > 1:
+            print(f"API call succeeded on attempt {self.attempts}.")
+        response_cache().put(self.entry_key, self.model, text, usage.total_tokens)
+        response = LLMResponse(text, usage, self.model, self.attempts, False, time.monotonic() - self.started)
+        _trace_call(self.provider, response, self.contents, self.entry_key, self.trace, failures=self.failures, rate_limited=self.rate_limited)
+        return response
+
+    def failed(self, error: Exception) -> float:
+        """Seconds to wait before retrying after error; raises error when it is not retried."""
+        try:
+            return self._retry_delay(error)
+        except Exception:
+            response = LLMResponse("", Usage(), self.model, self.attempts, False, time.monotonic() - self.started)
+            _trace_call(self.provider, response, self.contents, self.entry_key, self.trace, failures=self.failures,
+                        rate_limited=self.rate_limited, status=f"{error.__class__.__name__}: {error}")
+            raise
+
+    def _retry_delay(self, error: Exception) -> float:
+        if is_rate_limit_error(error):
+            self.rate_limited += 1
+            if self.retry.max_rate_limited is not None and self.rate_limited >= self.retry.max_rate_limited:
+                raise error
+            # The limiter has halved the model's concurrency and holds new calls until its backoff passes
+            print(f"API rate limited (status: 429). Attempt {self.attempts}. Retrying at concurrency limit {self.limiter.concurrency_limit():.1f}...")
+            return 0.0
+        timed_out = isinstance(error, self.provider.timeout_errors)
+        if not timed_out and not self.provider.is_server_error(error):
+            raise error
+        self.breaker.record_failure()
+        self.failures += 1
+        if self.retry.max_attempts is not None and self.failures >= self.retry.max_attempts:
+            raise error
+        if timed_out:
+            if self.budget is not None:
+                self.budget.timeouts += 1
+            print(f"API call timed out after {self.timeout}s. Attempt {self.attempts}. Retrying...")
+            return 0.0
+        print(f"API {error.__class__.__name__} (status: {getattr(error, 'code', None) or getattr(error, 'status_code', 'N/A')}). Attempt {self.attempts}. Retrying in {self.delay:.1f}s...")
+        delay = self.delay
+        self.delay = min(self.delay * self.retry.backoff_factor, self.retry.max_delay_seconds)
+        remaining = self.budget.remaining_seconds() if self.budget is not None else None
+        return delay if remaining is None else min(delay, remaining)
+
+
+def _trace_call(provider: "LLMProvider", response: LLMResponse, contents: Any, entry_key, trace: Optional[Dict[str, Any]], **fields):
+    """Write a call's record to the trace (see telemetry.py), if tracing is on."""
+    if telemetry() is None:
+        return
+    text_bytes, image_bytes, images = payload_bytes(contents)
+    record_call(
+        provider=provider.name, model=response.model, cached=response.cached, attempts=response.attempts,
+        input_tokens=response.usage.input_tokens, output_tokens=response.usage.output_tokens, total_tokens=response.usage.total_tokens,
+        cached_tokens=response.usage.cached_tokens,
+        prompt_bytes=text_bytes, image_bytes=image_bytes, images=images, response_bytes=len(response.text.encode("utf-8")),
+        latency_seconds=round(response.seconds, 4), sample=entry_key[1] if entry_key is not None else None,
+        **{"status": "ok", **fields, **(trace or {})}
+    )
+
+
+class LLMProvider:
+    """A model API behind the pipelines' common call path.
+
+    generate answers from the response cache when it can (see response_cache.py) and
+    otherwise calls the model through its shared rate limiter (see rate_limiter.py),
+    within the budget and circuit breaker of call_budget.py, retrying failed attempts
+    by the provider's RetryPolicy. Subclasses only make single attempts.
+    """
+
+    name = "provider"
+    timeout_errors: Tuple[type, ...] = TIMEOUT_ERRORS
+
+    def __init__(self, retry: Optional[RetryPolicy] = None):
+        self.retry = retry or RetryPolicy()
+
+    def is_server_error(self, error: Exception) -> bool:
+        raise NotImplementedError
+
+    async def aclose(self):
+        """Close the connections opened on the running event loop, before the loop is closed."""
+
+    def close(self):
+        """Release what the provider holds beyond its connections."""
+
+    def _generate(self, model: str, contents: Any, config: Any, timeout: Optional[float], cache_prefix: int = 0) -> Tuple[str, Usage]:
+        raise NotImplementedError
+
+    async def _generate_async(self, model: str, contents: Any, config: Any, timeout: Optional[float], cache_prefix: int = 0) -> Tuple[str, Usage]:
+        return await asyncio.to_thread(self._generate, model, contents, config, timeout, cache_prefix)
+
+    def _cached(self, model: str, contents: Any, config: Any, sample: Optional[int], trace: Optional[Dict[str, Any]]):
+        cache = response_cache()
+        entry_key = cache.entry_key(model, contents, config, sample)
+        started = time.monotonic()
+        cached = cache.get(entry_key)
+        if cached is None:
+            return entry_key, None
+        text, tokens = cached
+        response = LLMResponse(text, Usage(total_tokens=tokens), model, 0, True, time.monotonic() - started)
+        _trace_call(self, response, contents, entry_key, trace)
+        return entry_key, response
+
+    def generate(
+        self,
+        model: str,
+        contents: Any,
+        config: Any = None,
+        budget: Optional[CallBudget] = None,
+        sample: Optional[int] = None,
+        retry: Optional[RetryPolicy] = None,
+        trace: Optional[Dict[str, Any]] = None,
+        cache_prefix: int = 0,
+    ) -> LLMResponse:
+        """The model's response to contents. sample picks one of several recorded responses to the
+        same request; trace fields (e.g. the stage) are added to the call's trace record.
+
+        cache_prefix is the number of leading parts of contents shared by many requests;
+        providers with context caching upload them once and reference them instead.
+        """
+        entry_key, response = self._cached(model, contents, config, sample, trace)
+        if response is not None:
+            return response
+        attempt = _Attempts(self, model, contents, budget, retry or self.retry, entry_key, trace)
+        while True:
+            try:
+                timeout = attempt.start()
+                with attempt.limiter.slot(attempt.estimated_tokens) as slot:
+                    text, usage = self._generate(model, contents, config, timeout, cache_prefix)
+                    slot.used_tokens = usage.total_tokens
+            except Exception as e:
+                time.sleep(attempt.failed(e))
+                continue
+            return attempt.succeeded(text, usage)
+
+    async def generate_async(
+        self,
+        model: str,
+        contents: Any,
+        config: Any = None,
+        budget: Optional[CallBudget] = None,
+        sample: Optional[int] = None,
+        retry: Optional[RetryPolicy] = None,
+        trace: Optional[Dict[str, Any]] = None,
+        cache_prefix: int = 0,
+    ) -> LLMResponse:
+        """generate for event loops, so many calls can be in flight at once."""
+        entry_key, response = self._cached(model, contents, config, sample, trace)
+        if response is not None:
+            return response
+        attempt = _Attempts(self, model, contents, budget, retry or self.retry, entry_key, trace)
+        while True:
+            try:
+                timeout = attempt.start()
+                async with attempt.limiter.slot_async(attempt.estimated_tokens) as slot:
+                    # wait_for also bounds clients that ignore the HTTP timeout
+                    text, usage = await asyncio.wait_for(self._generate_async(model, contents, config, timeout, cache_prefix), timeout)
+                    slot.used_tokens = usage.total_tokens
+            except Exception as e:
+                await asyncio.sleep(attempt.failed(e))
+                continue
+            return attempt.succeeded(text, usage)
+
+
+def _with_timeout(config: Optional[types.GenerateContentConfig], timeout_seconds: Optional[float]) -> Optional[types.GenerateContentConfig]:
+    """config with the HTTP timeout of a single attempt set (the SDK takes milliseconds)."""
+    if timeout_seconds is None:
+        return config
+    http_options = types.HttpOptions(timeout=max(1, int(timeout_seconds * 1000)))
+    if config is None:
+        return types.GenerateContentConfig(http_options=http_options)
+    return config.model_copy(update={"http_options": http_options})
+
+
+def _gemini_usage(response: Any) -> Usage:
+    metadata = getattr(response, "usage_metadata", None)
+    return Usage(
+        getattr(metadata, "prompt_token_count", None),
+        getattr(metadata, "candidates_token_count", None),
+        getattr(metadata, "total_token_count", None),
+        getattr(metadata, "cached_content_token_count", None),
+    )
+
+
+class GeminiProvider(LLMProvider):
+    """Gemini through google.genai: contents are genai contents and config a GenerateContentConfig.
+
+    Built from an API key, the client sends its requests over the process's connection
+    pool; an existing client (e.g. mock_llm.MockGeminiClient) can be wrapped instead.
+    With context_caching, the prefixes of cache_prefix requests are uploaded once as
+    cached content (see context_cache.py); close deletes them.
+
+    Async connections belong to the event loop that opened them, so async calls go
+    through a client of their own per event loop, each with a pool of the process's
+    limits. aclose closes the running loop's client; those of loops closed without it
+    are dropped.
+    """
+
+    name = "gemini"
+
+    def __init__(self, api_key: Optional[str] = None, client: Any = None, retry: Optional[RetryPolicy] = None, context_caching: bool = True, base_url: Optional[str] = None):
+        super().__init__(retry)
+        self._api_key = api_key if client is None else None
+        self._base_url = base_url
+        if client is None:
+            client = self._new_client()
+        self.client = client
+        self.context_cache = ContextCache(client, enabled=context_caching)
+        self._loop_clients: Dict[asyncio.AbstractEventLoop, Tuple[Any, httpx.AsyncClient]] = {}
+        self._loop_lock = threading.Lock()
+
+    def aio(self) -> Any:
+        """The async surface (client.aio) of the running event loop's client."""
+        if self._api_key is None:
+            return self.client.aio
+        loop = asyncio.get_running_loop()
+        with self._loop_lock:
+            for closed in [other for other in self._loop_clients if other.is_closed()]:
+                del self._loop_clients[closed]
+            if loop not in self._loop_clients:
+                # The provider closes the loop's HTTP client itself (see aclose), so genai never
+                # tries to close it from another loop
+                loop_http_client = httpx.AsyncClient(limits=_pool_limits, timeout=None, follow_redirects=True)
+                self._loop_clients[loop] = (self._new_client(httpx_async_client=loop_http_client), loop_http_client)
+            return self._loop_clients[loop][0].aio
+
+    def _new_client(self, **http_options) -> Any:
+        return genai.Client(api_key=self._api_key, http_options=types.HttpOptions(base_url=self._base_url, httpx_client=http_client(), **http_options))
+
+    def is_server_error(self, error: Exception) -> bool:
+        return isinstance(error, (genai_errors.ServerError, httpx.TransportError))
+
+    def _request(self, cached: Optional[CachedPrefix], model: str, contents: Any, config: Any, timeout: Optional[float], cache_prefix: int) -> Tuple[str, Any, Any]:
+        """The (model, contents, config) to send, with the first cache_prefix parts of contents
+        replaced by their cached content when there is one."""
+        config = _with_timeout(config, timeout)
+        if cached is None:
+            return model, contents, config
+        config = (config or types.GenerateContentConfig()).model_copy(update={"cached_content": cached.name})
+        return cached.model, contents[cache_prefix:], config
+
+    def _cache_rejected(self, error: Exception, cached: Optional[CachedPrefix], model: str, prefix: Any) -> bool:
+        """Whether error is a rejection of the cached content (e.g. expired early), after which the request is sent inline."""
+        if cached is None or not isinstance(error, genai_errors.ClientError) or is_rate_limit_error(error):
+            return False
+        print(f"Cached content {cached.name} was rejected ({error}); sending the prompt prefix inline.")
+        self.context_cache.discard(model, prefix, cached)
+        return True
+
+    def _generate(self, model: str, contents: Any, config: Any, timeout: Optional[float], cache_prefix: int = 0) -> Tuple[str, Usage]:
+        cached = self.context_cache.lookup(model, contents[:cache_prefix]) if cache_prefix else None
+        request_model, request_contents, request_config = self._request(cached, model, contents, config, timeout, cache_prefix)
+        try:
+            response = self.client.models.generate_content(model=request_model, contents=request_contents, config=request_config)
+        except Exception as e:
+            if not self._cache_rejected(e, cached, model, contents[:cache_prefix]):
+                raise
+            return self._generate(model, contents, config, timeout)
+        return response.text, _gemini_usage(response)
+
+    async def _generate_async(self, model: str, contents: Any, config: Any, timeout: Optional[float], cache_prefix: int = 0) -> Tuple[str, Usage]:
+        cached = await self.context_cache.lookup_async(model, contents[:cache_prefix]) if cache_prefix else None
+        request_model, request_contents, request_config = self._request(cached, model, contents, config, timeout, cache_prefix)
+        try:
+            response = await self.aio().models.generate_content(model=request_model, contents=request_contents, config=request_config)
+        except Exception as e:
+            if not self._cache_rejected(e, cached, model, contents[:cache_prefix]):
+                raise
+            return await self._generate_async(model, contents, config, timeout)
+        return response.text, _gemini_usage(response)
+
+    async def aclose(self):
+        with self._loop_lock:
+            loop_clients = self._loop_clients.pop(asyncio.get_running_loop(), None)
+        if loop_clients is None:
+            return
+        loop_client, loop_http_client = loop_clients
+        del loop_clients
+        await loop_http_client.aclose()
+        # A dropped genai client schedules its own close on the running loop; let it run before the loop closes
+        del loop_client
+        await asyncio.sleep(0)
+
+    def close(self):
+        self.context_cache.close()
+
+
+class OpenAIProvider(LLMProvider):
+    """OpenAI-compatible chat completions: contents are chat messages and config the request's keyword arguments.
+
+    Also serves Gemini through its OpenAI-compatible endpoint (GEMINI_OPENAI_BASE_URL).
+    The SDK's own retries are turned off so that retries follow the RetryPolicy.
+    """
+
+    name = "openai"
+
+    def __init__(self, api_key: Optional[str] = None, base_url: Optional[str] = None, client: Any = None, retry: Optional[RetryPolicy] = None):
+        import openai
+
+        super().__init__(retry)
+        if client is None:
+            client = openai.OpenAI(api_key=api_key, base_url=base_url, http_client=http_client(), max_retries=0)
+        self.client = client
+        self.timeout_errors = TIMEOUT_ERRORS + (openai.APITimeoutError,)
+        self._server_errors = (openai.InternalServerError, openai.APIConnectionError, httpx.TransportError)
+
+    def is_server_error(self, error: Exception) -> bool:
+        return isinstance(error, self._server_errors) or (getattr(error, "status_code", None) or 0) >= 500
+
+    def _generate(self, model: str, contents: Any, config: Any, timeout: Optional[float], cache_prefix: int = 0) -> Tuple[str, Usage]:
+        # OpenAI caches long prompt prefixes on its own, so cache_prefix needs nothing here
+        response = self.client.chat.completions.create(model=model, messages=contents, timeout=timeout, **(config or {}))
+        usage = getattr(response, "usage", None)
+        return response.choices[0].message.content, Usage(
+            getattr(usage, "prompt_tokens", None),
+            getattr(usage, "completion_tokens", None),
+            getattr(usage, "total_tokens", None),
+            getattr(getattr(usage, "prompt_tokens_details", None), "cached_tokens", None),
+        )
+
+
+# Providers of the genai clients passed to gemini_provider, so their context caches last as long as the client
+_wrapped_clients: "weakref.WeakKeyDictionary[Any, GeminiProvider]" = weakref.WeakKeyDictionary()
+_wrapped_lock = threading.Lock()
+
+
+def gemini_provider(client: Any) -> LLMProvider:
+    """client as a provider: providers are returned as they are, genai clients are wrapped."""
+    if isinstance(client, LLMProvider):
+        return client
+    with _wrapped_lock:
+        if client not in _wrapped_clients:
+            _wrapped_clients[client] = GeminiProvider(client=client)
+        return _wrapped_clients[client]
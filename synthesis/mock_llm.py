@@ -0,0 +1,367 @@
+import asyncio
+import glob
+import hashlib
+import json
+import os
+import random
+import re
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from google.genai import errors as genai_errors
+from pddl_domain import domain_index
+from rate_limiter import estimate_tokens
+from response_cache import ResponseCache
+
+base_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+
+# Outcomes a mock call can have besides a normal response
+MOCK_ERRORS = ("server_error", "rate_limit", "malformed")
+CANNED_FILES = ("objects.json", "domain.pddl", "config.json")
+BASELINE_ANSWER = "<answer>mock</answer>"
+
+CELL_LABEL_RE = re.compile(r"^Cell (\d+):$")
+LIST_RE = {
+    "cell_types": re.compile(r"List of cell types in the domain: (\[.*?\])"),
+    "objects": re.compile(r"List of objects in the domain: (\[.*?\])"),
+}
+
+
+def parse_latency(spec: str) -> Callable[[random.Random], float]:
+    """A latency distribution from a spec: '0.5' (fixed seconds), 'uniform:LOW:HIGH',
+    'normal:MEAN:STD' or 'lognormal:MEDIAN:SIGMA'. Samples are never negative.
+    """
+    name, _, args = spec.partition(":")
+    try:
+        if not args:
+            seconds = float(name)
+            return lambda rng: seconds
+        a, b = (float(x) for x in args.split(":"))
+    except ValueError:
+        raise ValueError(f"Invalid latency spec: {spec!r}. Expected SECONDS, uniform:LOW:HIGH, normal:MEAN:STD or lognormal:MEDIAN:SIGMA.")
+    if name == "uniform":
+        return lambda rng: rng.uniform(a, b)
+    if name == "normal":
+        return lambda rng: max(0.0, rng.gauss(a, b))
+    if name == "lognormal":
+        return lambda rng: rng.lognormvariate(0.0, b) * a
+    raise ValueError(f"Unknown latency distribution: {name!r}.")
+
+
+def canned_response_dir(domain_name: Optional[str] = None, problem_name: Optional[str] = None) -> str:
+    """The synthesized problem under temp/ whose files serve as canned responses: the
+    problem itself if it was synthesized, else one of its domain, else any other.
+    """
+    candidates = []
+    if domain_name is not None:
+        if problem_name is not None:
+            candidates.append(f"{base_dir}/temp/{domain_name}/{problem_name}")
+        candidates.append(f"{base_dir}/temp/{domain_name}")
+        candidates.extend(sorted(glob.glob(f"{base_dir}/temp/{domain_name}/*/")))
+    candidates.extend(sorted(glob.glob(f"{base_dir}/temp/*/*/")))
+    for candidate in candidates:
+        if all(os.path.exists(os.path.join(candidate, f)) for f in CANNED_FILES):
+            return candidate.rstrip("/")
+    raise FileNotFoundError(f"No synthesized problem with {', '.join(CANNED_FILES)} found under {base_dir}/temp for canned responses.")
+
+
+def _prompt_text(contents: Any) -> str:
+    if isinstance(contents, str):
+        return contents
+    if isinstance(contents, list) and contents:
+        first = contents[0]
+        if isinstance(first, str):
+            return first
+        # OpenAI chat messages: the text parts of the first message
+        if isinstance(first, dict) and isinstance(first.get("content"), list):
+            return "\n".join(part.get("text", "") for part in first["content"] if isinstance(part, dict))
+    return ""
+
+
+def _image_digest(part: Any) -> int:
+    inline_data = getattr(part, "inline_data", None)
+    data = inline_data.data if inline_data is not None else repr(part).encode("utf-8")
+    return int(hashlib.md5(data).hexdigest(), 16)
+
+
+class MockBackend:
+    """A local stand-in for the Gemini and OpenAI APIs.
+
+    Responses are recorded ones from a response cache (see response_cache.py) when
+    recorded_path is given and has the request, and otherwise canned: the objects,
+    domain and config of a synthesized problem under temp/, cell classifications picked
+    from the prompt's lists by image hash, and a fixed answer for baseline prompts.
+
+    Every call first waits a latency drawn from the latency spec (see parse_latency),
+    then fails with a 5xx or a 429, or returns a truncated (malformed) response, at the
+    given rates. Calls and outcomes are counted in stats.
+    """
+
+    def __init__(
+        self,
+        canned_dir: Optional[str] = None,
+        recorded_path: Optional[str] = None,
+        latency: str = "0",
+        server_error_rate: float = 0.0,
+        rate_limit_rate: float = 0.0,
+        malformed_rate: float = 0.0,
+        seed: int = 0,
+    ):
+        self.canned_dir = canned_dir or canned_response_dir()
+        self.recorded = ResponseCache("record", recorded_path) if recorded_path else None
+        self.sample_latency = parse_latency(latency)
+        self.error_rates = {"server_error": server_error_rate, "rate_limit": rate_limit_rate, "malformed": malformed_rate}
+        self.stats: Dict[str, float] = {"calls": 0, "ok": 0, "recorded": 0, "latency_seconds": 0.0, **{error: 0 for error in MOCK_ERRORS}}
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        with open(f"{self.canned_dir}/objects.json", "r") as f:
+            self._objects = json.load(f)
+        self._objects.pop("obj_str", None)
+        with open(f"{self.canned_dir}/domain.pddl", "r") as f:
+            self._domain = f.read()
+        with open(f"{self.canned_dir}/config.json", "r") as f:
+            self._config = json.load(f)
+
+    def snapshot(self) -> Dict[str, float]:
+        with self._lock:
+            return dict(self.stats)
+
+    def _draw(self) -> Tuple[float, Optional[str]]:
+        """The latency and outcome (None for a normal response) of the next call."""
+        with self._lock:
+            latency = self.sample_latency(self._rng)
+            roll = self._rng.random()
+            outcome = None
+            for error in MOCK_ERRORS:
+                if roll < self.error_rates[error]:
+                    outcome = error
+                    break
+                roll -= self.error_rates[error]
+            self.stats["calls"] += 1
+            self.stats["latency_seconds"] += latency
+            self.stats[outcome or "ok"] += 1
+        return latency, outcome
+
+    def response_text(self, model: str, contents: Any, config: Any) -> str:
+        if self.recorded is not None:
+            recorded = self.recorded.get(self.recorded.entry_key(model, contents, config))
+            if recorded is not None:
+                with self._lock:
+                    self.stats["recorded"] += 1
+                return recorded[0]
+        return self.canned_text(contents)
+
+    def canned_text(self, contents: Any) -> str:
+        prompt = _prompt_text(contents)
+        if "Please count the number of actions" in prompt:
+            actions = list(domain_index(self._domain).actions)
+            return json.dumps({"action_name": actions, "action_count": len(actions)})
+        if "Please generate a PDDL domain file" in prompt:
+            return self._domain
+        if "synthesize a json configuration file" in prompt:
+            return json.dumps(self._config)
+        if "output a dictionary of physical objects" in prompt:
+            return json.dumps(self._objects)
+        if "classify the type of the cell" in prompt:
+            choices = self._prompt_list(prompt, "cell_types", self._objects["background_cells"])
+            return self._cell_responses(contents, lambda h: {"cell_type": choices[h % len(choices)]})
+        if "describing the object in the cell" in prompt:
+            choices = self._prompt_list(prompt, "objects", self._objects["unique_objects"] + self._objects["generic_objects"])
+
+            def _objects(h: int) -> Dict[str, Any]:
+                name = choices[h % len(choices)]
+                return {"object_name": [name], "object_pddl_str": f"(= (yloc {name}) $i) \n(= (xloc {name}) $j)\n"}
+            return self._cell_responses(contents, _objects)
+        return BASELINE_ANSWER
+
+    @staticmethod
+    def _prompt_list(prompt: str, kind: str, default: List[str]) -> List[str]:
+        match = LIST_RE[kind].search(prompt)
+        if match:
+            try:
+                return json.loads(match.group(1).replace("'", '"')) or default
+            except ValueError:
+                pass
+        return default
+
+    @staticmethod
+    def _cell_responses(contents: List[Any], respond: Callable[[int], Dict[str, Any]]) -> str:
+        """One cell's response, or a JSON array keyed by cell_id for a batch of labeled cells."""
+        if len(contents) == 2:
+            return json.dumps(respond(_image_digest(contents[1])))
+        entries = []
+        for n in range(1, len(contents) - 1, 2):
+            label = CELL_LABEL_RE.match(contents[n]) if isinstance(contents[n], str) else None
+            if label:
+                entries.append({"cell_id": int(label.group(1)), **respond(_image_digest(contents[n + 1]))})
+        return json.dumps(entries)
+
+    def call(self, model: str, contents: Any, config: Any, raise_error: Callable[[str], None]) -> Tuple[str, int]:
+        latency, outcome = self._draw()
+        time.sleep(latency)
+        return self._respond(model, contents, config, outcome, raise_error)
+
+    async def call_async(self, model: str, contents: Any, config: Any, raise_error: Callable[[str], None]) -> Tuple[str, int]:
+        latency, outcome = self._draw()
+        await asyncio.sleep(latency)
+        return self._respond(model, contents, config, outcome, raise_error)
+
+    def _respond(self, model: str, contents: Any, config: Any, outcome: Optional[str], raise_error: Callable[[str], None]) -> Tuple[str, int]:
+        if outcome in ("server_error", "rate_limit"):
+            raise_error(outcome)
+        text = self.response_text(model, contents, config)
+        if outcome == "malformed":
+            text = text[:len(text) // 2]
+        return text, estimate_tokens(contents) + estimate_tokens(text)
+
+
+class _Usage:
+    __slots__ = ("total_token_count", "total_tokens", "cached_content_token_count")
+
+    def __init__(self, tokens: int, cached_tokens: Optional[int] = None):
+        self.total_token_count = tokens
+        self.total_tokens = tokens
+        self.cached_content_token_count = cached_tokens
+
+
+class MockGeminiResponse:
+    __slots__ = ("text", "usage_metadata")
+
+    def __init__(self, text: str, tokens: int, cached_tokens: Optional[int] = None):
+        self.text = text
+        self.usage_metadata = _Usage(tokens, cached_tokens)
+
+
+def _raise_gemini_error(outcome: str):
+    if outcome == "rate_limit":
+        raise genai_errors.ClientError(429, {"error": {"code": 429, "message": "Mock quota exceeded.", "status": "RESOURCE_EXHAUSTED"}})
+    raise genai_errors.ServerError(503, {"error": {"code": 503, "message": "Mock model overloaded.", "status": "UNAVAILABLE"}})
+
+
+class _MockCachedContent:
+    __slots__ = ("name", "model", "contents")
+
+    def __init__(self, name: str, model: str, contents: List[Any]):
+        self.name = name
+        self.model = model
+        self.contents = contents
+
+
+class _MockGeminiCaches:
+    """client.caches: cached contents are kept in memory and prepended to the requests that reference them."""
+
+    def __init__(self):
+        self._cached: Dict[str, _MockCachedContent] = {}
+        self._created = 0
+        self._lock = threading.Lock()
+
+    def create(self, model: str, config: Any = None) -> _MockCachedContent:
+        with self._lock:
+            self._created += 1
+            cached = _MockCachedContent(f"cachedContents/mock-{self._created}", model, list(config.contents))
+            self._cached[cached.name] = cached
+        return cached
+
+    def delete(self, name: str, config: Any = None):
+        with self._lock:
+            self._cached.pop(name, None)
+
+    def resolve(self, contents: Any, config: Any) -> Tuple[Any, Optional[int]]:
+        """The full contents of a request and its cached tokens, or a 404 for an unknown cached content."""
+        name = getattr(config, "cached_content", None)
+        if name is None:
+            return contents, None
+        with self._lock:
+            cached = self._cached.get(name)
+        if cached is None:
+            raise genai_errors.ClientError(404, {"error": {"code": 404, "message": f"Mock cached content {name} not found.", "status": "NOT_FOUND"}})
+        return cached.contents + list(contents), estimate_tokens(cached.contents)
+
+
+class _MockGeminiModels:
+    def __init__(self, backend: MockBackend, caches: _MockGeminiCaches):
+        self._backend = backend
+        self._caches = caches
+
+    def generate_content(self, model: str, contents: Any, config: Any = None) -> MockGeminiResponse:
+        contents, cached_tokens = self._caches.resolve(contents, config)
+        return MockGeminiResponse(*self._backend.call(model, contents, config, _raise_gemini_error), cached_tokens)
+
+
+class _MockGeminiAsyncModels:
+    def __init__(self, backend: MockBackend, caches: _MockGeminiCaches):
+        self._backend = backend
+        self._caches = caches
+
+    async def generate_content(self, model: str, contents: Any, config: Any = None) -> MockGeminiResponse:
+        contents, cached_tokens = self._caches.resolve(contents, config)
+        return MockGeminiResponse(*await self._backend.call_async(model, contents, config, _raise_gemini_error), cached_tokens)
+
+
+class _MockGeminiAio:
+    def __init__(self, backend: MockBackend, caches: _MockGeminiCaches):
+        self.models = _MockGeminiAsyncModels(backend, caches)
+
+
+class MockGeminiClient:
+    """Stands in for genai.Client: client.models.generate_content, client.aio.models.generate_content
+    and client.caches (create and delete)."""
+
+    def __init__(self, backend: MockBackend):
+        self.backend = backend
+        self.caches = _MockGeminiCaches()
+        self.models = _MockGeminiModels(backend, self.caches)
+        self.aio = _MockGeminiAio(backend, self.caches)
+
+
+class _Message:
+    __slots__ = ("content",)
+
+    def __init__(self, content: str):
+        self.content = content
+
+
+class _Choice:
+    __slots__ = ("message",)
+
+    def __init__(self, content: str):
+        self.message = _Message(content)
+
+
+class MockChatCompletion:
+    __slots__ = ("choices", "usage")
+
+    def __init__(self, text: str, tokens: int):
+        self.choices = [_Choice(text)]
+        self.usage = _Usage(tokens)
+
+
+def _raise_openai_error(outcome: str):
+    import httpx
+    import openai
+
+    status = 429 if outcome == "rate_limit" else 503
+    response = httpx.Response(status, request=httpx.Request("POST", "http://mock/v1/chat/completions"))
+    error_class = openai.RateLimitError if status == 429 else openai.InternalServerError
+    raise error_class(f"Mock error {status}.", response=response, body=None)
+
+
+class _MockCompletions:
+    def __init__(self, backend: MockBackend):
+        self._backend = backend
+
+    def create(self, model: str, messages: List[Dict[str, Any]], **kwargs) -> MockChatCompletion:
+        return MockChatCompletion(*self._backend.call(model, messages, kwargs, _raise_openai_error))
+
+
+class _MockChat:
+    def __init__(self, backend: MockBackend):
+        self.completions = _MockCompletions(backend)
+
+
+class MockOpenAIClient:
+    """Stands in for openai.OpenAI: client.chat.completions.create."""
+
+    def __init__(self, backend: MockBackend):
+        self.backend = backend
+        self.chat = _MockChat(backend)
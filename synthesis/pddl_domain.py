@@ -0,0 +1,117 @@
+import hashlib
+from collections import OrderedDict
+from typing import Dict, List, Optional, Sequence, Tuple
+from pddl_problem import Term, parse_sexprs
+
+# Domains indexed by the hash of their text; synthesis only ever holds a few at a time
+MAX_CACHED_DOMAINS = 32
+
+
+def _typed_list(terms: Sequence[Term], default_type: str = "object") -> List[Tuple[Term, str]]:
+    """Pair the items of a PDDL typed list such as '?a - agent ?o ?p - object' with their types.
+
+    Items without a type get default_type; an (either t1 t2) type is kept as its first type.
+    """
+    typed, items = [], []
+    n = 0
+    while n < len(terms):
+        if terms[n] == "-" and n + 1 < len(terms):
+            item_type = terms[n + 1]
+            if not isinstance(item_type, str):
+                item_type = item_type[1] if len(item_type) > 1 else default_type
+            typed.extend((item, item_type) for item in items)
+            items = []
+            n += 2
+        else:
+            items.append(terms[n])
+            n += 1
+    typed.extend((item, default_type) for item in items)
+    return typed
+
+
+class Signature:
+    """The name and typed parameters of a predicate, function or action, and a function's value type."""
+
+    __slots__ = ("name", "parameters", "type")
+
+    def __init__(self, name: str, parameters: List[Tuple[str, str]], value_type: Optional[str] = None):
+        self.name = name
+        self.parameters = parameters
+        self.type = value_type
+
+    @property
+    def arity(self) -> int:
+        return len(self.parameters)
+
+    def __str__(self) -> str:
+        return "(" + " ".join([self.name] + [f"{var} - {var_type}" for var, var_type in self.parameters]) + ")"
+
+    def __repr__(self) -> str:
+        return f"Signature({self})" if self.type is None else f"Signature({self} - {self.type})"
+
+
+class DomainIndex:
+    """What a domain.pddl declares: types with their parent types, typed constants,
+    predicate and function signatures, and action parameters, in declaration order.
+    """
+
+    __slots__ = ("name", "requirements", "types", "constants", "predicates", "functions", "actions")
+
+    def __init__(self, domain_pddl: str):
+        self.name: Optional[str] = None
+        self.requirements: List[str] = []
+        self.types: Dict[str, str] = {}
+        self.constants: Dict[str, str] = {}
+        self.predicates: Dict[str, Signature] = {}
+        self.functions: Dict[str, Signature] = {}
+        self.actions: Dict[str, Signature] = {}
+
+        define = next((term for term in parse_sexprs(domain_pddl) if isinstance(term, tuple) and term and term[0] == "define"), None)
+        if define is None:
+            raise ValueError("No (define (domain ...) ...) block found in domain PDDL.")
+        for section in define[1:]:
+            if isinstance(section, str) or not section:
+                continue
+            keyword, body = section[0], section[1:]
+            if keyword == "domain" and body:
+                self.name = body[0]
+            elif keyword == ":requirements":
+                self.requirements = [req for req in body if isinstance(req, str)]
+            elif keyword == ":types":
+                self.types.update(_typed_list(body))
+            elif keyword == ":constants":
+                self.constants.update(_typed_list(body))
+            elif keyword == ":predicates":
+                for predicate in body:
+                    if isinstance(predicate, tuple) and predicate:
+                        self.predicates[predicate[0]] = Signature(predicate[0], _typed_list(predicate[1:]))
+            elif keyword == ":functions":
+                # Functions without a '- type' are numeric
+                for function, value_type in _typed_list(body, default_type="number"):
+                    if isinstance(function, tuple) and function:
+                        self.functions[function[0]] = Signature(function[0], _typed_list(function[1:]), value_type)
+            elif keyword == ":action" and body and isinstance(body[0], str):
+                parameters = ()
+                if ":parameters" in body:
+                    parameters = body[body.index(":parameters") + 1]
+                self.actions[body[0]] = Signature(body[0], _typed_list(parameters if isinstance(parameters, tuple) else ()))
+
+    def declares(self, name: str) -> bool:
+        """Whether name is a type, constant, predicate, function or action of the domain."""
+        return any(name in names for names in (self.types, self.constants, self.predicates, self.functions, self.actions))
+
+
+_domain_indexes: "OrderedDict[str, DomainIndex]" = OrderedDict()
+
+
+def domain_index(domain_pddl: str) -> DomainIndex:
+    """The DomainIndex of a domain.pddl text, parsed once per distinct content."""
+    key = hashlib.sha256(domain_pddl.encode("utf-8")).hexdigest()
+    if key in _domain_indexes:
+        _domain_indexes.move_to_end(key)
+        return _domain_indexes[key]
+    index = DomainIndex(domain_pddl)
+    _domain_indexes[key] = index
+    if len(_domain_indexes) > MAX_CACHED_DOMAINS:
+        _domain_indexes.popitem(last=False)
+    return index
@@ -0,0 +1,206 @@
+import functools
+import re
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple, Union
+from telemetry import record_parse_failure
+
+# An atom is a string; a compound term or fact is a tuple of terms, e.g. ("=", ("xloc", "student"), "3")
+Term = Union[str, Tuple["Term", ...]]
+Fact = Tuple[Term, ...]
+
+TOKEN_RE = re.compile(r"[()]|[^\s()]+")
+ATOM_RE = re.compile(r"[^\s()]+")
+GOAL_STR = "(:goal (true))"
+# Frames of a GIF repeat most of their facts, so serialized facts and instantiated cell
+# templates are kept until this many have been collected
+MAX_CACHED_FACTS = 1 << 18
+# Distinct object_pddl_str templates kept; a problem has one per classified cell with objects
+MAX_CACHED_TEMPLATES = 1024
+
+
+def tokenize(text: str) -> Iterator[str]:
+    """Yield the parentheses and atoms of PDDL text, skipping ; comments."""
+    for line in text.split("\n"):
+        yield from TOKEN_RE.findall(line.split(";", 1)[0])
+
+
+def parse_sexprs(text: str) -> List[Term]:
+    """Read the top-level S-expressions of a PDDL fragment into nested tuples."""
+    stack: List[List[Term]] = [[]]
+    for token in tokenize(text):
+        if token == "(":
+            stack.append([])
+        elif token == ")":
+            if len(stack) == 1:
+                raise ValueError(f"Unbalanced ')' in PDDL: {text!r}")
+            term = tuple(stack.pop())
+            stack[-1].append(term)
+        else:
+            stack[-1].append(token)
+    if len(stack) != 1:
+        raise ValueError(f"Unbalanced '(' in PDDL: {text!r}")
+    return stack[0]
+
+
+def serialize_term(term: Term) -> str:
+    if isinstance(term, str):
+        return term
+    parts = []
+    for sub in term:
+        if isinstance(sub, str):
+            parts.append(sub)
+        else:
+            # Most subterms are flat, e.g. (xloc student), and join in one call
+            try:
+                parts.append("(" + " ".join(sub) + ")")
+            except TypeError:
+                parts.append(serialize_term(sub))
+    return "(" + " ".join(parts) + ")"
+
+
+_serialized_facts: Dict[Fact, str] = {}
+
+
+def serialize_fact(fact: Fact) -> str:
+    """serialize_term for init facts, reusing the strings of facts seen in earlier frames."""
+    fact_str = _serialized_facts.get(fact)
+    if fact_str is None:
+        if len(_serialized_facts) >= MAX_CACHED_FACTS:
+            _serialized_facts.clear()
+        fact_str = _serialized_facts[fact] = serialize_term(fact)
+    return fact_str
+
+
+def _substitute(term: Fact, values: Dict[str, str]) -> Fact:
+    return tuple([values.get(sub, sub) if isinstance(sub, str) else _substitute(sub, values) for sub in term])
+
+
+def object_base_name(name: str) -> str:
+    """parkinglot12 -> parkinglot."""
+    return name.rstrip("0123456789")
+
+
+def _object_sort_key(name: str) -> Tuple[str, int, str]:
+    base = object_base_name(name)
+    suffix = name[len(base):]
+    return base, int(suffix) if suffix else -1, name
+
+
+def group_objects(names: Iterable[str]) -> Dict[str, List[str]]:
+    """Group numbered object names by their exact base name, each group in numeric order."""
+    objects: Dict[str, List[str]] = {}
+    for name in sorted(set(names), key=_object_sort_key):
+        objects.setdefault(object_base_name(name), []).append(name)
+    return objects
+
+
+def serialize_objects(objects: Dict[str, List[str]]) -> str:
+    """The (:objects ...) block of typed object groups, types in sorted order."""
+    lines = ["(:objects"]
+    for object_type in sorted(objects):
+        lines.append(f"{' '.join(objects[object_type])} - {object_type}")
+    lines.append(")")
+    return "\n".join(lines)
+
+
+def parse_objects(objects_str: str) -> Dict[str, List[str]]:
+    """Read an (:objects ...) block back into typed object groups; untyped names get type object."""
+    objects: Dict[str, List[str]] = {}
+    for block in parse_sexprs(objects_str):
+        if isinstance(block, str) or not block or block[0] != ":objects":
+            raise ValueError(f"Expected an (:objects ...) block, got: {objects_str!r}")
+        names: List[str] = []
+        tokens = iter(block[1:])
+        for token in tokens:
+            if token == "-":
+                objects.setdefault(next(tokens), []).extend(names)
+                names = []
+            else:
+                names.append(token)
+        if names:
+            objects.setdefault("object", []).extend(names)
+    return objects
+
+
+class CellTemplate:
+    """The object facts of a classified cell, parsed once from its object_pddl_str.
+
+    The $i and $j slots take the cell's 1-based row and column, and object names can be
+    renamed token by token, e.g. a generic parkinglot to the numbered parkinglot2.
+
+    An object_pddl_str that does not parse (e.g. unbalanced parentheses in the model's
+    answer) is kept as raw text: it is written out as a single fact, with its slots and
+    object names substituted in the text.
+    """
+
+    __slots__ = ("facts", "raw", "_instances")
+
+    def __init__(self, object_pddl_str: str):
+        self.raw: Optional[str] = None
+        try:
+            self.facts: Tuple[Fact, ...] = tuple(parse_sexprs(object_pddl_str))
+        except ValueError as e:
+            print(f"Warning: {e}; writing the cell's object facts as they are.")
+            record_parse_failure("object_pddl_str", str(e))
+            self.facts = ()
+            self.raw = object_pddl_str
+        self._instances: Dict[tuple, Tuple[Fact, ...]] = {}
+
+    def instantiate(self, row: int, col: int, renames: Optional[Dict[str, str]] = None) -> Tuple[Fact, ...]:
+        key = (row, col, tuple(renames.items())) if renames else (row, col)
+        facts = self._instances.get(key)
+        if facts is None:
+            values = {"$i": str(row + 1), "$j": str(col + 1)}
+            if renames:
+                values.update(renames)
+            if len(self._instances) >= MAX_CACHED_FACTS:
+                self._instances.clear()
+            if self.raw is not None:
+                facts = (ATOM_RE.sub(lambda m: values.get(m.group(0), m.group(0)), self.raw),)
+            else:
+                facts = tuple(_substitute(fact, values) for fact in self.facts)
+            self._instances[key] = facts
+        return facts
+
+
+@functools.lru_cache(maxsize=MAX_CACHED_TEMPLATES)
+def cell_template(object_pddl_str: str) -> CellTemplate:
+    return CellTemplate(object_pddl_str)
+
+
+def problem_str(problem_header: str, objects_str: str, init_strs: Iterable[str]) -> str:
+    """Assemble a problem file from its header, (:objects ...) block and serialized init facts."""
+    parts = [problem_header]
+    if objects_str:
+        parts.append(objects_str)
+    parts.append("(:init")
+    parts.extend(init_strs)
+    parts.append(")")
+    parts.append(GOAL_STR)
+    parts.append(")")
+    return "\n".join(parts)
+
+
+class PDDLProblem:
+    """A frame problem: typed objects (None for no (:objects ...) block) and init facts."""
+
+    __slots__ = ("name", "domain", "objects", "init")
+
+    def __init__(self, name: str, domain: str, objects: Optional[Dict[str, List[str]]] = None, init: Optional[List[Fact]] = None):
+        self.name = name
+        self.domain = domain
+        self.objects = objects
+        self.init: List[Fact] = init if init is not None else []
+
+    @property
+    def header(self) -> str:
+        return f"(define (problem {self.name})\n (:domain {self.domain})"
+
+    @property
+    def objects_str(self) -> str:
+        return "" if self.objects is None else serialize_objects(self.objects)
+
+    def init_strs(self) -> List[str]:
+        return [serialize_fact(fact) for fact in self.init]
+
+    def serialize(self) -> str:
+        return problem_str(self.header, self.objects_str, self.init_strs())
@@ -0,0 +1,92 @@
+import json
+import os
+from typing import Any, Callable, Dict, Iterable, Optional
+from call_budget import CallBudget
+from pddl_domain import DomainIndex, domain_index
+
+base_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+
+PROBLEM_FILES = ("objects", "domain", "config")
+
+
+class ProblemContext:
+    """The files of one problem, read once and shared by the synthesis stages.
+
+    The stimulus description, prompt templates, objects.json, domain.pddl and config.json
+    are read on first use and kept. Values derived from them, such as the rendered cell
+    and object prompts, are built once with memo() and dropped when a file they depend on
+    is invalidated. A stage that rewrites objects.json, domain.pddl or config.json must
+    call invalidate() with that file's name so later stages see the new content.
+
+    budget, if given, bounds the time, model calls and tokens of all stages together
+    (see call_budget.py); every model call of the problem is made against it.
+    """
+
+    def __init__(self, destination_folder: str, domain_name: str, problem_name: str, budget: Optional[CallBudget] = None):
+        self.destination_folder = destination_folder
+        self.domain_name = domain_name
+        self.problem_name = problem_name
+        self.budget = budget
+        self.problem_dir = f"{base_dir}/{destination_folder}/{domain_name}/{problem_name}"
+        self.description_path = f"{base_dir}/dataset/stimuli/{domain_name}/{problem_name}/{problem_name}.txt"
+        self.gif_path = f"{base_dir}/dataset/stimuli/{domain_name}/{problem_name}/{problem_name}.gif"
+        self.objects_path = f"{self.problem_dir}/objects.json"
+        self.domain_path = f"{self.problem_dir}/domain.pddl"
+        self.config_path = f"{self.problem_dir}/config.json"
+        self._cache: Dict[str, Any] = {}
+        self._dependencies: Dict[str, Iterable[str]] = {}
+
+    def _read(self, key: str, path: str) -> str:
+        if key not in self._cache:
+            with open(path, "r") as f:
+                self._cache[key] = f.read()
+        return self._cache[key]
+
+    @property
+    def description(self) -> str:
+        return self._read("description", self.description_path)
+
+    def prompt_template(self, filename: str) -> str:
+        return self._read(f"prompt:{filename}", f"{base_dir}/synthesis/prompts/{filename}")
+
+    @property
+    def objects_json(self) -> str:
+        return self._read("objects", self.objects_path)
+
+    @property
+    def objects(self) -> Dict[str, Any]:
+        """objects.json parsed into a new dict, safe to modify before writing it back."""
+        return json.loads(self.objects_json)
+
+    @property
+    def domain_pddl(self) -> str:
+        return self._read("domain", self.domain_path)
+
+    @property
+    def domain_index(self) -> DomainIndex:
+        """The parsed declarations of domain.pddl (see pddl_domain.py)."""
+        return self.memo("domain_index", ("domain",), lambda: domain_index(self.domain_pddl))
+
+    @property
+    def config(self) -> Dict[str, Any]:
+        """config.json parsed into a new dict, safe to modify before writing it back."""
+        return json.loads(self._read("config", self.config_path))
+
+    def memo(self, key: str, depends_on: Iterable[str], build: Callable[[], Any]) -> Any:
+        """Build a value derived from the problem files once, until one of depends_on is invalidated."""
+        if key not in self._cache:
+            self._cache[key] = build()
+            self._dependencies[key] = tuple(depends_on)
+        return self._cache[key]
+
+    def invalidate(self, *names: str):
+        """Forget the given problem files (all of them if none given) and everything derived from them."""
+        names = names or PROBLEM_FILES
+        for name in names:
+            if name not in PROBLEM_FILES:
+                raise ValueError(f"Unknown problem file: {name}. Expected one of {PROBLEM_FILES}.")
+            self._cache.pop(name, None)
+        for key, depends_on in list(self._dependencies.items()):
+            if any(name in depends_on for name in names):
+                self._cache.pop(key, None)
+                del self._dependencies[key]
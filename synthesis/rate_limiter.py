@@ -0,0 +1,275 @@
+import asyncio
+import contextlib
+import json
+import os
+import re
+import threading
+import time
+from typing import Any, Dict, Optional, Tuple
+
+try:
+    import fcntl
+except ImportError:  # Windows: the limiter still works within one process
+    fcntl = None
+
+base_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+DEFAULT_RATE_LIMIT_DIR = f"{base_dir}/.cache/rate_limits"
+
+# (requests per minute, tokens per minute) of the models the pipelines call
+MODEL_RATE_LIMITS: Dict[str, Tuple[int, int]] = {
+    "gemini-2.0-flash": (2000, 4_000_000),
+    "gemini-2.0-flash-001": (2000, 4_000_000),
+    "gpt-4o-2024-11-20": (500, 30_000),
+    "o3-2025-04-16": (500, 30_000),
+}
+DEFAULT_RATE_LIMIT = (60, 1_000_000)
+# Calls in flight per model: AIMD starts here and stays within [1, max_concurrency]
+INITIAL_CONCURRENCY = 4
+MAX_CONCURRENCY = 16
+# Backoff after a 429 without a retry delay, doubled on every further 429 until a call succeeds
+INITIAL_BACKOFF_SECONDS = 1.0
+MAX_BACKOFF_SECONDS = 60.0
+# Waiting for a free slot is polled; waiting for the buckets sleeps until they refill
+POLL_SECONDS = 0.05
+# Rough request size before the response reports its usage
+CHARS_PER_TOKEN = 4
+IMAGE_TOKENS = 258
+
+RETRY_DELAY_RE = re.compile(r"retryDelay['\"]?:\s*['\"]?(\d+(?:\.\d+)?)s")
+
+
+def estimate_tokens(contents: Any) -> int:
+    """Rough token count of a request: Gemini contents or OpenAI chat messages."""
+    if isinstance(contents, str):
+        return len(contents) // CHARS_PER_TOKEN + 1
+    if isinstance(contents, dict):
+        if contents.get("type") == "image_url":
+            return IMAGE_TOKENS
+        return sum(estimate_tokens(value) for value in contents.values() if isinstance(value, (str, list, dict)))
+    if isinstance(contents, (list, tuple)):
+        return sum(estimate_tokens(part) for part in contents)
+    text = getattr(contents, "text", None)
+    if isinstance(text, str):
+        return estimate_tokens(text)
+    # Image parts (inline bytes, PIL images)
+    return IMAGE_TOKENS
+
+
+def is_rate_limit_error(error: BaseException) -> bool:
+    """Whether an API error is a 429 (quota or rate limit), for both google-genai and openai errors."""
+    return getattr(error, "code", None) == 429 or getattr(error, "status_code", None) == 429
+
+
+def retry_after_seconds(error: BaseException) -> Optional[float]:
+    """The delay a 429 asks for: a Retry-After header (openai) or a RetryInfo retryDelay (Gemini)."""
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None)
+    if headers is not None:
+        try:
+            return float(headers.get("retry-after"))
+        except (TypeError, ValueError):
+            pass
+    match = RETRY_DELAY_RE.search(str(error))
+    return float(match.group(1)) if match else None
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _bucket_wait(level: float, needed: float, per_minute: int) -> float:
+    """Seconds until a bucket refilling at per_minute holds needed."""
+    return 0.0 if level >= needed else (needed - level) * 60.0 / per_minute
+
+
+class CallSlot:
+    """A call admitted by a RateLimiter; set used_tokens from the response to settle the token estimate."""
+
+    __slots__ = ("estimated_tokens", "used_tokens")
+
+    def __init__(self, estimated_tokens: int):
+        self.estimated_tokens = estimated_tokens
+        self.used_tokens: Optional[int] = None
+
+
+class RateLimiter:
+    """Requests/min and tokens/min budgets and an adaptive concurrency limit for one model.
+
+    The budgets are token buckets refilled continuously up to one minute's worth. A call
+    takes one request and its estimated tokens, and the estimate is settled against the
+    usage the response reports. The number of calls in flight is limited by AIMD: the
+    limit grows by 1/limit per successful call (about one per round of calls) and halves
+    on a 429, after which no call starts until the backoff has passed.
+
+    The state lives in a JSON file under state_dir, locked with flock for every update,
+    so every process and thread calling the same model shares one quota. Calls in flight
+    are counted per pid, and the counts of processes that died are dropped.
+    """
+
+    def __init__(
+        self,
+        model: str,
+        requests_per_minute: int,
+        tokens_per_minute: int,
+        max_concurrency: int = MAX_CONCURRENCY,
+        initial_concurrency: int = INITIAL_CONCURRENCY,
+        state_dir: str = DEFAULT_RATE_LIMIT_DIR,
+    ):
+        os.makedirs(state_dir, exist_ok=True)
+        self.model = model
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.max_concurrency = max_concurrency
+        self.initial_concurrency = min(initial_concurrency, max_concurrency)
+        self.path = os.path.join(state_dir, re.sub(r"[^\w.-]", "_", model) + ".json")
+        self._lock = threading.Lock()
+
+    def _initial_state(self) -> Dict[str, Any]:
+        return {
+            "updated": time.time(),
+            "requests": float(self.requests_per_minute),
+            "tokens": float(self.tokens_per_minute),
+            "limit": float(self.initial_concurrency),
+            "backoff": 0.0,
+            "cooldown_until": 0.0,
+            "in_flight": {},
+        }
+
+    @contextlib.contextmanager
+    def _state(self):
+        """The shared state, refilled to now, written back when the block exits."""
+        with self._lock, open(self.path, "a+") as f:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_EX)
+            f.seek(0)
+            try:
+                state = json.loads(f.read())
+            except ValueError:
+                state = self._initial_state()
+            now = time.time()
+            elapsed = max(0.0, now - state["updated"])
+            state["updated"] = now
+            state["requests"] = min(self.requests_per_minute, state["requests"] + elapsed * self.requests_per_minute / 60.0)
+            state["tokens"] = min(self.tokens_per_minute, state["tokens"] + elapsed * self.tokens_per_minute / 60.0)
+            state["limit"] = min(state["limit"], self.max_concurrency)
+            state["in_flight"] = {pid: n for pid, n in state["in_flight"].items() if _pid_alive(int(pid))}
+            yield state
+            f.seek(0)
+            f.truncate()
+            json.dump(state, f)
+
+    def _try_acquire(self, tokens: int) -> float:
+        """Start a call and return 0, or return how long to wait before trying again."""
+        with self._state() as state:
+            now = state["updated"]
+            if state["cooldown_until"] > now:
+                return state["cooldown_until"] - now
+            if sum(state["in_flight"].values()) >= int(state["limit"]):
+                return POLL_SECONDS
+            wait = max(
+                _bucket_wait(state["requests"], 1, self.requests_per_minute),
+                _bucket_wait(state["tokens"], tokens, self.tokens_per_minute),
+            )
+            if wait > 0:
+                return wait
+            state["requests"] -= 1
+            state["tokens"] -= tokens
+            pid = str(os.getpid())
+            state["in_flight"][pid] = state["in_flight"].get(pid, 0) + 1
+            return 0.0
+
+    def _release(self, slot: CallSlot, outcome: Optional[bool], retry_after: Optional[float] = None):
+        """End a call. outcome is True for a success, False for a 429 and None for any other error."""
+        with self._state() as state:
+            pid = str(os.getpid())
+            if state["in_flight"].get(pid, 0) > 1:
+                state["in_flight"][pid] -= 1
+            else:
+                state["in_flight"].pop(pid, None)
+            if slot.used_tokens is not None:
+                state["tokens"] -= slot.used_tokens - slot.estimated_tokens
+            if outcome:
+                state["limit"] = min(self.max_concurrency, state["limit"] + 1.0 / state["limit"])
+                state["backoff"] = 0.0
+            elif outcome is False:
+                now = state["updated"]
+                # Calls already in flight when the quota ran out fail together; react once per backoff
+                if state["cooldown_until"] <= now:
+                    state["limit"] = max(1.0, state["limit"] / 2)
+                    state["backoff"] = min(MAX_BACKOFF_SECONDS, state["backoff"] * 2 or INITIAL_BACKOFF_SECONDS)
+                    # The delay the server asks for wins over our own backoff
+                    state["cooldown_until"] = now + (state["backoff"] if retry_after is None else retry_after)
+                elif retry_after is not None:
+                    state["cooldown_until"] = max(state["cooldown_until"], now + retry_after)
+
+    def _tokens_for(self, estimated_tokens: int) -> int:
+        # A request larger than the whole budget waits for a full bucket instead of forever
+        return min(estimated_tokens, self.tokens_per_minute)
+
+    @contextlib.contextmanager
+    def slot(self, estimated_tokens: int):
+        """Wait until a call may start, then hold its slot for the with block."""
+        slot = CallSlot(self._tokens_for(estimated_tokens))
+        while True:
+            wait = self._try_acquire(slot.estimated_tokens)
+            if wait == 0:
+                break
+            time.sleep(wait)
+        try:
+            yield slot
+        except BaseException as e:
+            self._release(slot, False if is_rate_limit_error(e) else None, retry_after_seconds(e))
+            raise
+        self._release(slot, True)
+
+    @contextlib.asynccontextmanager
+    async def slot_async(self, estimated_tokens: int):
+        """slot() for coroutines: waiting sleeps on the event loop instead of the thread.
+
+        The locked state file is read and written on a worker thread, so polling for a
+        slot does not block the loop's other calls.
+        """
+        slot = CallSlot(self._tokens_for(estimated_tokens))
+        while True:
+            wait = await asyncio.to_thread(self._try_acquire, slot.estimated_tokens)
+            if wait == 0:
+                break
+            await asyncio.sleep(wait)
+        try:
+            yield slot
+        except BaseException as e:
+            self._release(slot, False if is_rate_limit_error(e) else None, retry_after_seconds(e))
+            raise
+        self._release(slot, True)
+
+    def concurrency_limit(self) -> float:
+        with self._state() as state:
+            return state["limit"]
+
+
+_limiters: Dict[str, RateLimiter] = {}
+_limiters_lock = threading.Lock()
+_rate_limit_dir = DEFAULT_RATE_LIMIT_DIR
+
+
+def configure_rate_limits(state_dir: str = DEFAULT_RATE_LIMIT_DIR):
+    """Keep the limiter state of this process's later calls under state_dir, e.g. to benchmark against a mock quota."""
+    global _rate_limit_dir
+    with _limiters_lock:
+        _rate_limit_dir = state_dir
+        _limiters.clear()
+
+
+def rate_limiter(model: str) -> RateLimiter:
+    """The RateLimiter of a model, with its limits from MODEL_RATE_LIMITS."""
+    with _limiters_lock:
+        if model not in _limiters:
+            requests_per_minute, tokens_per_minute = MODEL_RATE_LIMITS.get(model, DEFAULT_RATE_LIMIT)
+            _limiters[model] = RateLimiter(model, requests_per_minute, tokens_per_minute, state_dir=_rate_limit_dir)
+        return _limiters[model]
@@ -0,0 +1,178 @@
+import base64
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, Optional, Tuple
+
+base_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+DEFAULT_RESPONSE_CACHE_PATH = f"{base_dir}/.cache/llm_responses.sqlite"
+
+# record: answer from the cache, call the model on a miss and store the response
+# replay: answer only from the cache; a miss raises ResponseCacheMiss
+# off: always call the model
+RESPONSE_CACHE_MODES = ("record", "replay", "off")
+
+# (request hash, sample index)
+EntryKey = Tuple[str, int]
+
+
+class ResponseCacheMiss(LookupError):
+    """A request that replay mode has no recorded response for."""
+
+
+def _sha256(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def _image_url_bytes(url: str) -> bytes:
+    """The image bytes of a data: URL, or the URL itself for remote images."""
+    if url.startswith("data:") and "," in url:
+        return base64.b64decode(url.split(",", 1)[1])
+    return url.encode("utf-8")
+
+
+def canonical_contents(contents: Any) -> Any:
+    """Gemini contents or OpenAI chat messages as JSON-able data, with texts normalized and images replaced by their byte hash."""
+    if isinstance(contents, str):
+        return contents.replace("\r\n", "\n").strip()
+    if isinstance(contents, bytes):
+        return {"image_sha256": _sha256(contents)}
+    if isinstance(contents, dict):
+        if contents.get("type") == "image_url":
+            return {"image_sha256": _sha256(_image_url_bytes(contents["image_url"]["url"]))}
+        return {key: canonical_contents(value) for key, value in contents.items()}
+    if isinstance(contents, (list, tuple)):
+        return [canonical_contents(part) for part in contents]
+    inline_data = getattr(contents, "inline_data", None)
+    if inline_data is not None and inline_data.data is not None:
+        return {"image_sha256": _sha256(inline_data.data)}
+    text = getattr(contents, "text", None)
+    if isinstance(text, str):
+        return canonical_contents(text)
+    if hasattr(contents, "tobytes"):  # PIL images
+        return {"image_sha256": _sha256(contents.tobytes())}
+    return repr(contents)
+
+
+def canonical_config(config: Any) -> Dict[str, Any]:
+    """A generation config (GenerateContentConfig or request keyword arguments) without its unset fields.
+
+    Transport settings such as timeouts, and references to cached prompt prefixes (the
+    contents hold the full prompt), do not change the response and are left out.
+    """
+    if config is None:
+        return {}
+    if hasattr(config, "model_dump"):
+        return config.model_dump(exclude_none=True, exclude={"http_options", "cached_content"}, mode="json")
+    return {key: value for key, value in dict(config).items() if value is not None and key != "timeout"}
+
+
+def request_hash(model: str, contents: Any, config: Any) -> str:
+    request = {"model": model, "contents": canonical_contents(contents), "config": canonical_config(config)}
+    return _sha256(json.dumps(request, sort_keys=True, default=str).encode("utf-8"))
+
+
+class ResponseCache:
+    """On-disk cache of model responses keyed by request content, for record and replay runs.
+
+    Entries are keyed by the hash of (model, canonicalized contents, generation config)
+    and a sample index, so a request sampled at temperature 1.0 can have several recorded
+    responses. Without an explicit sample, the n-th identical request of a run gets sample
+    n, so a rerun that asks the same questions in the same order, including regenerations
+    of rejected answers, gets the same answers back.
+    """
+
+    def __init__(self, mode: str = "record", path: str = DEFAULT_RESPONSE_CACHE_PATH):
+        if mode not in RESPONSE_CACHE_MODES:
+            raise ValueError(f"Unknown response cache mode: {mode}. Expected one of {RESPONSE_CACHE_MODES}.")
+        self.mode = mode
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self._samples: Dict[str, int] = {}
+        self._lock = threading.Lock()
+        self._conn = None
+        if mode != "off":
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Shared by the threads of llm_script.py; self._lock serializes its use
+            self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "request_hash TEXT, sample INTEGER, model TEXT, response TEXT, tokens INTEGER, created REAL, "
+                "PRIMARY KEY (request_hash, sample))"
+            )
+            self._conn.commit()
+
+    def entry_key(self, model: str, contents: Any, config: Any, sample: Optional[int] = None) -> Optional[EntryKey]:
+        """The entry of a request, None when the cache is off. sample defaults to the request's occurrence count in this run."""
+        if self.mode == "off":
+            return None
+        key = request_hash(model, contents, config)
+        with self._lock:
+            if sample is None:
+                sample = self._samples.get(key, 0)
+                self._samples[key] = sample + 1
+        return key, sample
+
+    def get(self, entry_key: Optional[EntryKey]) -> Optional[Tuple[str, Optional[int]]]:
+        """The recorded (response text, total tokens) of an entry, None on a miss outside replay mode."""
+        if entry_key is None:
+            return None
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT response, tokens FROM responses WHERE request_hash = ? AND sample = ?", entry_key
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        if row is None and self.mode == "replay":
+            raise ResponseCacheMiss(f"No recorded response for request {entry_key[0][:16]} sample {entry_key[1]} in {self.path}.")
+        return row
+
+    def put(self, entry_key: Optional[EntryKey], model: str, response: str, tokens: Optional[int] = None):
+        if entry_key is None or self.mode != "record":
+            return
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)",
+                (*entry_key, model, response, tokens, time.time()),
+            )
+            self._conn.commit()
+
+    def clear(self, model: Optional[str] = None):
+        if self._conn is None:
+            return
+        with self._lock:
+            if model is None:
+                self._conn.execute("DELETE FROM responses")
+            else:
+                self._conn.execute("DELETE FROM responses WHERE model = ?", (model,))
+            self._conn.commit()
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+
+_response_cache: Optional[ResponseCache] = None
+
+
+def configure_response_cache(mode: str = "off", path: str = DEFAULT_RESPONSE_CACHE_PATH) -> ResponseCache:
+    """Set the response cache every model call of this process goes through."""
+    global _response_cache
+    if _response_cache is not None:
+        _response_cache.close()
+    _response_cache = ResponseCache(mode, path)
+    return _response_cache
+
+
+def response_cache() -> ResponseCache:
+    """The process's response cache; off unless configured otherwise."""
+    if _response_cache is None:
+        configure_response_cache()
+    return _response_cache
@@ -1,8 +1,10 @@
+import asyncio
 import re
-from typing import List, Dict, Any, Optional, Tuple
+from typing import List, Dict, Any, Iterator, Optional, Tuple
 import os
+import glob
 import json
-from PIL import Image, ImageSequence
+from PIL import Image
 import base64
 import numpy as np
 import io
@@ -11,92 +13,240 @@ from google import genai
 from google.genai import types
 from google.genai import errors as genai_errors
 import time
-from utils import call_gemini_with_retry
+import functools
+from concurrent.futures import ProcessPoolExecutor
+from utils import call_gemini_with_retry, call_gemini_with_retry_async
+from telemetry import record_parse_failure
+from llm_providers import gemini_provider
+from cell_fingerprints import CellFingerprintIndex
+from cell_cache import CellClassificationCache, prompt_context_hash
+from frame_store import load_frames
+from grid_detection import check_grid_size
+from cell_grid import CellGrid, FrameStack, OBJECT_STD_THRESHOLD
+from trajectory import TrajectoryWriter, trajectory_paths
+from problem_context import ProblemContext
+from pddl_problem import Term, Fact, CellTemplate, PDDLProblem, cell_template, group_objects, parse_objects, serialize_objects, serialize_term
+
+CELL_RESIZE = 100
+CELL_BORDER = 3
+BIT_MATRIX_ENCODINGS = ("set-index", "literal")
+OUTPUT_FORMATS = ("frames", "trajectory")
+
+
+def _encode_cell_thumbnail(cell_image_pil: Image.Image) -> str:
+    cell_image_pil_resized = cell_image_pil.resize((CELL_RESIZE, CELL_RESIZE)).crop((CELL_BORDER, CELL_BORDER, CELL_RESIZE - CELL_BORDER, CELL_RESIZE - CELL_BORDER))
+    buffer = io.BytesIO()
+    cell_image_pil_resized.save(buffer, format="JPEG")
+    buffer.seek(0)
+    return base64.b64encode(buffer.getvalue()).decode("utf-8")
+
+
+class CellThumbnails:
+    """Frame buffers plus cell geometry; a cell is JPEG/base64 encoded only when a classifier asks for it.
+
+    With a window, only the most recent window frames (and their encoded cells) are kept.
+    """
+
+    def __init__(self, dim: Tuple[int, int], memoize: bool = True, window: Optional[int] = None):
+        self.dim = dim
+        self.memoize = memoize
+        self.window = window
+        self.first_frame_idx = 0
+        self.frames: List[np.ndarray] = []
+        self._encoded: Dict[Tuple[int, int, int], str] = {}
+
+    def __len__(self) -> int:
+        return self.first_frame_idx + len(self.frames)
+
+    def append(self, frame_array: np.ndarray):
+        self.frames.append(frame_array)
+        if self.window is not None and len(self.frames) > self.window:
+            self.frames.pop(0)
+            self._encoded = {key: val for key, val in self._encoded.items() if key[0] > self.first_frame_idx}
+            self.first_frame_idx += 1
+
+    def get(self, frame_idx: int, row: int, col: int) -> str:
+        """Return the base64 JPEG thumbnail of cell (row, col) in frame frame_idx."""
+        key = (frame_idx, row, col)
+        if key in self._encoded:
+            return self._encoded[key]
+
+        frame_array = self.frames[frame_idx - self.first_frame_idx]
+        cell_height = frame_array.shape[0] // self.dim[0]
+        cell_width = frame_array.shape[1] // self.dim[1]
+        cell_array = frame_array[row * cell_height:(row + 1) * cell_height, col * cell_width:(col + 1) * cell_width]
+        cell_base64_str = _encode_cell_thumbnail(Image.fromarray(cell_array))
+
+        if self.memoize:
+            self._encoded[key] = cell_base64_str
+        return cell_base64_str
+
+
+def _cell_blocks(frame_array: np.ndarray, dim: Tuple[int, int]) -> np.ndarray:
+    """View an RGB frame as (rows, cols, cell_h, cell_w, 3) cells with their borders trimmed."""
+    rows, cols = dim
+    height, width = frame_array.shape[:2]
+    cell_height = height // rows
+    cell_width = width // cols
+    border_h = min(int(round(cell_height * CELL_BORDER / CELL_RESIZE)), (cell_height - 1) // 2)
+    border_w = min(int(round(cell_width * CELL_BORDER / CELL_RESIZE)), (cell_width - 1) // 2)
+
+    cells = frame_array[:rows * cell_height, :cols * cell_width].reshape(rows, cell_height, cols, cell_width, 3).swapaxes(1, 2)
+    return cells[:, :, border_h:cell_height - border_h, border_w:cell_width - border_w]
+
+
+def segment_frame_array(frame_array: np.ndarray, dim: Tuple[int, int], cell_mask: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Compute the mean, std and signature of every cell of an RGB frame in a few array operations.
+
+    With a (rows, cols) boolean cell_mask only the selected cells are reduced and the
+    results are flat arrays in row-major order of the mask.
+    """
+    cells = _cell_blocks(frame_array, dim)
+    if cell_mask is not None:
+        cells = cells[cell_mask]
+
+    cell_means = cells.mean(axis=(-3, -2, -1))
+    cell_stds = np.round(cells.std(axis=(-3, -2)).mean(axis=-1), 2)
+    cell_signatures = np.ceil(cell_means).astype(np.int64)
+    return cell_means, cell_stds, cell_signatures
+
+
+def changed_cell_mask(frame_array: np.ndarray, prev_frame_array: np.ndarray, dim: Tuple[int, int]) -> np.ndarray:
+    """Return a (rows, cols) mask of the cells whose pixels differ from the previous frame."""
+    return np.any(_cell_blocks(frame_array, dim) != _cell_blocks(prev_frame_array, dim), axis=(2, 3, 4))
+
+
+def _segment_frame_pil(frame_array: np.ndarray, dim: Tuple[int, int]) -> Tuple[np.ndarray, np.ndarray]:
+    rgb_frame = Image.fromarray(frame_array)
+    width, height = rgb_frame.size
+    cell_width = width // dim[1]
+    cell_height = height // dim[0]
+
+    current_frame_vals_list = []
+    current_frame_stds_list = []
+    for i in range(dim[0]):
+        row_vals = []
+        row_stds = []
+        for j in range(dim[1]):
+            left = j * cell_width
+            upper = i * cell_height
+            right = left + cell_width
+            lower = upper + cell_height
+
+            cell_image_pil = rgb_frame.crop((left, upper, right, lower))
+            cell_image_pil_resized = cell_image_pil.resize((CELL_RESIZE, CELL_RESIZE)).crop((CELL_BORDER, CELL_BORDER, CELL_RESIZE - CELL_BORDER, CELL_RESIZE - CELL_BORDER))
+
+            cell_pixel_array = np.array(cell_image_pil_resized)
+            cell_mean_val = int(np.ceil(cell_pixel_array.mean()))
+            cell_std_dev = round(cell_pixel_array.std(axis=(0,1)).mean(), 2)
+
+            row_vals.append(cell_mean_val)
+            row_stds.append(cell_std_dev)
+
+        current_frame_vals_list.append(row_vals)
+        current_frame_stds_list.append(row_stds)
+
+    return np.array(current_frame_vals_list), np.array(current_frame_stds_list)
+
+
+def _segment_frame_numpy(frame_array: np.ndarray, dim: Tuple[int, int]) -> Tuple[np.ndarray, np.ndarray]:
+    _, cell_stds, cell_signatures = segment_frame_array(frame_array, dim)
+    return cell_signatures, cell_stds
+
+
+SEGMENTATION_ENGINES = {
+    "numpy": _segment_frame_numpy,
+    "pil": _segment_frame_pil,
+}
+# How far the cell statistics of the two engines may differ (see iter_gif_frames_and_cells)
+ENGINE_MEAN_TOLERANCE = 4
+ENGINE_STD_TOLERANCE = 2.5
+
+
+def iter_gif_frames_and_cells(gif_path: str, frame_stack: FrameStack, engine: str = "numpy", delta: bool = False, key_scheme: str = "fingerprint") -> Iterator[Tuple[np.ndarray, CellGrid]]:
+    """Split the GIF frames into frame_stack.dim = (rows, cols) cells one frame at a time.
+
+    Appends the CellGrid of every frame to frame_stack and yields (frame_array, grid).
+    Frames are read from the decoded frame store next to the GIF (see frame_store.py)
+    and only the previous frame is held, so with a windowed frame_stack memory does not
+    grow with the length of the GIF.
+
+    engine="numpy" computes the cell statistics of a whole frame at once, trimming the
+    cell borders by slicing; engine="pil" is the original per-cell crop/resize path.
+    Both find objects in the same cells, but on antialiased tiles the PIL resample can
+    move a cell's ceil(mean) by up to ENGINE_MEAN_TOLERANCE levels and its std by up to
+    ENGINE_STD_TOLERANCE.
+
+    delta=True only re-segments the cells that changed since the previous frame and
+    carries the statistics of the other cells forward; grid.changed_cells lists those
+    cells and is None when the frame was fully segmented.
+
+    key_scheme="fingerprint" keys cells by content-addressed cell fingerprints with
+    near-duplicate tiles merged (see cell_fingerprints.py); key_scheme="mean" keeps the
+    ceil(mean pixel value) keys.
+    """
+    if engine not in SEGMENTATION_ENGINES:
+        raise ValueError(f"Unknown segmentation engine: {engine}. Expected one of {list(SEGMENTATION_ENGINES)}.")
+    if delta and engine != "numpy":
+        raise ValueError("delta segmentation requires the numpy engine.")
+    if key_scheme not in ("fingerprint", "mean"):
+        raise ValueError(f"Unknown key scheme: {key_scheme}. Expected 'fingerprint' or 'mean'.")
+    segment_frame = SEGMENTATION_ENGINES[engine]
+    fingerprint_index = CellFingerprintIndex()
+    mean_keys = set()
+    dim = frame_stack.dim
+    all_cells = [(i, j) for i in range(dim[0]) for j in range(dim[1])]
+
+    prev_frame_array = None
+    prev_grid = None
+    for frame_idx, frame_array in enumerate(load_frames(gif_path)):
+        if delta and prev_grid is not None and prev_frame_array.shape == frame_array.shape:
+            changed_mask = changed_cell_mask(frame_array, prev_frame_array, dim)
+            changed_cells = [tuple(idx) for idx in np.argwhere(changed_mask).tolist()]
+            grid = CellGrid(frame_idx, prev_grid.means.copy(), prev_grid.stds.copy(), prev_grid.ids.copy(), changed_cells)
+            if changed_cells:
+                _, cell_stds, cell_signatures = segment_frame_array(frame_array, dim, changed_mask)
+                mean_keys.update(cell_signatures.tolist())
+                if key_scheme == "fingerprint":
+                    cell_keys = fingerprint_index.assign(_cell_blocks(frame_array, dim)[changed_mask])
+                else:
+                    cell_keys = [str(v) for v in cell_signatures.tolist()]
+                grid.means[changed_mask] = cell_signatures
+                grid.stds[changed_mask] = cell_stds
+                grid.ids[changed_mask] = frame_stack.register_keys(frame_idx, cell_keys, changed_cells)
+        else:
+            cell_signatures, cell_stds = segment_frame(frame_array, dim)
+            mean_keys.update(cell_signatures.ravel().tolist())
+            if key_scheme == "fingerprint":
+                cells = _cell_blocks(frame_array, dim)
+                cell_keys = fingerprint_index.assign(cells.reshape(-1, *cells.shape[2:]))
+            else:
+                cell_keys = [str(v) for v in cell_signatures.ravel().tolist()]
+            cell_ids = frame_stack.register_keys(frame_idx, cell_keys, all_cells).reshape(dim)
+            grid = CellGrid(frame_idx, cell_signatures, cell_stds, cell_ids)
+
+        frame_stack.append(grid)
+        yield frame_array, grid
+
+        prev_frame_array = frame_array
+        prev_grid = grid
+
+    if key_scheme == "fingerprint":
+        print(f"Unique cell classes: {len(fingerprint_index)} fingerprint classes vs {len(mean_keys)} ceil(mean) keys")
+
+
+def load_gif_by_frame_and_cells(gif_path: str, dim: Tuple[int, int], engine: str = "numpy", delta: bool = False, key_scheme: str = "fingerprint") -> Tuple[CellThumbnails, FrameStack]:
+    """Split every GIF frame into dim = (rows, cols) cells and keep the results of all frames.
+
+    See iter_gif_frames_and_cells for the options. Cell thumbnails are not encoded here;
+    frames_cells keeps the frame buffers and encodes a cell on demand.
+    """
+    frames_cells = CellThumbnails(dim)
+    frame_stack = FrameStack(dim)
+    for frame_array, _ in iter_gif_frames_and_cells(gif_path, frame_stack, engine=engine, delta=delta, key_scheme=key_scheme):
+        frames_cells.append(frame_array)
+    return frames_cells, frame_stack
 
-def load_gif_by_frame_and_cells(gif_path: str, dim: Tuple[int, int]) -> Tuple[List[List[List[str]]], List[List[List[float]]], List[List[List[float]]], Dict[float, List[Tuple[int, int, int]]]]:
-    frames_cells = []
-    frames_cells_vals = []
-    frames_cells_stds = []
-    pixel_value_to_all_indices = {} 
-    
-    with Image.open(gif_path) as gif:
-        for frame_idx, frame in enumerate(ImageSequence.Iterator(gif)):
-            rgb_frame = frame.convert('RGB')
-            width, height = rgb_frame.size
-            cell_width = width // dim[1]
-            cell_height = height // dim[0]
-            
-            current_frame_cells_list = []
-            current_frame_vals_list = []
-            current_frame_stds_list = []
-            for i in range(dim[0]):
-                row_cells = []
-                row_vals = []
-                row_stds = []
-                for j in range(dim[1]):
-                    left = j * cell_width
-                    upper = i * cell_height
-                    right = left + cell_width
-                    lower = upper + cell_height
-                    
-                    cell_image_pil = rgb_frame.crop((left, upper, right, lower))
-                    cell_image_pil_resized = cell_image_pil.resize((100, 100)).crop((3, 3, 97, 97))
-
-                    cell_pixel_array = np.array(cell_image_pil_resized)
-                    cell_mean_val = str(int(np.ceil(cell_pixel_array.mean())))
-                    cell_std_dev = round(np.array(cell_image_pil_resized).std(axis=(0,1)).mean(), 2)
-                    
-                    if cell_mean_val not in pixel_value_to_all_indices:
-                        pixel_value_to_all_indices[cell_mean_val] = []
-                    pixel_value_to_all_indices[cell_mean_val].append((frame_idx, i, j))
-                    
-                    buffer = io.BytesIO()
-                    cell_image_pil_resized.save(buffer, format="JPEG")
-                    buffer.seek(0)
-                    cell_base64_str = base64.b64encode(buffer.getvalue()).decode("utf-8")
-                    
-                    row_cells.append(cell_base64_str)
-                    row_vals.append(cell_mean_val)
-                    row_stds.append(cell_std_dev)
-
-                current_frame_cells_list.append(row_cells)
-                current_frame_vals_list.append(row_vals)
-                current_frame_stds_list.append(row_stds)
-            
-            frames_cells.append(current_frame_cells_list)
-            frames_cells_vals.append(current_frame_vals_list)
-            frames_cells_stds.append(current_frame_stds_list)
-            
-    return frames_cells, frames_cells_vals, frames_cells_stds, pixel_value_to_all_indices
-
-
-def _extract_pddl_block_content(text: str, keyword: str) -> str:
-    if not keyword.startswith('('):
-        keyword = "(" + keyword
-
-    start_keyword_idx = text.find(keyword)
-    if start_keyword_idx == -1:
-        return ""
-    
-    content_start_idx = start_keyword_idx + len(keyword)
-    while content_start_idx < len(text) and text[content_start_idx].isspace():
-        content_start_idx += 1
-
-    balance = 1 
-    content_end_idx = -1
-
-    for i in range(content_start_idx, len(text)):
-        if text[i] == '(':
-            balance += 1
-        elif text[i] == ')':
-            balance -= 1
-            if balance == 0: 
-                content_end_idx = i
-                break
-    
-    if content_start_idx != -1 and content_end_idx != -1 and content_start_idx < content_end_idx:
-        return text[content_start_idx:content_end_idx].strip()
-    return ""
 
 # def _get_pddl_domain_details(domain_pddl_content: str) -> Dict[str, List[str]]:
 #     """Parses domain PDDL content to extract specific details like defined color constants."""
@@ -125,21 +275,9 @@ def synthesize_pddl_objects(client, domain_name, problem_name, objects):
     # with open(f"../dataset/stimuli/{domain_name}/{problem_name}/{problem_name}.txt", "r") as f:
     #     description = f.read()
 
-    objects_kind = set([re.sub(r'\d+$', '', obj) for obj in objects])
-
-    object_dict ={}
-    for kind in objects_kind:
-        object_dict[kind] = []
-        for o in objects:
-            if kind in o:
-                object_dict[kind].append(o)
-
-    pddl_obj_str = "(:objects\n"
-    for k, val in object_dict.items():
-        if len(val) > 1:
-            pddl_obj_str += f"{' '.join(sorted(list(set(val))))} - {k}\n"
-
-    pddl_obj_str += ")\n"
+    # Group by the exact name without its number, so e.g. truck1 is not grouped with foodtruck1
+    object_dict = group_objects(objects)
+    pddl_obj_str = serialize_objects({k: val for k, val in object_dict.items() if len(val) > 1})
 
     return pddl_obj_str
 
@@ -270,47 +408,67 @@ def synthesize_pddl_objects(client, domain_name, problem_name, objects):
     
 #     return final_pddl_objects_str
 
-def get_cell_prompt(destination_folder, loc, objects, domain_name, problem_name):
-    base_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
-    with open(f"{base_dir}/dataset/stimuli/{domain_name}/{problem_name}/{problem_name}.txt", "r") as f:
-        description = f.read()
-    with open(f"{base_dir}/synthesis/prompts/pddl_classify_cell_type.txt", "r") as f:
-        cell_prompt = f.read()
-    with open(f"{base_dir}/{destination_folder}/{domain_name}/{problem_name}/objects.json", "r") as f:
-        object_types = json.load(f)
-
-    cell_prompt += f"Description of the domain: {description}\n"
-    cell_prompt += f"List of cell types in the domain: {object_types['background_cells']}\n"
-    cell_prompt += "Please classify the cell in the image and return a json file.\n"
-    return cell_prompt
-
-def get_object_prompt(destination_folder, domain_name, problem_name):
-    base_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
-    with open(f"{base_dir}/dataset/stimuli/{domain_name}/{problem_name}/{problem_name}.txt", "r") as f:
-        description = f.read()
-    with open(f"{base_dir}/synthesis/prompts/pddl_problem_prompt.txt", "r") as f:
-        object_prompt = f.read()
-    with open(f"{base_dir}/{destination_folder}/{domain_name}/{problem_name}/objects.json", "r") as f:
-        object_types_config = json.load(f)
+def get_cell_prompt(destination_folder, loc, objects, domain_name, problem_name, context: Optional[ProblemContext] = None):
+    context = context or ProblemContext(destination_folder, domain_name, problem_name)
+
+    def _render_cell_prompt():
+        cell_prompt = context.prompt_template("pddl_classify_cell_type.txt")
+        object_types = context.objects
+
+        cell_prompt += f"Description of the domain: {context.description}\n"
+        cell_prompt += f"List of cell types in the domain: {object_types['background_cells']}\n"
+        cell_prompt += "Please classify the cell in the image and return a json file.\n"
+        return cell_prompt
+
+    return context.memo("cell_prompt", ("objects",), _render_cell_prompt)
+
+def get_object_prompt(destination_folder, domain_name, problem_name, context: Optional[ProblemContext] = None):
+    context = context or ProblemContext(destination_folder, domain_name, problem_name)
+
+    def _render_object_prompt():
+        object_prompt = context.prompt_template("pddl_problem_prompt.txt")
+        object_types_config = context.objects
 
         relevant_object_categories = []
         
         for k in ["unique_objects", "generic_objects", "agent"]:
             relevant_object_categories.extend(object_types_config[k])
-        print(f"Relevant object categories: {relevant_object_categories}")
-    with open(f"{base_dir}/{destination_folder}/{domain_name}/{problem_name}/domain.pddl", "r") as f:
-        domain_pddl_content = f.read()
-
-    attributes_str = ""
-    if "(:predicates" in domain_pddl_content:
-        predicates_section = _extract_pddl_block_content(domain_pddl_content, "(:predicates")
-        attributes_str = "\n".join([line.strip() for line in predicates_section.split('\n') if line.strip() and not line.strip().startswith(';')])
-    
-    object_prompt += f"Description of the domain: {description}\n"
-    object_prompt += f"List of objects in the domain: {relevant_object_categories}. Please only use object names in this list\n"
-    object_prompt += f"List of attributes in the domain: {attributes_str}\n"
-    object_prompt += "Please parse the object in the image and return a json file.\n"
-    return object_prompt
+        attributes_str = "\n".join(str(predicate) for predicate in context.domain_index.predicates.values())
+        
+        object_prompt += f"Description of the domain: {context.description}\n"
+        object_prompt += f"List of objects in the domain: {relevant_object_categories}. Please only use object names in this list\n"
+        object_prompt += f"List of attributes in the domain: {attributes_str}\n"
+        object_prompt += "Please parse the object in the image and return a json file.\n"
+        return object_prompt
+
+    return context.memo("object_prompt", ("objects", "domain"), _render_object_prompt)
+
+def _classification_request(prompt: str, image: str, temperature: float) -> Tuple[List[Any], types.GenerateContentConfig]:
+    """The contents (prompt and cell image) and JSON response config of a cell classification call."""
+    contents = [
+        prompt,
+        _image_part(image)
+    ]
+    return contents, _classification_config(temperature)
+
+def _classification_config(temperature: float) -> types.GenerateContentConfig:
+    return types.GenerateContentConfig(
+        temperature=temperature,
+        response_mime_type= 'application/json'
+    )
+
+def _image_part(image: str) -> types.Part:
+    header, encoded_data = image.split(",", 1)
+    mime_type = header.split(":")[1].split(";")[0]
+    return types.Part.from_bytes(data=base64.b64decode(encoded_data), mime_type=mime_type)
+
+def _batch_classification_request(prompt: str, images: List[Tuple[int, str]], temperature: float) -> Tuple[List[Any], types.GenerateContentConfig]:
+    """The contents of a batched classification call: the prompt, then every (cell id, image) as a label and its image."""
+    contents = [prompt]
+    for cell_id, image in images:
+        contents.append(f"Cell {cell_id}:")
+        contents.append(_image_part(image))
+    return contents, _classification_config(temperature)
 
 def classify_cell(    
     client,
@@ -320,25 +478,20 @@ def classify_cell(
     domain_name: str,
     problem_name: str,
     objects: List[str],
-    temperature: float = 0.2):
-    config_obj = types.GenerateContentConfig(
-        temperature=temperature,
-        response_mime_type= 'application/json'
-    )
-    cell_prompt = get_cell_prompt(destination_folder, loc,  objects, domain_name, problem_name)
-    header, encoded_data = image.split(",", 1)
-    mime_type = header.split(":")[1].split(";")[0]
-    image_bytes = base64.b64decode(encoded_data)
+    temperature: float = 0.2,
+    context: Optional[ProblemContext] = None):
+    cell_prompt = get_cell_prompt(destination_folder, loc,  objects, domain_name, problem_name, context=context)
+    contents, config_obj = _classification_request(cell_prompt, image, temperature)
     
     return call_gemini_with_retry(
         client=client,
         problem_name=problem_name,
         model_name="gemini-2.0-flash",
-        contents=[
-            cell_prompt,
-            types.Part.from_bytes(data=image_bytes, mime_type=mime_type)
-        ],
-        config=config_obj 
+        contents=contents,
+        config=config_obj,
+        budget=context.budget if context else None,
+        stage="classify_cell",
+        cache_prefix=1
     )
 
 def classify_object(
@@ -348,58 +501,168 @@ def classify_object(
     domain_name: str,
     problem_name: str,
     temperature: float = 0.2,
+    context: Optional[ProblemContext] = None
 ) -> str:
-    config_obj = types.GenerateContentConfig(
-        temperature=temperature,
-        response_mime_type= 'application/json'
-    )
-    object_prompt = get_object_prompt(destination_folder, domain_name, problem_name)
-    header, encoded_data = image.split(",", 1)
-    mime_type = header.split(":")[1].split(";")[0] 
-    image_bytes = base64.b64decode(encoded_data)
+    object_prompt = get_object_prompt(destination_folder, domain_name, problem_name, context=context)
+    contents, config_obj = _classification_request(object_prompt, image, temperature)
     
     return call_gemini_with_retry(
         client=client,
         problem_name=problem_name,
         model_name="gemini-2.0-flash",
-        contents=[
-            object_prompt,
-            types.Part.from_bytes(data=image_bytes, mime_type=mime_type)
-        ],
-        config=config_obj 
+        contents=contents,
+        config=config_obj,
+        budget=context.budget if context else None,
+        stage="classify_object",
+        cache_prefix=1
     )
 
+async def classify_cell_async(client, destination_folder, image: str, loc: List[int], domain_name: str, problem_name: str, objects: List[str], temperature: float = 0.2, context: Optional[ProblemContext] = None) -> str:
+    cell_prompt = get_cell_prompt(destination_folder, loc, objects, domain_name, problem_name, context=context)
+    contents, config_obj = _classification_request(cell_prompt, image, temperature)
+    return await call_gemini_with_retry_async(client=client, problem_name=problem_name, model_name="gemini-2.0-flash", contents=contents, config=config_obj, budget=context.budget if context else None, stage="classify_cell", cache_prefix=1)
+
+async def classify_object_async(client, destination_folder, image: str, domain_name: str, problem_name: str, temperature: float = 0.2, context: Optional[ProblemContext] = None) -> str:
+    object_prompt = get_object_prompt(destination_folder, domain_name, problem_name, context=context)
+    contents, config_obj = _classification_request(object_prompt, image, temperature)
+    return await call_gemini_with_retry_async(client=client, problem_name=problem_name, model_name="gemini-2.0-flash", contents=contents, config=config_obj, budget=context.budget if context else None, stage="classify_object", cache_prefix=1)
+
+async def classify_cells_async(client, destination_folder, images: List[Tuple[int, str]], domain_name: str, problem_name: str, objects: List[str], temperature: float = 0.2, context: Optional[ProblemContext] = None) -> str:
+    """classify_cell_async for several (cell id, image) pairs in one call; the response is a JSON array keyed by cell_id."""
+    context = context or ProblemContext(destination_folder, domain_name, problem_name)
+    cell_prompt = get_cell_prompt(destination_folder, None, objects, domain_name, problem_name, context=context) + context.prompt_template("pddl_classify_cell_batch.txt")
+    contents, config_obj = _batch_classification_request(cell_prompt, images, temperature)
+    return await call_gemini_with_retry_async(client=client, problem_name=problem_name, model_name="gemini-2.0-flash", contents=contents, config=config_obj, budget=context.budget if context else None, stage="classify_cells_batch", cache_prefix=1)
+
+async def classify_objects_async(client, destination_folder, images: List[Tuple[int, str]], domain_name: str, problem_name: str, temperature: float = 0.2, context: Optional[ProblemContext] = None) -> str:
+    """classify_object_async for several (cell id, image) pairs in one call; the response is a JSON array keyed by cell_id."""
+    context = context or ProblemContext(destination_folder, domain_name, problem_name)
+    object_prompt = get_object_prompt(destination_folder, domain_name, problem_name, context=context) + context.prompt_template("pddl_problem_batch.txt")
+    contents, config_obj = _batch_classification_request(object_prompt, images, temperature)
+    return await call_gemini_with_retry_async(client=client, problem_name=problem_name, model_name="gemini-2.0-flash", contents=contents, config=config_obj, budget=context.budget if context else None, stage="classify_objects_batch", cache_prefix=1)
+
+def _response_json(response: str) -> Any:
+    return json.loads(response.strip("`").strip("json"))
+
+def _parse_batch_response(response: str, cell_ids: List[int], fields: Tuple[str, ...]) -> Dict[int, Dict[str, Any]]:
+    """The entries of a batched response that name one of cell_ids and have all fields; anything else is left out."""
+    try:
+        entries = _response_json(response)
+    except ValueError:
+        return {}
+    parsed = {}
+    for entry in entries if isinstance(entries, list) else []:
+        if not isinstance(entry, dict) or not all(field in entry for field in fields):
+            continue
+        try:
+            cell_id = int(entry.get("cell_id"))
+        except (TypeError, ValueError):
+            continue
+        if cell_id in cell_ids:
+            parsed[cell_id] = entry
+    return parsed
+
+def _combined_type(cell_type_data: Dict[str, Any], cell_content_data: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    if cell_content_data is None:
+        cell_content_data = {"object_name": [], "object_pddl_str": ""}
+    return {"type": cell_type_data["cell_type"], "objects": cell_content_data["object_name"], "object_pddl_str": cell_content_data["object_pddl_str"]}
+
+def _classified_type(cell_type_json_str: str, cell_content_json_str: Optional[str]) -> Dict[str, Any]:
+    """Combine the cell type and object responses of a cell; no object response means an empty cell."""
+    return _combined_type(_response_json(cell_type_json_str), None if cell_content_json_str is None else _response_json(cell_content_json_str))
+
+def _start_classification(destination_folder, frame_stack: FrameStack, domain_name, problem_name, objects, temperature, cell_cache, cell_ids, context: ProblemContext, batch_size: int = 1) -> Tuple[List[int], Optional[str]]:
+    """Report what classify_unique_cells is about to classify; returns the cell ids and the cell cache's prompt context hash."""
+    if cell_ids is None:
+        cell_ids = range(len(frame_stack.keys))
+    total_cell_instances = len(frame_stack) * frame_stack.dim[0] * frame_stack.dim[1]
+    unique_pixel_values_count = len(cell_ids)
+    
+    print(f"Total cell instances across all frames: {total_cell_instances}")
+    print(f"Unique mean pixel values to classify: {unique_pixel_values_count}")
+    if total_cell_instances > unique_pixel_values_count:
+         print(f"LLM calls for background saved by unique classification: {total_cell_instances - unique_pixel_values_count}")
+
+    context_hash = classification_context_hash(context, temperature, batch_size) if cell_cache is not None else None
+    return list(cell_ids), context_hash
+
+def classification_context_hash(context: ProblemContext, temperature: float, batch_size: int = 1) -> str:
+    """The cell cache's prompt context hash: the prompt templates, the domain's vocabulary and the model settings.
+
+    The vocabulary is what a classification can answer with: the background cell types,
+    object categories and predicates of objects.json and domain.pddl, each sorted. The
+    stimulus description is left out, so problems whose synthesized vocabulary matches
+    share their classifications.
+    """
+    object_types = context.objects
+    vocabulary = {category: sorted(object_types.get(category, [])) for category in ("background_cells", "unique_objects", "generic_objects", "agent")}
+    predicates = sorted(str(predicate) for predicate in context.domain_index.predicates.values())
+    prompt_parts = [
+        context.prompt_template("pddl_classify_cell_type.txt"),
+        context.prompt_template("pddl_problem_prompt.txt"),
+        json.dumps(vocabulary, sort_keys=True),
+        "\n".join(predicates),
+        f"gemini-2.0-flash temperature={temperature}"
+    ]
+    # Batched calls classify from different prompts, so their classifications are kept apart
+    if batch_size > 1:
+        prompt_parts += [context.prompt_template("pddl_classify_cell_batch.txt"), context.prompt_template("pddl_problem_batch.txt")]
+    return prompt_context_hash(*prompt_parts)
+
 def classify_unique_cells(
     client,
     destination_folder: str,
-    pixel_value_to_all_indices: Dict[float, List[Tuple[int, int, int]]],
-    frames_cells: List[List[List[str]]],
-    frames_cells_stds: List[List[List[float]]],
+    frame_stack: FrameStack,
+    frames_cells: CellThumbnails,
     domain_name: str,
     problem_name: str,
     objects: List[str], 
-    temperature: float = 0.2
-) -> Dict[float, str]:
-    """Classify cells based on their unique average pixel values."""
-
-
-    unique_pixel_value_to_cell_type_path = f"../{destination_folder}/{domain_name}/{problem_name}/unique_pixel_value_to_cell_type.json"
-    # if os.path.exists(unique_pixel_value_to_cell_type_path):
-    #     with open(unique_pixel_value_to_cell_type_path, "r") as f:
-    #         return json.load(f)
+    temperature: float = 0.2,
+    cell_cache: Optional[CellClassificationCache] = None,
+    cell_ids: Optional[List[int]] = None,
+    concurrency: int = 1,
+    batch_size: int = 1,
+    context: Optional[ProblemContext] = None,
+    loop: Optional[asyncio.AbstractEventLoop] = None
+) -> Dict[str, Dict[str, Any]]:
+    """Classify cells based on their unique keys in frame_stack, each from the cell where the key first appeared.
+
+    cell_ids restricts classification to those key ids (default: all keys). With a
+    cell_cache, the keys must be cell fingerprints; classifications are looked up by
+    (fingerprint, domain, prompt context) before calling the model. concurrency > 1
+    or batch_size > 1 runs the model calls through classify_unique_cells_async, on
+    loop if given (callers classifying many times keep their connections across
+    calls that way) and otherwise on an event loop of their own.
+    """
+    if concurrency > 1 or batch_size > 1:
+        classification = classify_unique_cells_async(
+            client, destination_folder, frame_stack, frames_cells, domain_name, problem_name, objects,
+            temperature=temperature, cell_cache=cell_cache, cell_ids=cell_ids, concurrency=concurrency, batch_size=batch_size, context=context
+        )
+        if loop is not None:
+            return loop.run_until_complete(classification)
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(classification)
+        finally:
+            close_classification_loop(client, loop)
+
+    context = context or ProblemContext(destination_folder, domain_name, problem_name)
+    cell_ids, context_hash = _start_classification(destination_folder, frame_stack, domain_name, problem_name, objects, temperature, cell_cache, cell_ids, context)
     pixel_value_to_type = {}
-    total_cell_instances = sum(len(indices_list) for indices_list in pixel_value_to_all_indices.values())
-    unique_pixel_values_count = len(pixel_value_to_all_indices)
+    unique_pixel_values_count = len(cell_ids)
     
-    print(f"Total cell instances across all frames: {total_cell_instances}")
-    print(f"Unique mean pixel values to classify: {unique_pixel_values_count}")
-    if total_cell_instances > unique_pixel_values_count:
-         print(f"LLM calls for background saved by unique classification: {total_cell_instances - unique_pixel_values_count}")
-    
-    for i, (pixel_value, indices_list) in enumerate(pixel_value_to_all_indices.items()):
-        frame_idx, row, col = indices_list[0]
-        cell_image_base64 = frames_cells[frame_idx][row][col]
-        
+    for i, cell_id in enumerate(cell_ids):
+        pixel_value = frame_stack.keys[cell_id]
+        frame_idx, row, col = frame_stack.first_seen[cell_id]
+
+        if cell_cache is not None:
+            cached_type = cell_cache.get(pixel_value, domain_name, context_hash)
+            if cached_type is not None:
+                pixel_value_to_type[pixel_value] = cached_type
+                continue
+
+        cell_image_base64 = frames_cells.get(frame_idx, row, col)
 
         cell_image_url = f"data:image/jpeg;base64,{cell_image_base64}"
         
@@ -413,281 +676,686 @@ def classify_unique_cells(
             domain_name=domain_name,
             problem_name=problem_name,
             objects=objects, 
-            temperature=temperature
+            temperature=temperature,
+            context=context
         )
 
-        cell_type_data = json.loads(cell_type_json_str.strip("`").strip("json"))
-
-        if frames_cells_stds[frame_idx][row][col] < 0.1:
-            cell_content_data = {"object_name": [], "object_pddl_str": ""}
-        else:
+        cell_content_json_str = None
+        if frame_stack[frame_idx].has_objects(row, col):
             cell_content_json_str = classify_object(
                         client, destination_folder, cell_image_url, domain_name, 
-                        problem_name,temperature=0.2,
+                        problem_name,temperature=0.2, context=context
                 )
 
-            cell_content_data = json.loads(cell_content_json_str.strip("`").strip("json"))
-
         # print(f"Cell ({row+1},{col+1}) classified as: {cell_type_data}")
-        classified_type = {"type": cell_type_data["cell_type"], "objects": cell_content_data["object_name"], "object_pddl_str": cell_content_data["object_pddl_str"]}
+        classified_type = _classified_type(cell_type_json_str, cell_content_json_str)
         pixel_value_to_type[pixel_value] = classified_type
+        if cell_cache is not None:
+            cell_cache.put(pixel_value, domain_name, context_hash, classified_type)
+
+    if cell_cache is not None:
+        print(f"Cell classification cache: {cell_cache.hits} hits, {cell_cache.misses} misses")
 
     return pixel_value_to_type
 
+def close_classification_loop(client, loop: asyncio.AbstractEventLoop):
+    """Close an event loop that ran classify_unique_cells_async, with the client's connections opened on it.
+
+    Calls still in flight, e.g. after another call of their gather failed, are cancelled first.
+    """
+    try:
+        pending = asyncio.all_tasks(loop)
+        for task in pending:
+            task.cancel()
+        if pending:
+            loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
+        loop.run_until_complete(gemini_provider(client).aclose())
+        loop.run_until_complete(loop.shutdown_default_executor())
+    finally:
+        loop.close()
+
+async def classify_unique_cells_async(
+    client,
+    destination_folder: str,
+    frame_stack: FrameStack,
+    frames_cells: CellThumbnails,
+    domain_name: str,
+    problem_name: str,
+    objects: List[str],
+    temperature: float = 0.2,
+    cell_cache: Optional[CellClassificationCache] = None,
+    cell_ids: Optional[List[int]] = None,
+    concurrency: int = 8,
+    batch_size: int = 1,
+    context: Optional[ProblemContext] = None
+) -> Dict[str, Dict[str, Any]]:
+    """classify_unique_cells with the cell type and object calls of all uncached cells in flight together.
+
+    At most concurrency model calls run at once. The mapping is built in cell_ids order
+    and cache writes happen after all calls return, so the result is the same as the
+    serial classify_unique_cells for the same model responses.
+
+    batch_size > 1 packs up to that many cells into each cell type call, and their cells
+    with objects into one object call (see classify_cells_async). Cells missing from a
+    batched response, or whose entry lacks a field, are classified with single-cell calls.
+    """
+    context = context or ProblemContext(destination_folder, domain_name, problem_name)
+    cell_ids, context_hash = _start_classification(destination_folder, frame_stack, domain_name, problem_name, objects, temperature, cell_cache, cell_ids, context, batch_size=batch_size)
+    semaphore = asyncio.Semaphore(concurrency)
+    unique_pixel_values_count = len(cell_ids)
+
+    async def _limited(classify_async, *args, **kwargs) -> str:
+        async with semaphore:
+            return await classify_async(*args, **kwargs)
+
+    async def _classify(i: int, cell_id: int) -> Dict[str, Any]:
+        pixel_value = frame_stack.keys[cell_id]
+        frame_idx, row, col = frame_stack.first_seen[cell_id]
+        cell_image_url = f"data:image/jpeg;base64,{frames_cells.get(frame_idx, row, col)}"
+        print(f"Classifying unique cell type {i+1}/{unique_pixel_values_count} (pixel_value: {pixel_value})...")
+
+        requests = [_limited(classify_cell_async, client, destination_folder, cell_image_url, [row+1, col+1], domain_name, problem_name, objects, temperature=temperature, context=context)]
+        if frame_stack[frame_idx].has_objects(row, col):
+            requests.append(_limited(classify_object_async, client, destination_folder, cell_image_url, domain_name, problem_name, temperature=0.2, context=context))
+        responses = await asyncio.gather(*requests)
+        return _classified_type(responses[0], responses[1] if len(responses) > 1 else None)
+
+    async def _classify_batch(batch: List[Tuple[int, int]]) -> List[Dict[str, Any]]:
+        images, object_images = [], []
+        for _, cell_id in batch:
+            frame_idx, row, col = frame_stack.first_seen[cell_id]
+            image = (cell_id, f"data:image/jpeg;base64,{frames_cells.get(frame_idx, row, col)}")
+            images.append(image)
+            if frame_stack[frame_idx].has_objects(row, col):
+                object_images.append(image)
+        print(f"Classifying unique cell types {batch[0][0]+1}-{batch[-1][0]+1}/{unique_pixel_values_count} in one batch ({len(object_images)} with objects)...")
+
+        requests = [_limited(classify_cells_async, client, destination_folder, images, domain_name, problem_name, objects, temperature=temperature, context=context)]
+        if object_images:
+            requests.append(_limited(classify_objects_async, client, destination_folder, object_images, domain_name, problem_name, temperature=0.2, context=context))
+        responses = await asyncio.gather(*requests)
+        cell_types = _parse_batch_response(responses[0], [cell_id for cell_id, _ in images], ("cell_type",))
+        cell_contents = _parse_batch_response(responses[1], [cell_id for cell_id, _ in object_images], ("object_name", "object_pddl_str")) if object_images else {}
+
+        object_ids = {cell_id for cell_id, _ in object_images}
+        fallbacks = {}
+        for cell_id, image in images:
+            frame_idx, row, col = frame_stack.first_seen[cell_id]
+            if cell_id not in cell_types:
+                fallbacks[cell_id, "type"] = _limited(classify_cell_async, client, destination_folder, image, [row+1, col+1], domain_name, problem_name, objects, temperature=temperature, context=context)
+            if cell_id in object_ids and cell_id not in cell_contents:
+                fallbacks[cell_id, "objects"] = _limited(classify_object_async, client, destination_folder, image, domain_name, problem_name, temperature=0.2, context=context)
+        if fallbacks:
+            print(f"Batched responses left out {len(fallbacks)} cell classifications; classifying them one cell at a time...")
+            for kind, stage in (("type", "classify_cells_batch"), ("objects", "classify_objects_batch")):
+                missing = sum(k == kind for _, k in fallbacks)
+                if missing:
+                    record_parse_failure(stage, f"{missing} cells missing from the batched response", problem=problem_name, cells=missing)
+            for (cell_id, kind), response in zip(fallbacks, await asyncio.gather(*fallbacks.values())):
+                (cell_types if kind == "type" else cell_contents)[cell_id] = _response_json(response)
+        return [_combined_type(cell_types[cell_id], cell_contents.get(cell_id) if cell_id in object_ids else None) for cell_id, _ in images]
+
+    classified_types = {}
+    pending = []
+    for i, cell_id in enumerate(cell_ids):
+        if cell_cache is not None:
+            cached_type = cell_cache.get(frame_stack.keys[cell_id], domain_name, context_hash)
+            if cached_type is not None:
+                classified_types[cell_id] = cached_type
+                continue
+        pending.append((i, cell_id))
+
+    if batch_size > 1:
+        batches = [pending[start:start + batch_size] for start in range(0, len(pending), batch_size)]
+        pending_types = [classified_type for batch_types in await asyncio.gather(*[_classify_batch(batch) for batch in batches]) for classified_type in batch_types]
+    else:
+        pending_types = await asyncio.gather(*[_classify(i, cell_id) for i, cell_id in pending])
+    for (_, cell_id), classified_type in zip(pending, pending_types):
+        classified_types[cell_id] = classified_type
+        if cell_cache is not None:
+            cell_cache.put(frame_stack.keys[cell_id], domain_name, context_hash, classified_type)
+
+    if cell_cache is not None:
+        print(f"Cell classification cache: {cell_cache.hits} hits, {cell_cache.misses} misses")
+
+    return {frame_stack.keys[cell_id]: classified_types[cell_id] for cell_id in cell_ids}
+
+def bit_matrix_term(matrix: np.ndarray) -> Term:
+    """PDDL array theory literal of a boolean (rows, cols) matrix.
+
+    bit-mat stacks its bit-vecs as columns, so the rows are written out and transposed.
+    """
+    bit_atoms = ("0", "1")
+    bit_vecs = tuple(("bit-vec",) + tuple(map(bit_atoms.__getitem__, row)) for row in matrix.tolist())
+    return ("transpose", ("bit-mat",) + bit_vecs)
+
+def bit_matrix_literal(matrix: np.ndarray) -> str:
+    return serialize_term(bit_matrix_term(matrix))
+
+@functools.lru_cache(maxsize=64)
+def _set_index_facts(pddl_type: str, rows: int, cols: int) -> List[List[Fact]]:
+    """The set-index fact of every cell for a background type, built once so that frames share the fact objects."""
+    fluent = (pddl_type,)
+    return [[("=", fluent, ("set-index", pddl_type, "true", str(row + 1), str(col + 1))) for col in range(cols)] for row in range(rows)]
+
 def generate_pddl_from_mapping(
-    pixel_value_to_indices_current_frame: Dict[float, List[Tuple[int, int, int]]],
-    unique_pixel_value_to_cell_type: Dict[float, str],
-    rows: int,
-    cols: int,
-    domain_name: str 
-) -> str:
-    """Generate PDDL init facts for background cells for the current frame."""
+    frame_stack: FrameStack,
+    frame_number: int,
+    unique_pixel_value_to_cell_type: Dict[str, Dict[str, Any]],
+    domain_name: str,
+    bit_matrix_encoding: str = "set-index"
+) -> List[Fact]:
+    """Generate PDDL init facts for background cells for the current frame.
+
+    bit_matrix_encoding="set-index" creates each background type's bit matrix empty and
+    sets its cells one fact at a time; "literal" writes each matrix as a single
+    bit-mat literal.
+    """
+    if bit_matrix_encoding not in BIT_MATRIX_ENCODINGS:
+        raise ValueError(f"Unknown bit matrix encoding: {bit_matrix_encoding}. Expected one of {BIT_MATRIX_ENCODINGS}.")
+    rows, cols = frame_stack.dim
+    keys = frame_stack.keys
+    # Key ids are numbered in order of first appearance, so the groups follow that order
+    cells_by_id = frame_stack.cells_by_key(frame_number)
+    grid_size_facts = [("=", ("gridheight",), str(rows)), ("=", ("gridwidth",), str(cols))]
+
     pddl_init_bg_facts = []
-    frame_specific_actual_pddl_types = set()
-    for pixel_value, _ in pixel_value_to_indices_current_frame.items():
-        classified_type = unique_pixel_value_to_cell_type.get(str(pixel_value))
+    if bit_matrix_encoding == "literal":
+        type_matrices = {}
+        for cell_id, cells in cells_by_id.items():
+            actual_pddl_type = unique_pixel_value_to_cell_type.get(keys[cell_id])["type"]
+            if actual_pddl_type not in type_matrices:
+                type_matrices[actual_pddl_type] = np.zeros((rows, cols), dtype=bool)
+            cell_rows, cell_cols = zip(*cells)
+            type_matrices[actual_pddl_type][list(cell_rows), list(cell_cols)] = True
+        for actual_pddl_type, matrix in type_matrices.items():
+            pddl_init_bg_facts.append(("=", (actual_pddl_type,), bit_matrix_term(matrix)))
+        return pddl_init_bg_facts + grid_size_facts
+
+    # A dict rather than a set keeps the new-bit-matrix facts in first-appearance order,
+    # independent of the string hash seed of the process rendering the frame
+    frame_specific_actual_pddl_types = {}
+    for cell_id in cells_by_id:
+        classified_type = unique_pixel_value_to_cell_type.get(keys[cell_id])
 
         actual_pddl_type = classified_type["type"]
         # if domain_name == "foodtruck" and classified_type == "blackspace":
         #     actual_pddl_type = "building"
 
-        frame_specific_actual_pddl_types.add(actual_pddl_type)
+        frame_specific_actual_pddl_types[actual_pddl_type] = None
 
     for pddl_type_to_init in frame_specific_actual_pddl_types:
-        pddl_init_bg_facts.append(f"(= ({pddl_type_to_init}) (new-bit-matrix false {rows} {cols}))")
-    pddl_init_bg_facts.append(f"(= (gridheight) {rows})")
-    pddl_init_bg_facts.append(f"(= (gridwidth) {cols})")
-    
-    for pixel_value, indices_list_for_pv in pixel_value_to_indices_current_frame.items():
-        classified_type = unique_pixel_value_to_cell_type.get(str(pixel_value))
+        pddl_init_bg_facts.append(("=", (pddl_type_to_init,), ("new-bit-matrix", "false", str(rows), str(cols))))
+    pddl_init_bg_facts.extend(grid_size_facts)
+
+    for cell_id, cells in cells_by_id.items():
+        classified_type = unique_pixel_value_to_cell_type.get(keys[cell_id])
 
         actual_pddl_type = classified_type["type"]
         # if domain_name == "foodtruck" and classified_type == "blackspace":
         #     actual_pddl_type = "building"
         
-        for frame_idx, row, col in indices_list_for_pv: 
-            pddl_init_bg_facts.append(f"(= ({actual_pddl_type}) (set-index {actual_pddl_type} true {row+1} {col+1}))")
+        set_index_facts = _set_index_facts(actual_pddl_type, rows, cols)
+        pddl_init_bg_facts.extend([set_index_facts[row][col] for row, col in cells])
 
-    return "\n".join(pddl_init_bg_facts)
+    return pddl_init_bg_facts
 
-def generate_per_image(
-    client,
-    destination_folder,
-    current_frame_cells: List[List[str]],
-    current_frame_vals: List[List[float]],
-    current_frame_stds: List[List[float]],
-    domain_name: str, 
-    problem_name: str,
+def render_frame_facts(
+    frame_stack: FrameStack,
     frame_number: int,
-    pixel_value_to_all_indices: Dict[float, List[Tuple[int, int, int]]], 
-    unique_pixel_value_to_cell_content: Dict[float, str]
-):
-    """Generates PDDL for a single frame using unique pixel classification for background and object detection for dynamic elements."""
-    base_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
-    rows = len(current_frame_cells)
-    cols = len(current_frame_cells[0]) if rows > 0 else 0
-    
-    # Initialize/load here
+    domain_name: str,
+    unique_pixel_value_to_cell_content: Dict[str, Dict[str, Any]],
+    object_categories_config: Dict[str, Any],
+    previous_cell_contents: Optional[Dict[Tuple[int, int], Tuple[List[str], CellTemplate]]] = None,
+    bit_matrix_encoding: str = "set-index"
+) -> Tuple[List[Fact], List[str], Dict[Tuple[int, int], Tuple[List[str], CellTemplate]]]:
+    """Render the init facts of a single frame without writing anything.
+
+    Returns the init facts, the generic objects detected in the frame (numbered in
+    row-major order) and the per-cell (objects, CellTemplate) contents of the frame.
+    When the frame was delta segmented and the previous frame's contents are given,
+    only the changed cells are looked up again and the others are carried forward.
+    """
+    grid = frame_stack[frame_number]
     unique_objects_detected_in_frame = set()
     generic_objects_detected_in_frame = []
-    object_type_path = f"{base_dir}/{destination_folder}/{domain_name}/{problem_name}/objects.json"
-    object_categories_config = {}
-    if os.path.exists(object_type_path):
-        with open(object_type_path, "r") as f:
-            object_categories_config = json.load(f)
-
-    domain_pddl_path = f"{base_dir}/{destination_folder}/{domain_name}/{problem_name}/domain.pddl"
-    with open(domain_pddl_path, "r") as f:
-        domain_pddl_content = f.read()
-
-    # valid_pddl_colors = set()
-    # domain_details = _get_pddl_domain_details(domain_pddl_content)
-    # valid_pddl_colors = set(domain_details.get("colors", []))
 
-    pddl_problem_header = f"(define (problem {problem_name})\n (:domain {domain_name})"
-    
-    current_frame_pixel_value_indices = {}
-    if frame_number is not None:
-        for pv, all_indices_for_pv in pixel_value_to_all_indices.items():
-            indices_for_current_frame = [(f_idx, r, c) for f_idx, r, c in all_indices_for_pv if f_idx == frame_number]
-            if indices_for_current_frame:
-                current_frame_pixel_value_indices[pv] = indices_for_current_frame
-    
-    pddl_init_background_facts_str = generate_pddl_from_mapping(
-        current_frame_pixel_value_indices, 
+    pddl_init_facts = generate_pddl_from_mapping(
+        frame_stack,
+        frame_number,
         unique_pixel_value_to_cell_content,
-        rows, cols, domain_name
+        domain_name,
+        bit_matrix_encoding=bit_matrix_encoding
     )
-    pddl_init_dynamic_objects_facts_list = []
 
     generic_object_dict = {}
 
     if len(object_categories_config["agent"]) > 1:
-        pddl_init_dynamic_objects_facts_list.append(f"(= (agentcode {object_categories_config['agent'][0]}) 0)")
-        pddl_init_dynamic_objects_facts_list.append(f"(= (agentcode {object_categories_config['agent'][1]}) 1)")
-        pddl_init_dynamic_objects_facts_list.append(f"(= (turn) {frame_number % 2})")
-
-    for r in range(rows):
-        for c in range(cols):
-            if current_frame_stds[r][c] > 0.1:
-                cell_image_base64 = current_frame_cells[r][c]
-                cell_image_url = f"data:image/jpeg;base64,{cell_image_base64}"
-
-                object_list = unique_pixel_value_to_cell_content.get(current_frame_vals[r][c])["objects"]
-
-                cell_object_pddl_str = unique_pixel_value_to_cell_content.get(current_frame_vals[r][c])["object_pddl_str"]
-
-                cell_object_pddl_str = cell_object_pddl_str.replace("$i", str(r+1)).replace("$j", str(c+1))
-
-                for o in object_list:
-                    if o in object_categories_config["unique_objects"]:
-                        unique_objects_detected_in_frame.add(o)
-                    if o in object_categories_config["generic_objects"]:
-                        if o not in generic_object_dict:
-                            generic_object_dict[o] = 1
-                            cell_object_pddl_str = cell_object_pddl_str.replace(" "+o," "+o + "1")
-                            generic_objects_detected_in_frame.append(o + "1")
-                        else:
-                            generic_object_dict[o] += 1
-                            cell_object_pddl_str = cell_object_pddl_str.replace(" "+o, " "+o + str(generic_object_dict[o]))
-                            generic_objects_detected_in_frame.append(o + str(generic_object_dict[o]))
-                pddl_init_dynamic_objects_facts_list.append(cell_object_pddl_str)
-                # print(f"Cell ({r+1},{c+1}) classified as: {cell_object_data}")
-                # if "object_pddl_str" in cell_object_data and cell_object_data["object_pddl_str"]:
-                #     for pred_line in cell_object_data["object_pddl_str"].split('\n'):
-                #         clean_line = pred_line.strip()
-                #         if not clean_line: continue
-                #         modified_pred_line = clean_line
-                #         constants_set_lower = set() 
-                #         if domain_pddl_content:
-                #             constants_section_content = _extract_pddl_block_content(domain_pddl_content, "(:constants")
-                #             for line_const in constants_section_content.split('\n'):
-                #                 line_const = line_const.strip()
-                #                 if not line_const or line_const.startswith(';') or line_const == ")": continue
-                #                 line_const = line_const.split(';')[0].strip()
-                #                 if not line_const: continue
-                #                 names_str_const = line_const.split(' - ')[0] if ' - ' in line_const else line_const
-                #                 for const_name in names_str_const.split():
-                #                     if const_name: constants_set_lower.add(const_name.lower())
-
-                #         for generic_base_name in object_categories_config.get("generic_objects", []):
-                #             if generic_base_name.lower() not in constants_set_lower:
-                #                 pattern = r'([\(\s])(' + re.escape(generic_base_name) + r')([\s\)])'
-                #                 replacement_str = r'\1' + generic_base_name + "1" + r'\3'
-                #                 modified_pred_line = re.sub(pattern=pattern, repl=replacement_str, string=modified_pred_line, flags=re.IGNORECASE)
-                        
-                #         if modified_pred_line.startswith("(iskeycolor") or modified_pred_line.startswith("(isdoorcolor"):
-                #             color_val = modified_pred_line.split()[-1][:-1].lower()
-                #             if color_val not in valid_pddl_colors:
-                #                 print(f"Warning: LLM proposed invalid PDDL color '{color_val}' in predicate: {modified_pred_line}. Valid colors: {valid_pddl_colors}. Frame: {frame_number}, Cell: ({r+1},{c+1})")
-
-                #         pddl_init_dynamic_objects_facts_list.append(modified_pred_line)
-                # if "object_name" in cell_object_data:
-                #     for o_name in cell_object_data["object_name"]:
-                #         if not o_name: continue
-                #         o_name_base = re.sub(r'\d+$', '', o_name)
-                #         for category, cat_names in object_categories_config.items():
-                #             if isinstance(cat_names, list) and (o_name in cat_names or o_name_base in cat_names):
-                #                 if category in objects_detected_in_frame and o_name not in objects_detected_in_frame[category]:
-                #                     objects_detected_in_frame[category].append(o_name)
-                #                 break
-    
+        pddl_init_facts.append(("=", ("agentcode", object_categories_config["agent"][0]), "0"))
+        pddl_init_facts.append(("=", ("agentcode", object_categories_config["agent"][1]), "1"))
+        pddl_init_facts.append(("=", ("turn",), str(frame_number % 2)))
+
+    key_contents = {}
+
+    def _cell_content(r, c):
+        cell_id = grid.ids[r, c]
+        if cell_id not in key_contents:
+            classified_type = unique_pixel_value_to_cell_content.get(frame_stack.keys[cell_id])
+            key_contents[cell_id] = (classified_type["objects"], cell_template(classified_type["object_pddl_str"]))
+        return key_contents[cell_id]
+
+    if grid.changed_cells is not None and previous_cell_contents is not None:
+        cell_contents = dict(previous_cell_contents)
+        for r, c in grid.changed_cells:
+            cell_contents.pop((r, c), None)
+            if grid.has_objects(r, c):
+                cell_contents[(r, c)] = _cell_content(r, c)
+        cell_contents = dict(sorted(cell_contents.items()))
+    else:
+        object_cells = np.argwhere(grid.stds > OBJECT_STD_THRESHOLD).tolist()
+        cell_contents = {(r, c): _cell_content(r, c) for r, c in object_cells}
+
+    generic_objects = set(object_categories_config["generic_objects"])
+    for (r, c), (object_list, template) in cell_contents.items():
+        # Generic objects are numbered across the frame; every mention of one in the
+        # cell's facts refers to its first instance in the cell
+        renames = {}
+        for o in object_list:
+            if o in object_categories_config["unique_objects"]:
+                unique_objects_detected_in_frame.add(o)
+            if o in generic_objects:
+                generic_object_dict[o] = generic_object_dict.get(o, 0) + 1
+                numbered_object = o + str(generic_object_dict[o])
+                renames.setdefault(o, numbered_object)
+                generic_objects_detected_in_frame.append(numbered_object)
+        pddl_init_facts.extend(template.instantiate(r, c, renames))
+
     for cat_key in object_categories_config["unique_objects"]:
         if cat_key not in unique_objects_detected_in_frame:
-            pddl_init_dynamic_objects_facts_list.append(f"(= (xloc {cat_key}) -1)")
-            pddl_init_dynamic_objects_facts_list.append(f"(= (yloc {cat_key}) -1)")
+            pddl_init_facts.append(("=", ("xloc", cat_key), "-1"))
+            pddl_init_facts.append(("=", ("yloc", cat_key), "-1"))
 
+    return pddl_init_facts, generic_objects_detected_in_frame, cell_contents
 
-    full_pddl_str = pddl_problem_header + "\n"
 
-    # print(f"Unique objects detected in frame {frame_number}: {unique_objects_detected_in_frame}")
-    if len(generic_objects_detected_in_frame) > 0:
+def emit_frame(problem_dir: str, frame_number: int, problem: PDDLProblem, trajectory: Optional[TrajectoryWriter] = None):
+    """Write a rendered frame to frame_k.pddl, or add it to the trajectory if one is given."""
+    if trajectory is not None:
+        trajectory.add_frame(frame_number, problem.objects_str, problem.init_strs())
+        return
 
-        if frame_number == 0:
+    pddl_file_path = f"{problem_dir}/frame_{frame_number}.pddl"
+    os.makedirs(os.path.dirname(pddl_file_path), exist_ok=True)
+    with open(pddl_file_path, "w") as pddl_file:
+        pddl_file.write(problem.serialize())
 
-            pddl_objects_declaration_str = synthesize_pddl_objects(client, domain_name, problem_name, generic_objects_detected_in_frame)
-            full_pddl_str += pddl_objects_declaration_str + "\n"
 
-            object_categories_config["obj_str"] = pddl_objects_declaration_str
+def declare_generic_objects(client, domain_name: str, problem_name: str, generic_objects: List[str], context: ProblemContext) -> str:
+    """Build the (:objects ...) declaration of the first frame with generic objects and save it as obj_str in objects.json.
 
-            with open(object_type_path, "w") as f:
-                json.dump(object_categories_config, f, indent=4)
+    Later frames reuse the saved declaration instead of declaring their own objects.
+    """
+    pddl_objects_declaration_str = synthesize_pddl_objects(client, domain_name, problem_name, generic_objects)
+    object_categories_config = context.objects
+    object_categories_config["obj_str"] = pddl_objects_declaration_str
+    with open(context.objects_path, "w") as f:
+        json.dump(object_categories_config, f, indent=4)
+    context.invalidate("objects")
+    return pddl_objects_declaration_str
 
-        else:
 
+def clear_generic_objects(context: ProblemContext):
+    """Remove the obj_str an earlier run saved in objects.json, so this run declares its own generic objects."""
+    if not os.path.exists(context.objects_path):
+        return
+    object_categories_config = context.objects
+    if object_categories_config.pop("obj_str", None) is None:
+        return
+    with open(context.objects_path, "w") as f:
+        json.dump(object_categories_config, f, indent=4)
+    context.invalidate("objects")
+
+
+def generate_per_image(
+    client,
+    destination_folder,
+    frame_stack: FrameStack,
+    domain_name: str, 
+    problem_name: str,
+    frame_number: int,
+    unique_pixel_value_to_cell_content: Dict[str, Dict[str, Any]],
+    previous_cell_contents: Optional[Dict[Tuple[int, int], Tuple[List[str], CellTemplate]]] = None,
+    bit_matrix_encoding: str = "set-index",
+    trajectory: Optional[TrajectoryWriter] = None,
+    context: Optional[ProblemContext] = None
+) -> Dict[Tuple[int, int], Tuple[List[str], CellTemplate]]:
+    """Generates PDDL for a single frame using unique pixel classification for background and object detection for dynamic elements.
+
+    Returns the per-cell (objects, CellTemplate) contents of the frame, which can be
+    passed back as previous_cell_contents for the next frame (see render_frame_facts).
+    With a trajectory, the frame is added to it instead of being written to frame_k.pddl.
+    """
+    context = context or ProblemContext(destination_folder, domain_name, problem_name)
+    object_categories_config = {}
+    if os.path.exists(context.objects_path):
+        object_categories_config = context.objects
+
+    pddl_init_facts, generic_objects_detected_in_frame, cell_contents = render_frame_facts(
+        frame_stack,
+        frame_number,
+        domain_name,
+        unique_pixel_value_to_cell_content,
+        object_categories_config,
+        previous_cell_contents=previous_cell_contents,
+        bit_matrix_encoding=bit_matrix_encoding
+    )
+
+    problem = PDDLProblem(problem_name, domain_name, init=pddl_init_facts)
+    if len(generic_objects_detected_in_frame) > 0:
+        # Frame 0, or the first frame with generic objects when frame 0 has none, declares them
+        if frame_number == 0 or "obj_str" not in object_categories_config:
+            pddl_objects_declaration_str = declare_generic_objects(client, domain_name, problem_name, generic_objects_detected_in_frame, context)
+        else:
             pddl_objects_declaration_str = object_categories_config["obj_str"]
-            full_pddl_str += pddl_objects_declaration_str + "\n"
-        
-        
-    full_pddl_str += "(:init \n"
-    full_pddl_str += pddl_init_background_facts_str + "\n"
-    if pddl_init_dynamic_objects_facts_list:
-        full_pddl_str += "\n".join(pddl_init_dynamic_objects_facts_list) + "\n"
-    full_pddl_str += ")\n" 
-    full_pddl_str += "(:goal (true)) \n)" 
-    
-    pddl_file_path = f"{base_dir}/{destination_folder}/{domain_name}/{problem_name}/frame_{frame_number}.pddl"
-    os.makedirs(os.path.dirname(pddl_file_path), exist_ok=True)
-    with open(pddl_file_path, "w") as pddl_file:
-        pddl_file.write(full_pddl_str)
-    return None
+        problem.objects = parse_objects(pddl_objects_declaration_str)
+
+    emit_frame(context.problem_dir, frame_number, problem, trajectory=trajectory)
+    return cell_contents
+
+
+def _emit_frame_range(
+    frame_stack: FrameStack,
+    domain_name: str,
+    problem_name: str,
+    problem_dir: str,
+    unique_pixel_value_to_cell_content: Dict[str, Dict[str, Any]],
+    object_categories_config: Dict[str, Any],
+    bit_matrix_encoding: str,
+    render_only: bool
+) -> List[PDDLProblem]:
+    """Pool task of emit_frames_parallel: render the frames of a FrameStack slice and write them, or return them if render_only."""
+    rendered_frames = []
+    cell_contents = None
+    declared_objects = None
+    for frame_idx in range(frame_stack.first_frame_idx, len(frame_stack)):
+        pddl_init_facts, generic_objects, cell_contents = render_frame_facts(
+            frame_stack,
+            frame_idx,
+            domain_name,
+            unique_pixel_value_to_cell_content,
+            object_categories_config,
+            previous_cell_contents=cell_contents,
+            bit_matrix_encoding=bit_matrix_encoding
+        )
+        problem = PDDLProblem(problem_name, domain_name, init=pddl_init_facts)
+        if generic_objects:
+            if declared_objects is None:
+                declared_objects = parse_objects(object_categories_config["obj_str"])
+            problem.objects = declared_objects
+        if render_only:
+            rendered_frames.append(problem)
+        else:
+            emit_frame(problem_dir, frame_idx, problem)
+    return rendered_frames
 
-def generate_problem_pddl(client, destination_folder, domain_name, problem_name):
+
+def emit_frames_parallel(
+    client,
+    destination_folder,
+    frame_stack: FrameStack,
+    domain_name: str,
+    problem_name: str,
+    unique_pixel_value_to_cell_content: Dict[str, Dict[str, Any]],
+    workers: int,
+    bit_matrix_encoding: str = "set-index",
+    trajectory: Optional[TrajectoryWriter] = None,
+    context: Optional[ProblemContext] = None
+):
+    """Render and write every frame of a fully classified FrameStack across a process pool.
+
+    Frames only share the generic object declaration of the first frame with generic
+    objects, so it is built and saved to objects.json up front (rendering the frames
+    before it once more); the frames are then split into contiguous ranges
+    rendered by the workers. Delta segmented frames carry cell contents within a range
+    only, which gives the same contents as a full lookup. Trajectory frames are rendered
+    by the workers and added in frame order here, so the output is identical to
+    emitting the frames one by one with generate_per_image.
+    """
+    context = context or ProblemContext(destination_folder, domain_name, problem_name)
+    total_frames = len(frame_stack)
+    if total_frames == 0:
+        return
+    object_categories_config = context.objects if os.path.exists(context.objects_path) else {}
+
+    cell_contents = None
+    for frame_idx in range(total_frames):
+        _, generic_objects, cell_contents = render_frame_facts(frame_stack, frame_idx, domain_name, unique_pixel_value_to_cell_content, object_categories_config, previous_cell_contents=cell_contents, bit_matrix_encoding=bit_matrix_encoding)
+        if generic_objects:
+            declare_generic_objects(client, domain_name, problem_name, generic_objects, context)
+            object_categories_config = context.objects
+            break
+
+    # A few ranges per worker keeps the pool busy when some frames hold more objects than others
+    num_ranges = min(total_frames, workers * 4)
+    bounds = np.linspace(0, total_frames, num_ranges + 1).astype(int).tolist()
+    render_only = trajectory is not None
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [
+            executor.submit(
+                _emit_frame_range,
+                frame_stack.slice(start, stop),
+                domain_name,
+                problem_name,
+                context.problem_dir,
+                unique_pixel_value_to_cell_content,
+                object_categories_config,
+                bit_matrix_encoding,
+                render_only
+            )
+            for start, stop in zip(bounds[:-1], bounds[1:])
+        ]
+        for start, future in zip(bounds[:-1], futures):
+            for frame_idx, problem in enumerate(future.result(), start):
+                emit_frame(context.problem_dir, frame_idx, problem, trajectory=trajectory)
+
+def stream_problem_pddl(client, destination_folder, domain_name, problem_name, image_path, grid_size, delta: bool = False, key_scheme: str = "fingerprint", cell_cache: Optional[CellClassificationCache] = None, bit_matrix_encoding: str = "set-index", trajectory: Optional[TrajectoryWriter] = None, concurrency: int = 1, batch_size: int = 1, context: Optional[ProblemContext] = None) -> Dict[str, Any]:
+    """Segment, classify and emit frame_k.pddl in a single pass over the GIF.
+
+    Cell keys are classified when they first appear and each frame's PDDL is written
+    before the next frame is read, so only the current and previous frame are held.
+    Concurrent or batched classification runs on one event loop for the whole GIF, so
+    the frames share their connections to the model.
+    Returns the mapping of every classified key to its cell type.
+    """
+    frames_cells = CellThumbnails(grid_size, window=1)
+    frame_stack = FrameStack(grid_size, window=1)
+    unique_pixel_value_to_cell_type = {}
+    cell_contents = None
+    loop = asyncio.new_event_loop() if concurrency > 1 or batch_size > 1 else None
+
+    try:
+        for frame_array, grid in iter_gif_frames_and_cells(image_path, frame_stack, delta=delta, key_scheme=key_scheme):
+            frames_cells.append(frame_array)
+
+            new_cell_ids = list(range(len(unique_pixel_value_to_cell_type), len(frame_stack.keys)))
+            if new_cell_ids:
+                unique_pixel_value_to_cell_type.update(classify_unique_cells(
+                    client,
+                    destination_folder,
+                    frame_stack,
+                    frames_cells,
+                    domain_name,
+                    problem_name,
+                    [],
+                    temperature=0.2,
+                    cell_cache=cell_cache,
+                    cell_ids=new_cell_ids,
+                    concurrency=concurrency,
+                    batch_size=batch_size,
+                    context=context,
+                    loop=loop
+                ))
+
+            cell_contents = generate_per_image(
+                client,
+                destination_folder,
+                frame_stack,
+                domain_name,
+                problem_name,
+                grid.frame_idx,
+                unique_pixel_value_to_cell_type,
+                previous_cell_contents=cell_contents,
+                bit_matrix_encoding=bit_matrix_encoding,
+                trajectory=trajectory,
+                context=context
+            )
+    finally:
+        if loop is not None:
+            close_classification_loop(client, loop)
+
+    print(f"Processed {len(frame_stack)} frames from GIF: {problem_name}")
+    return unique_pixel_value_to_cell_type
+
+def generate_problem_pddl(client, destination_folder, domain_name, problem_name, delta: bool = False, key_scheme: str = "fingerprint", use_cell_cache: bool = True, grid_check: str = "override", stream: bool = True, bit_matrix_encoding: str = "set-index", output_format: str = "frames", keyframe_interval: int = 0, workers: int = 1, concurrency: int = 1, batch_size: int = 1, context: Optional[ProblemContext] = None):
+    """Write frame_k.pddl for every frame of the problem GIF.
+
+    stream=True runs the single-pass pipeline of stream_problem_pddl; stream=False
+    segments the whole GIF and classifies all unique cells before writing any frame.
+    bit_matrix_encoding selects how background bit matrices are written (see
+    generate_pddl_from_mapping).
+
+    output_format="trajectory" writes a single trajectory.jsonl of the initial state and
+    per-frame deltas (see trajectory.py) instead of frame_k.pddl files, storing a full
+    keyframe every keyframe_interval frames (0: only the first frame). Trajectories
+    always use literal bit matrices, as set-index facts depend on their order.
+
+    workers > 1 renders and writes the frames across that many processes once all
+    cells are classified (see emit_frames_parallel), so it implies stream=False;
+    workers=0 uses every core. The output is identical to workers=1.
+
+    concurrency > 1 classifies the unique cells with up to that many model calls in
+    flight, and batch_size > 1 classifies up to that many cells per call (see
+    classify_unique_cells_async).
+    """
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(f"Unknown output format: {output_format}. Expected one of {OUTPUT_FORMATS}.")
     base_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
-    config_path = f"{base_dir}/{destination_folder}/{domain_name}/{problem_name}/config.json"
+    context = context or ProblemContext(destination_folder, domain_name, problem_name)
+    config_path = context.config_path
     if not os.path.exists(config_path):
         print(f"Error: Config file not found at {config_path}")
         return
-    with open(config_path, "r") as f:
-        config = json.load(f)
+    config = context.config
 
-    image_path = f"{base_dir}/dataset/stimuli/{domain_name}/{problem_name}/{problem_name}.gif"
+    image_path = context.gif_path
     if not os.path.exists(image_path):
         print(f"Error: GIF file not found at {image_path}")
         return
-    grid_size = config.get("grid_size")
+    grid_size = check_grid_size(image_path, config.get("grid_size"), mode=grid_check)
     if not grid_size or not (isinstance(grid_size, list) and len(grid_size) == 2):
         print(f"Error: Invalid grid_size in config: {grid_size}. Expected [rows, cols].")
         return
+    if grid_size != config.get("grid_size"):
+        config["grid_size"] = grid_size
+        with open(config_path, "w") as f:
+            json.dump(config, f, indent=4)
+        context.invalidate("config")
+
+    clear_generic_objects(context)
+
+    # Outputs of the other format from earlier runs would be picked up by load_domain_states
+    problem_dir = context.problem_dir
+    stale_outputs = glob.glob(f"{problem_dir}/frame_*.pddl") if output_format == "trajectory" else [p for p in trajectory_paths(problem_dir) if os.path.exists(p)]
+    for stale_path in stale_outputs:
+        os.remove(stale_path)
+    if stale_outputs:
+        print(f"Removed {len(stale_outputs)} {'frame' if output_format == 'trajectory' else 'trajectory'} files of an earlier run from {problem_dir}")
+
+    trajectory = None
+    if output_format == "trajectory":
+        bit_matrix_encoding = "literal"
+        trajectory = TrajectoryWriter(problem_dir, f"(define (problem {problem_name})\n (:domain {domain_name})", keyframe_interval=keyframe_interval)
+
+    # Mean pixel value keys are not content addressed, so they cannot be shared across problems
+    cell_cache = CellClassificationCache() if use_cell_cache and key_scheme == "fingerprint" else None
+
+    workers = workers or os.cpu_count() or 1
+    output_path = f"{base_dir}/{destination_folder}/{domain_name}/{problem_name}/unique_pixel_value_to_cell_type.json"
+    if stream and workers == 1:
+        unique_pixel_value_to_cell_type = stream_problem_pddl(client, destination_folder, domain_name, problem_name, image_path, grid_size, delta=delta, key_scheme=key_scheme, cell_cache=cell_cache, bit_matrix_encoding=bit_matrix_encoding, trajectory=trajectory, concurrency=concurrency, batch_size=batch_size, context=context)
+        if cell_cache is not None:
+            cell_cache.close()
+        if trajectory is not None:
+            trajectory.close()
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+        with open(output_path, "w") as json_file:
+            json.dump(unique_pixel_value_to_cell_type, json_file, indent=4)
+        print(f"Unique pixel value to cell type mapping saved to: {output_path}")
+        return
 
-    frames_cells, frames_cells_vals, frames_cells_stds, pixel_value_to_all_indices = load_gif_by_frame_and_cells(image_path, grid_size)
+    frames_cells, frame_stack = load_gif_by_frame_and_cells(image_path, grid_size, delta=delta, key_scheme=key_scheme)
     
     unique_pixel_value_to_cell_type = classify_unique_cells(
         client,
         destination_folder,
-        pixel_value_to_all_indices, 
+        frame_stack, 
         frames_cells, 
-        frames_cells_stds,
         domain_name,
         problem_name,
         [], 
-        temperature=0.2
+        temperature=0.2,
+        cell_cache=cell_cache,
+        concurrency=concurrency,
+        batch_size=batch_size,
+        context=context
     )
+    if cell_cache is not None:
+        cell_cache.close()
 
     print(f"Unique pixel values classified: {unique_pixel_value_to_cell_type}")
 
     # Save the unique pixel value to cell type mapping to a JSON file
-    output_path = f"{base_dir}/{destination_folder}/{domain_name}/{problem_name}/unique_pixel_value_to_cell_type.json"
     os.makedirs(os.path.dirname(output_path), exist_ok=True)
     with open(output_path, "w") as json_file:
         json.dump(unique_pixel_value_to_cell_type, json_file, indent=4)
     print(f"Unique pixel value to cell type mapping saved to: {output_path}")
     
-    total_frames = len(frames_cells)
+    total_frames = len(frame_stack)
     print(f"Processing {total_frames} frames from GIF: {problem_name}")
 
+    if workers > 1:
+        emit_frames_parallel(
+            client,
+            destination_folder,
+            frame_stack,
+            domain_name,
+            problem_name,
+            unique_pixel_value_to_cell_type,
+            workers,
+            bit_matrix_encoding=bit_matrix_encoding,
+            trajectory=trajectory,
+            context=context
+        )
+        if trajectory is not None:
+            trajectory.close()
+        return None
+
+    cell_contents = None
     for frame_idx in range(total_frames):
-        generate_per_image(
+        cell_contents = generate_per_image(
             client,
             destination_folder,
-            frames_cells[frame_idx],
-            frames_cells_vals[frame_idx],
-            frames_cells_stds[frame_idx],
+            frame_stack,
             domain_name,
             problem_name,
             frame_idx,      
-            pixel_value_to_all_indices, 
-            unique_pixel_value_to_cell_type
+            unique_pixel_value_to_cell_type,
+            previous_cell_contents=cell_contents,
+            bit_matrix_encoding=bit_matrix_encoding,
+            trajectory=trajectory,
+            context=context
         )
+    if trajectory is not None:
+        trajectory.close()
         
     return None
\ No newline at end of file
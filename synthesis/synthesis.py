@@ -3,6 +3,15 @@ import os
 import argparse
 from google import genai
 from segment_cells import *
+from response_cache import RESPONSE_CACHE_MODES, configure_response_cache
+from mock_llm import MockBackend, MockGeminiClient, canned_response_dir
+from rate_limiter import configure_rate_limits
+from llm_providers import POOL_MAX_CONNECTIONS, POOL_MAX_KEEPALIVE_CONNECTIONS, GeminiProvider, configure_http_pool
+from telemetry import configure_telemetry, trace_context
+from call_budget import BudgetExceeded, CallBudget, CircuitOpen, configure_circuit_breakers
+import json
+import sys
+import tempfile
 import time
 
 def __main__():
@@ -10,6 +19,26 @@ def __main__():
     parser.add_argument("--api_addr", type=str, help="Path to the api file.")
     parser.add_argument("--problem_path", type=str, help="Path to the problem file.")
     parser.add_argument("--destination_folder", type=str, help="Path to the destination folder.")
+    parser.add_argument("--delta", action="store_true", help="Only re-segment the cells that changed since the previous frame.")
+    parser.add_argument("--no_cell_cache", action="store_true", help="Do not reuse cell classifications cached by earlier problems.")
+    parser.add_argument("--bit_matrix_encoding", type=str, default="set-index", choices=["set-index", "literal"], help="Write background bit matrices as per-cell set-index facts or as one bit-mat literal per type.")
+    parser.add_argument("--output_format", type=str, default="frames", choices=["frames", "trajectory"], help="Write one frame_k.pddl per frame or a single trajectory.jsonl of per-frame deltas.")
+    parser.add_argument("--grid_check", type=str, default="override", choices=["override", "validate", "off"], help="How to use the grid size detected from the GIF against the synthesized grid_size.")
+    parser.add_argument("--workers", type=int, default=1, help="Processes used to write the frame PDDL files once all cells are classified; 0 uses every core.")
+    parser.add_argument("--concurrency", type=int, default=8, help="Cell classification calls to the model in flight at once.")
+    parser.add_argument("--batch_size", type=int, default=1, help="Cells classified per model call; larger batches make fewer but slower calls.")
+    parser.add_argument("--mock_llm", type=str, default=None, metavar="LATENCY", help="Answer from the local mock backend (see mock_llm.py) instead of Gemini, with this latency spec, e.g. 0 or lognormal:0.8:0.5. No API key is needed, and the response cache is not used.")
+    parser.add_argument("--llm_cache", type=str, default="off", choices=RESPONSE_CACHE_MODES, help="Call the model every time (default), reuse recorded model responses and record new ones, or replay recorded responses only (offline). With record or replay, a rerun gets the same answers back.")
+    parser.add_argument("--deadline", type=float, default=0, help="Seconds the whole problem may take across all stages; 0 for no deadline.")
+    parser.add_argument("--max_calls", type=int, default=0, help="Model calls the problem may make, retries included; 0 for no limit.")
+    parser.add_argument("--max_tokens", type=int, default=0, help="Tokens the problem's model calls may use; 0 for no limit.")
+    parser.add_argument("--call_timeout", type=float, default=120, help="Seconds a single model call may take before it is retried; 0 for no timeout.")
+    parser.add_argument("--circuit_breaker_failures", type=int, default=10, help="Consecutive failed calls (5xx or timeouts) after which calls to the model fail fast.")
+    parser.add_argument("--circuit_breaker_cooldown", type=float, default=60, help="Seconds calls fail fast once the circuit breaker has opened.")
+    parser.add_argument("--max_connections", type=int, default=POOL_MAX_CONNECTIONS, help="Connections the pooled HTTP client keeps open to the model API at most.")
+    parser.add_argument("--max_keepalive_connections", type=int, default=POOL_MAX_KEEPALIVE_CONNECTIONS, help="Idle connections the pool keeps alive for reuse.")
+    parser.add_argument("--trace", type=str, default="", help="Trace every model call to this JSONL file, e.g. .cache/llm_trace.jsonl (summarize it with telemetry.py); off by default.")
+    parser.add_argument("--no_context_cache", action="store_true", help="Send the static prompt prefix of every cell classification call inline instead of uploading it once as Gemini cached content.")
     args = parser.parse_args()
     path = args.problem_path
     api_addr = args.api_addr
@@ -28,11 +57,20 @@ def __main__():
     #     json.dump(token_count, json_file)
 
 
-    with open(api_addr, "r") as f:
-        gemini_api_key = f.read()
+    configure_http_pool(args.max_connections, args.max_keepalive_connections)
+    if args.mock_llm is not None:
+        client_gemini = GeminiProvider(client=MockGeminiClient(MockBackend(canned_dir=canned_response_dir(domain_name, problem_name), latency=args.mock_llm)), context_caching=not args.no_context_cache)
+        # Mock responses are neither recorded nor counted against the real quota
+        args.llm_cache = "off"
+        configure_rate_limits(tempfile.mkdtemp(prefix="rate_limits_"))
+    else:
+        with open(api_addr, "r") as f:
+            gemini_api_key = f.read()
 
-
-    client_gemini = genai.Client(api_key=gemini_api_key)
+        client_gemini = GeminiProvider(api_key=gemini_api_key, context_caching=not args.no_context_cache)
+    llm_cache = configure_response_cache(args.llm_cache)
+    configure_circuit_breakers(args.circuit_breaker_failures, args.circuit_breaker_cooldown)
+    configure_telemetry(args.trace or None)
 
     domain_name = path.split("/")[-2]
     problem_name = path.split("/")[-1]
@@ -42,23 +80,53 @@ def __main__():
 
     print(f"--- Processing problem: {problem_name} ---")
 
+    # Shared by all stages so the problem files and prompts are read once
+    budget = CallBudget(
+        deadline_seconds=args.deadline or None,
+        max_calls=args.max_calls or None,
+        max_tokens=args.max_tokens or None,
+        call_timeout_seconds=args.call_timeout or None,
+    )
+    context = ProblemContext(destination_folder, domain_name, problem_name, budget=budget)
+
+    status = "ok"
+    stopped = False
     valid_synthesis = False
     num_retries = 0
     max_retries = 7
-    while not valid_synthesis and num_retries < max_retries:
-        # try:
-            extract_objects(client_gemini, destination_folder,domain_name, problem_name)
-            synthesize_domain(client_gemini, destination_folder,domain_name, problem_name)
-            synthesize_config(client_gemini, destination_folder,domain_name, problem_name)
-
-
-            valid_synthesis = check_valid_synthesis(destination_folder,domain_name, problem_name)
-        # except Exception as e:
-        #     print(f"Error during synthesis: {e}")
-            num_retries += 1
-            time.sleep(5)  # Wait before retrying
-    generate_problem_pddl(client_gemini, destination_folder, domain_name, problem_name)
-    print(f"--- Finished processing problem: {problem_name} ---")
+    # Every model call of the problem is traced under its domain and problem
+    with trace_context(domain=domain_name, problem=problem_name, backend="api" if args.mock_llm is None else "mock"):
+        try:
+            while not valid_synthesis and num_retries < max_retries:
+                extract_objects(client_gemini, destination_folder,domain_name, problem_name, context=context)
+                synthesize_domain(client_gemini, destination_folder,domain_name, problem_name, context=context)
+                synthesize_config(client_gemini, destination_folder,domain_name, problem_name, grid_check=args.grid_check, context=context)
+
+
+                valid_synthesis = check_valid_synthesis(destination_folder,domain_name, problem_name, context=context)
+                num_retries += 1
+                if not valid_synthesis:
+                    time.sleep(5)  # Wait before retrying
+            if not valid_synthesis:
+                status = "invalid synthesis"
+            generate_problem_pddl(client_gemini, destination_folder, domain_name, problem_name, delta=args.delta, use_cell_cache=not args.no_cell_cache, grid_check=args.grid_check, bit_matrix_encoding=args.bit_matrix_encoding, output_format=args.output_format, workers=args.workers, concurrency=args.concurrency, batch_size=args.batch_size, context=context)
+        except (BudgetExceeded, CircuitOpen) as e:
+            status = f"{e.__class__.__name__}: {e}"
+            stopped = True
+            print(f"Stopped: {e}")
+        finally:
+            client_gemini.close()
+    if args.llm_cache != "off":
+        print(f"LLM response cache ({args.llm_cache}): {llm_cache.hits} hits, {llm_cache.misses} misses")
+
+    run_summary = {"status": status, "synthesis_attempts": num_retries, "budget": budget.summary()}
+    os.makedirs(context.problem_dir, exist_ok=True)
+    with open(f"{context.problem_dir}/synthesis_run.json", "w") as f:
+        json.dump(run_summary, f, indent=2)
+    print(f"Model calls: {budget.calls}, tokens: {budget.tokens}, timeouts: {budget.timeouts}, {budget.elapsed_seconds():.1f}s")
+    print(f"--- Finished processing problem: {problem_name} ({status}) ---")
+    if stopped:
+        sys.exit(1)
 
 
 if __name__ == "__main__":
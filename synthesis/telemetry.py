@@ -0,0 +1,209 @@
+import argparse
+import base64
+import contextlib
+import contextvars
+import json
+import os
+import threading
+import time
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+base_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+DEFAULT_TRACE_PATH = f"{base_dir}/.cache/llm_trace.jsonl"
+# Fields the summary can group by
+GROUP_FIELDS = ("stage", "domain", "problem", "model", "provider", "backend", "run")
+
+# Fields (domain, problem, ...) added to the records of every call made inside trace_context
+_trace_fields: contextvars.ContextVar = contextvars.ContextVar("llm_trace_fields", default={})
+
+
+@contextlib.contextmanager
+def trace_context(**fields):
+    """Add fields to the trace records of the model calls made inside the block, including
+    those of asyncio tasks it starts."""
+    token = _trace_fields.set({**_trace_fields.get(), **fields})
+    try:
+        yield
+    finally:
+        _trace_fields.reset(token)
+
+
+def payload_bytes(contents: Any) -> Tuple[int, int, int]:
+    """(text bytes, image bytes, image count) of Gemini contents or OpenAI chat messages."""
+    if isinstance(contents, str):
+        return len(contents.encode("utf-8")), 0, 0
+    if isinstance(contents, bytes):
+        return 0, len(contents), 1
+    if isinstance(contents, dict):
+        if contents.get("type") == "image_url":
+            url = contents["image_url"]["url"]
+            data = url.split(",", 1)[1] if url.startswith("data:") and "," in url else ""
+            return 0, len(base64.b64decode(data)) if data else 0, 1
+        return _sum_payloads(contents.values())
+    if isinstance(contents, (list, tuple)):
+        return _sum_payloads(contents)
+    inline_data = getattr(contents, "inline_data", None)
+    if inline_data is not None and inline_data.data is not None:
+        return 0, len(inline_data.data), 1
+    text = getattr(contents, "text", None)
+    if isinstance(text, str):
+        return payload_bytes(text)
+    if hasattr(contents, "tobytes"):  # PIL images
+        return 0, len(contents.tobytes()), 1
+    return 0, 0, 0
+
+
+def _sum_payloads(parts: Iterable[Any]) -> Tuple[int, int, int]:
+    text, images, count = 0, 0, 0
+    for part in parts:
+        t, i, c = payload_bytes(part)
+        text, images, count = text + t, images + i, count + c
+    return text, images, count
+
+
+class TraceWriter:
+    """Appends one JSON record per model call, and per response the pipeline could not use,
+    to a JSONL trace. Records of one process share a run id; the trace may hold many runs.
+    """
+
+    def __init__(self, path: str = DEFAULT_TRACE_PATH):
+        self.path = path
+        self.run = f"{time.strftime('%Y%m%dT%H%M%S')}-{os.getpid()}"
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._file = open(path, "a")
+
+    def write(self, event: str, fields: Dict[str, Any]):
+        record = {"event": event, "time": round(time.time(), 3), "run": self.run, **_trace_fields.get()}
+        record.update((key, value) for key, value in fields.items() if value is not None)
+        line = json.dumps(record, default=str)
+        with self._lock:
+            self._file.write(line + "\n")
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+_trace_writer: Optional[TraceWriter] = None
+
+
+def configure_telemetry(path: Optional[str] = DEFAULT_TRACE_PATH) -> Optional[TraceWriter]:
+    """Trace this process's model calls to path; None turns tracing off (the default)."""
+    global _trace_writer
+    if _trace_writer is not None:
+        _trace_writer.close()
+    _trace_writer = TraceWriter(path) if path else None
+    return _trace_writer
+
+
+def telemetry() -> Optional[TraceWriter]:
+    """The process's trace writer, None when tracing is off."""
+    return _trace_writer
+
+
+def record_call(**fields):
+    """Trace one model call (see llm_providers.py for its fields)."""
+    if _trace_writer is not None:
+        _trace_writer.write("call", fields)
+
+
+def record_parse_failure(stage: str, reason: str, **fields):
+    """Trace a model response that could not be parsed or was rejected, and so was asked for again."""
+    if _trace_writer is not None:
+        _trace_writer.write("parse_failure", {"stage": stage, "reason": reason, **fields})
+
+
+def read_trace(path: str, runs: Optional[List[str]] = None) -> List[Dict[str, Any]]:
+    records = []
+    with open(path, "r") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue  # a line cut short by an interrupted run
+            if runs is None or record.get("run") in runs:
+                records.append(record)
+    return records
+
+
+def _percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def summarize_trace(records: List[Dict[str, Any]], group_by: Tuple[str, ...] = ("stage",)) -> Dict[Tuple[Any, ...], Dict[str, float]]:
+    """Per-group totals of the trace: calls, cache hits, attempts, errors, parse failures,
+    tokens (cached_tokens: input tokens served from a context cache), image bytes and latency.
+    """
+    groups: Dict[Tuple[Any, ...], Dict[str, Any]] = {}
+    for record in records:
+        key = tuple(record.get(field) for field in group_by)
+        row = groups.setdefault(key, {
+            "calls": 0, "cached": 0, "attempts": 0, "errors": 0, "parse_failures": 0,
+            "input_tokens": 0, "output_tokens": 0, "total_tokens": 0, "cached_tokens": 0, "image_bytes": 0, "images": 0,
+            "latency_seconds": 0.0, "_latencies": [],
+        })
+        if record.get("event") == "parse_failure":
+            row["parse_failures"] += 1
+            continue
+        row["calls"] += 1
+        row["cached"] += bool(record.get("cached"))
+        row["attempts"] += record.get("attempts") or 0
+        row["errors"] += record.get("status", "ok") != "ok"
+        for field in ("input_tokens", "output_tokens", "total_tokens", "cached_tokens", "image_bytes", "images"):
+            row[field] += record.get(field) or 0
+        latency = record.get("latency_seconds") or 0.0
+        row["latency_seconds"] += latency
+        row["_latencies"].append(latency)
+    for row in groups.values():
+        latencies = row.pop("_latencies")
+        row["mean_latency_seconds"] = row["latency_seconds"] / len(latencies) if latencies else 0.0
+        row["p95_latency_seconds"] = _percentile(latencies, 0.95)
+    return dict(sorted(groups.items(), key=lambda item: tuple(str(k) for k in item[0])))
+
+
+def print_trace_summary(summary: Dict[Tuple[Any, ...], Dict[str, float]], group_by: Tuple[str, ...]):
+    width = max([len(" / ".join(str(k) for k in key)) for key in summary] + [len(" / ".join(group_by))]) + 2
+    print(f"{' / '.join(group_by):<{width}}{'calls':>7}{'cached':>8}{'attempts':>10}{'errors':>8}{'parse fail':>12}"
+          f"{'in tok':>11}{'cached tok':>12}{'out tok':>10}{'total tok':>11}{'img MB':>9}{'lat s':>10}{'mean s':>9}{'p95 s':>8}")
+    totals = {"calls": 0, "cached": 0, "attempts": 0, "errors": 0, "parse_failures": 0, "input_tokens": 0, "cached_tokens": 0, "output_tokens": 0, "total_tokens": 0, "image_bytes": 0, "latency_seconds": 0.0}
+    for key, row in summary.items():
+        for field in totals:
+            totals[field] += row[field]
+        print(f"{' / '.join(str(k) for k in key):<{width}}{row['calls']:>7}{row['cached']:>8}{row['attempts']:>10}{row['errors']:>8}{row['parse_failures']:>12}"
+              f"{row['input_tokens']:>11}{row['cached_tokens']:>12}{row['output_tokens']:>10}{row['total_tokens']:>11}{row['image_bytes'] / 1e6:>9.2f}{row['latency_seconds']:>10.1f}"
+              f"{row['mean_latency_seconds']:>9.2f}{row['p95_latency_seconds']:>8.2f}")
+    print(f"{'total':<{width}}{totals['calls']:>7}{totals['cached']:>8}{totals['attempts']:>10}{totals['errors']:>8}{totals['parse_failures']:>12}"
+          f"{totals['input_tokens']:>11}{totals['cached_tokens']:>12}{totals['output_tokens']:>10}{totals['total_tokens']:>11}{totals['image_bytes'] / 1e6:>9.2f}{totals['latency_seconds']:>10.1f}")
+
+
+def __main__():
+    parser = argparse.ArgumentParser(description="Summarize a trace of model calls written by the synthesis pipeline and the LLM baselines.")
+    parser.add_argument("trace", type=str, nargs="?", default=DEFAULT_TRACE_PATH, help="JSONL trace to summarize.")
+    parser.add_argument("--by", type=str, nargs="+", default=["stage"], choices=GROUP_FIELDS, help="Fields to group the calls by, e.g. --by domain stage.")
+    parser.add_argument("--runs", type=str, nargs="+", default=None, help="Only these run ids; 'last' is the most recent run.")
+    parser.add_argument("--json", action="store_true", help="Print the summary as JSON instead of a table.")
+    args = parser.parse_args()
+
+    runs = args.runs
+    if runs == ["last"]:
+        records = read_trace(args.trace)
+        runs = [records[-1]["run"]] if records else []
+    records = read_trace(args.trace, runs)
+    group_by = tuple(args.by)
+    summary = summarize_trace(records, group_by)
+    if args.json:
+        print(json.dumps([{**dict(zip(group_by, key)), **row} for key, row in summary.items()], indent=2))
+    else:
+        print_trace_summary(summary, group_by)
+
+
+if __name__ == "__main__":
+    __main__()
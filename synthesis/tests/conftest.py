@@ -0,0 +1,71 @@
+import os
+import shutil
+import sys
+import pytest
+
+synthesis_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+base_dir = os.path.dirname(synthesis_dir)
+# The synthesis modules import each other as top-level scripts
+sys.path.insert(0, synthesis_dir)
+
+
+@pytest.fixture
+def stimulus_gif(tmp_path):
+    """Copy a stimulus GIF into tmp_path, so its decoded frame store is written there and not next to the dataset."""
+    def _copy(domain_name: str, problem_name: str) -> str:
+        gif_path = str(tmp_path / f"{problem_name}.gif")
+        shutil.copy(f"{base_dir}/dataset/stimuli/{domain_name}/{problem_name}/{problem_name}.gif", gif_path)
+        return gif_path
+    return _copy
+
+
+@pytest.fixture
+def mock_problem(tmp_path):
+    """Synthesize a problem's objects, domain and config against the mock backend under tmp_path.
+
+    Returns synthesize(domain_name, problem_name), which returns generate(**kwargs):
+    write the problem's frames with generate_problem_pddl and return the written files
+    by name. generate.client and generate.context are the provider and context it uses.
+    """
+    import contextlib
+    import glob
+    import io
+    from llm_providers import GeminiProvider
+    from mock_llm import MockBackend, MockGeminiClient, canned_response_dir
+    from problem_context import ProblemContext
+    from rate_limiter import DEFAULT_RATE_LIMIT_DIR, configure_rate_limits
+    from segment_cells import generate_problem_pddl
+    from utils import extract_objects, synthesize_config, synthesize_domain
+
+    # Mock calls go against a quota of their own
+    configure_rate_limits(str(tmp_path / "rate_limits"))
+    destination_folder = os.path.relpath(tmp_path / "synthesis", base_dir)
+    clients = []
+
+    def _synthesize(domain_name: str, problem_name: str):
+        client = GeminiProvider(client=MockGeminiClient(MockBackend(canned_dir=canned_response_dir(domain_name, problem_name))))
+        clients.append(client)
+        context = ProblemContext(destination_folder, domain_name, problem_name)
+        with contextlib.redirect_stdout(io.StringIO()):
+            extract_objects(client, destination_folder, domain_name, problem_name, context=context)
+            synthesize_domain(client, destination_folder, domain_name, problem_name, context=context)
+            synthesize_config(client, destination_folder, domain_name, problem_name, context=context)
+
+        def _generate(**kwargs):
+            for path in glob.glob(f"{context.problem_dir}/frame_*.pddl") + glob.glob(f"{context.problem_dir}/trajectory*"):
+                os.remove(path)
+            with contextlib.redirect_stdout(io.StringIO()):
+                generate_problem_pddl(client, destination_folder, domain_name, problem_name, use_cell_cache=False, context=context, **kwargs)
+            outputs = {}
+            for path in glob.glob(f"{context.problem_dir}/frame_*.pddl") + glob.glob(f"{context.problem_dir}/trajectory*"):
+                with open(path, "r") as f:
+                    outputs[os.path.basename(path)] = f.read()
+            return outputs
+        _generate.client = client
+        _generate.context = context
+        return _generate
+
+    yield _synthesize
+    for client in clients:
+        client.close()
+    configure_rate_limits(DEFAULT_RATE_LIMIT_DIR)
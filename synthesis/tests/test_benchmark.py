@@ -0,0 +1,63 @@
+import argparse
+import contextlib
+import io
+import os
+import pytest
+from benchmark import STAGES, benchmark_problem, summarize
+from call_budget import configure_circuit_breakers
+from mock_llm import MockBackend, canned_response_dir
+from problem_context import base_dir
+from rate_limiter import DEFAULT_RATE_LIMIT_DIR, configure_rate_limits
+
+
+def _args(**changes) -> argparse.Namespace:
+    """benchmark.py's default arguments, with changes."""
+    args = dict(
+        delta=False, concurrency=8, batch_size=1, workers=1, output_format="frames", grid_check="override", no_context_cache=False,
+        cell_cache=False, deadline=0, max_calls=0, max_tokens=0, call_timeout=0,
+    )
+    args.update(changes)
+    return argparse.Namespace(**args)
+
+
+@pytest.fixture
+def run_benchmark(tmp_path):
+    configure_rate_limits(str(tmp_path / "rate_limits"))
+    configure_circuit_breakers()
+    destination_folder = os.path.relpath(tmp_path / "benchmark", base_dir)
+
+    def _run(domain_name: str, problem_name: str, **changes):
+        backend = MockBackend(canned_dir=canned_response_dir(domain_name, problem_name))
+        with contextlib.redirect_stdout(io.StringIO()):
+            return benchmark_problem(backend, destination_folder, domain_name, problem_name, _args(**changes))
+    yield _run
+    configure_rate_limits(DEFAULT_RATE_LIMIT_DIR)
+
+
+@pytest.mark.parametrize("domain_name, problem_name", [("foodtruck", "foodtruck_1"), ("dkg_single", "dkg_single_1"), ("mdkg", "mdkg_1")])
+@pytest.mark.parametrize("changes", [{}, {"delta": True}, {"batch_size": 4}, {"workers": 2}, {"output_format": "trajectory"}])
+def test_benchmark_problem(run_benchmark, domain_name, problem_name, changes):
+    result = run_benchmark(domain_name, problem_name, **changes)
+    assert result["status"] == "ok"
+    assert result["synthesis_attempts"] == 1
+    assert result["stages"]["problem"]["calls"] > 0
+    summary = summarize([result])
+    assert set(summary) == set(STAGES) | {"total"}
+    assert summary["total"]["calls"] == sum(stage["calls"] for stage in result["stages"].values())
+
+
+def test_benchmark_problem_reports_an_exceeded_budget(run_benchmark):
+    result = run_benchmark("foodtruck", "foodtruck_1", max_calls=3)
+    assert result["status"].startswith("BudgetExceeded")
+    assert result["budget"]["calls"] == 3
+
+
+def test_generic_objects_declared_after_frame_zero(mock_problem):
+    # foodtruck_1 has no generic objects in frame 0, so a later frame declares them
+    generate = mock_problem("foodtruck", "foodtruck_1")
+    serial = generate(stream=False)
+    assert "(:objects" not in serial["frame_0.pddl"]
+    assert any("(:objects" in text for text in serial.values())
+    assert generate() == serial
+    assert generate(workers=2) == serial
+    assert generate(delta=True, workers=2) == serial
@@ -0,0 +1,84 @@
+import threading
+import time
+import pytest
+import call_budget
+from call_budget import BudgetExceeded, CallBudget, CircuitBreaker, CircuitOpen
+
+
+def test_call_budget_limits_calls_and_tokens():
+    budget = CallBudget(max_calls=2, max_tokens=100)
+    budget.check()
+    budget.record_call()
+    budget.record_tokens(60)
+    budget.check()
+    budget.record_call()
+    with pytest.raises(BudgetExceeded, match="2 of 2 model calls"):
+        budget.check()
+    assert budget.summary()["exceeded"] == "2 of 2 model calls used"
+
+    budget = CallBudget(max_tokens=100)
+    budget.record_tokens(100)
+    with pytest.raises(BudgetExceeded, match="tokens"):
+        budget.check()
+
+
+def test_call_budget_deadline_bounds_the_call_timeout():
+    assert CallBudget().call_timeout() is None
+    assert CallBudget(call_timeout_seconds=120).call_timeout() == 120
+    assert CallBudget(deadline_seconds=30, call_timeout_seconds=120).call_timeout() <= 30
+    budget = CallBudget(deadline_seconds=0.01)
+    time.sleep(0.02)
+    assert budget.call_timeout() == 0.0
+    with pytest.raises(BudgetExceeded, match="deadline"):
+        budget.check()
+
+
+def test_circuit_breaker_opens_after_consecutive_failures():
+    breaker = CircuitBreaker("test-model", failure_threshold=3, cooldown_seconds=0.05)
+    breaker.record_failure()
+    breaker.record_failure()
+    breaker.record_success()
+    breaker.record_failure()
+    breaker.record_failure()
+    breaker.before_call()
+    breaker.record_failure()
+    with pytest.raises(CircuitOpen):
+        breaker.before_call()
+
+    # After the cooldown calls go through again; another failure reopens the circuit right away
+    time.sleep(0.06)
+    breaker.before_call()
+    breaker.record_failure()
+    with pytest.raises(CircuitOpen):
+        breaker.before_call()
+    time.sleep(0.06)
+    breaker.record_success()
+    breaker.record_failure()
+    breaker.before_call()
+
+
+def test_circuit_breaker_registry_creates_one_breaker_per_model(monkeypatch):
+    class SlowCircuitBreaker(CircuitBreaker):
+        def __init__(self, *args, **kwargs):
+            # Widens the window in which an unguarded registry creates a second breaker
+            time.sleep(0.01)
+            super().__init__(*args, **kwargs)
+    monkeypatch.setattr(call_budget, "CircuitBreaker", SlowCircuitBreaker)
+    call_budget.configure_circuit_breakers()
+
+    barrier = threading.Barrier(8)
+    breakers = []
+
+    def _get():
+        barrier.wait()
+        breakers.append(call_budget.circuit_breaker("registry-model"))
+    threads = [threading.Thread(target=_get) for _ in range(8)]
+    try:
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert len(breakers) == 8
+        assert all(breaker is breakers[0] for breaker in breakers)
+    finally:
+        call_budget.configure_circuit_breakers()
@@ -0,0 +1,60 @@
+import json
+import shutil
+from cell_cache import CellClassificationCache
+from problem_context import ProblemContext, base_dir
+from segment_cells import classification_context_hash
+
+
+def _context(tmp_path, name: str, description: str, **objects_changes) -> ProblemContext:
+    """foodtruck_1's synthesized objects.json and domain.pddl, with objects.json fields replaced."""
+    problem_dir = tmp_path / name
+    problem_dir.mkdir()
+    shutil.copy(f"{base_dir}/temp/foodtruck/foodtruck_1/domain.pddl", problem_dir / "domain.pddl")
+    with open(f"{base_dir}/temp/foodtruck/foodtruck_1/objects.json", "r") as f:
+        objects = json.load(f)
+    objects.update(objects_changes)
+    (problem_dir / "objects.json").write_text(json.dumps(objects))
+    (problem_dir / "description.txt").write_text(description)
+
+    context = ProblemContext("temp", "foodtruck", name)
+    context.objects_path = str(problem_dir / "objects.json")
+    context.domain_path = str(problem_dir / "domain.pddl")
+    context.description_path = str(problem_dir / "description.txt")
+    return context
+
+
+def test_context_hash_is_shared_by_problems_with_the_same_vocabulary(tmp_path):
+    context = _context(tmp_path, "a", "The student walks to the korean truck.")
+    other_problem = _context(
+        tmp_path, "b", "The student walks past the mexican truck.",
+        unique_objects=["lebanesetruck", "mexicantruck", "koreantruck"],
+        obj_str="(:objects\nparkinglot1 - parkinglot\n)\n",
+    )
+    assert classification_context_hash(context, 0.2) == classification_context_hash(other_problem, 0.2)
+
+
+def test_context_hash_changes_with_vocabulary_and_settings(tmp_path):
+    context = _context(tmp_path, "a", "")
+    context_hash = classification_context_hash(context, 0.2)
+    assert classification_context_hash(_context(tmp_path, "b", "", background_cells=["building", "whitespace", "road"]), 0.2) != context_hash
+    assert classification_context_hash(context, 1.0) != context_hash
+    assert classification_context_hash(context, 0.2, batch_size=4) != context_hash
+
+
+def test_cell_cache_is_keyed_by_context_hash(tmp_path):
+    cache = CellClassificationCache(str(tmp_path / "cells.sqlite"))
+    cache.put("cellkey", "foodtruck", "hash1", {"type": "building", "objects": [], "object_pddl_str": ""})
+    assert cache.get("cellkey", "foodtruck", "hash1") == {"type": "building", "objects": [], "object_pddl_str": ""}
+    assert cache.get("cellkey", "foodtruck", "hash2") is None
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_cell_cache_evicts_least_recently_used(tmp_path):
+    cache = CellClassificationCache(str(tmp_path / "cells.sqlite"), max_entries=2)
+    for key in ("a", "b"):
+        cache.put(key, "foodtruck", "hash", {"type": key})
+    cache.get("a", "foodtruck", "hash")
+    cache.put("c", "foodtruck", "hash", {"type": "c"})
+    assert cache.get("b", "foodtruck", "hash") is None
+    assert cache.get("a", "foodtruck", "hash") == {"type": "a"}
+    assert cache.get("c", "foodtruck", "hash") == {"type": "c"}
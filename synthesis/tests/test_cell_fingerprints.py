@@ -0,0 +1,36 @@
+import numpy as np
+from cell_fingerprints import CellFingerprintIndex, exact_cell_hashes, perceptual_cell_hashes
+
+
+def _cells(*colors, shift: int = 0) -> np.ndarray:
+    """Cells of the given colors, all shaded by the same horizontal gradient."""
+    gradient = np.linspace(-30, 30, 24)[None, :, None]
+    return np.stack([np.broadcast_to(np.clip(gradient + np.array(color) + shift, 0, 255), (24, 24, 3)) for color in colors]).astype(np.uint8)
+
+
+def test_exact_cell_hashes():
+    cells = _cells((100, 100, 100), (100, 100, 100), (20, 200, 20))
+    hashes = exact_cell_hashes(cells)
+    assert hashes[0] == hashes[1] != hashes[2]
+    assert exact_cell_hashes(cells[:0]) == []
+
+
+def test_perceptual_hash_of_flat_cells_ignores_their_color():
+    flat_cells = np.stack([np.full((24, 24, 3), level, dtype=np.uint8) for level in (30, 77, 200)])
+    assert len(set(perceptual_cell_hashes(flat_cells))) == 1
+    assert perceptual_cell_hashes(_cells((100, 100, 100))) != perceptual_cell_hashes(flat_cells[:1])
+
+
+def test_fingerprint_index_merges_near_duplicates():
+    index = CellFingerprintIndex()
+    cells = _cells((100, 100, 100), (20, 200, 20))
+    # A slightly brighter tile: another exact hash, but the same perceptual hash and nearly the same color
+    near_duplicate = _cells((100, 100, 100), shift=3)
+    assert exact_cell_hashes(near_duplicate) != exact_cell_hashes(cells[:1])
+
+    keys = index.assign(cells)
+    # Same shading, different color: kept apart by the color tolerance
+    assert keys[0] != keys[1]
+    assert index.assign(near_duplicate) == [keys[0]]
+    assert index.assign(cells[::-1]) == keys[::-1]
+    assert len(index) == 2
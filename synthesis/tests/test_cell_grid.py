@@ -0,0 +1,68 @@
+import numpy as np
+from cell_grid import CellGrid, CellIndex, FrameStack
+from segment_cells import load_gif_by_frame_and_cells
+
+
+def _cells_by_key(grid: CellGrid):
+    """The (row, col) cells of every key id of a grid, in id and row-major order, the slow way."""
+    cells = {}
+    for (row, col), cell_id in np.ndenumerate(grid.ids):
+        cells.setdefault(int(cell_id), []).append((row, col))
+    return dict(sorted(cells.items()))
+
+
+def _frame_stack(num_frames: int, dim=(4, 5), num_keys: int = 6, seed: int = 0) -> FrameStack:
+    rng = np.random.default_rng(seed)
+    frame_stack = FrameStack(dim)
+    frame_stack.keys = [f"key{n}" for n in range(num_keys)]
+    for frame_idx in range(num_frames):
+        ids = rng.integers(0, num_keys, dim)
+        frame_stack.append(CellGrid(frame_idx, np.zeros(dim), np.zeros(dim), ids))
+    return frame_stack
+
+
+def test_cell_index_groups_cells_by_key():
+    frame_stack = _frame_stack(7)
+    for frame_idx in range(7):
+        cells_by_key = frame_stack.cells_by_key(frame_idx)
+        assert cells_by_key == _cells_by_key(frame_stack[frame_idx])
+        assert list(cells_by_key) == sorted(cells_by_key)
+
+
+def test_cell_index_of_stimulus(stimulus_gif):
+    _, frame_stack = load_gif_by_frame_and_cells(stimulus_gif("dkg_single", "dkg_single_1"), (10, 12))
+    for frame_idx in range(len(frame_stack)):
+        assert frame_stack.cells_by_key(frame_idx) == _cells_by_key(frame_stack[frame_idx])
+
+
+def test_cell_index_is_rebuilt_after_append():
+    frame_stack = _frame_stack(3)
+    cell_index = frame_stack.cell_index()
+    assert frame_stack.cell_index() is cell_index
+    frame_stack.append(CellGrid(3, np.zeros((4, 5)), np.zeros((4, 5)), np.zeros((4, 5))))
+    assert frame_stack.cell_index() is not cell_index
+    assert frame_stack.cells_by_key(3) == {0: [(row, col) for row in range(4) for col in range(5)]}
+
+
+def test_cell_index_of_windowed_stack():
+    frame_stack = _frame_stack(6)
+    windowed = FrameStack(frame_stack.dim, window=2)
+    windowed.keys = frame_stack.keys
+    for grid in frame_stack.grids:
+        windowed.append(grid)
+    assert windowed.first_frame_idx == 4
+    assert windowed.cells_by_key(5) == _cells_by_key(frame_stack[5])
+
+
+def test_empty_cell_index():
+    assert CellIndex([]).num_frames == 0
+
+
+def test_slice_shares_keys_and_frame_numbers():
+    frame_stack = _frame_stack(8)
+    part = frame_stack.slice(3, 6)
+    assert part.keys is frame_stack.keys
+    assert (part.first_frame_idx, len(part)) == (3, 6)
+    for frame_idx in range(3, 6):
+        assert part[frame_idx] is frame_stack[frame_idx]
+        assert part.cells_by_key(frame_idx) == frame_stack.cells_by_key(frame_idx)
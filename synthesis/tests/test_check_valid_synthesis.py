@@ -0,0 +1,45 @@
+import os
+import shutil
+import pytest
+from problem_context import ProblemContext, base_dir
+from utils import check_valid_synthesis
+
+
+@pytest.fixture
+def foodtruck_synthesis(tmp_path, capsys):
+    """A copy of foodtruck_1's synthesized files; check(domain_changes) rewrites domain.pddl and checks it."""
+    destination_folder = os.path.relpath(tmp_path, base_dir)
+    shutil.copytree(f"{base_dir}/temp/foodtruck/foodtruck_1", tmp_path / "foodtruck" / "foodtruck_1")
+    domain_path = tmp_path / "foodtruck" / "foodtruck_1" / "domain.pddl"
+    domain = domain_path.read_text()
+
+    def _check(*domain_changes) -> bool:
+        changed = domain
+        for old, new in domain_changes:
+            assert old in changed
+            changed = changed.replace(old, new)
+        domain_path.write_text(changed)
+        valid = check_valid_synthesis(destination_folder, "foodtruck", "foodtruck_1", context=ProblemContext(destination_folder, "foodtruck", "foodtruck_1"))
+        capsys.readouterr()
+        return valid
+    return _check
+
+
+def test_stored_synthesis_is_valid(foodtruck_synthesis):
+    assert foodtruck_synthesis()
+
+
+def test_agent_declared_as_constant_is_valid(foodtruck_synthesis):
+    assert foodtruck_synthesis(("item agent - object", "item robot - object"), ("student - agent", "agent - robot"))
+
+
+def test_undeclared_agent_is_invalid(foodtruck_synthesis):
+    assert not foodtruck_synthesis(("item agent - object", "item robot - object"), ("student - agent", "student - robot"))
+
+
+def test_unparsable_domain_is_invalid(foodtruck_synthesis):
+    assert not foodtruck_synthesis(("(:requirements", "((:requirements"))
+
+
+def test_undeclared_belief_container_is_invalid(foodtruck_synthesis):
+    assert not foodtruck_synthesis(("foodtruck parkinglot  - item", "foodtruck  - item"))
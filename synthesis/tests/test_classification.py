@@ -0,0 +1,93 @@
+import asyncio
+import contextlib
+import io
+import json
+import pytest
+from mock_llm import MockBackend
+from segment_cells import _parse_batch_response, classify_unique_cells, close_classification_loop, load_gif_by_frame_and_cells
+
+
+@pytest.mark.parametrize("domain_name, problem_name", [("dkg_single", "dkg_single_1"), ("mdkg", "mdkg_1")])
+def test_concurrent_classification_matches_serial_classification(mock_problem, domain_name, problem_name):
+    generate = mock_problem(domain_name, problem_name)
+    backend = generate.client.client.backend
+
+    def _calls(**kwargs):
+        calls = backend.snapshot()["calls"]
+        outputs = generate(**kwargs)
+        return outputs, backend.snapshot()["calls"] - calls
+
+    serial = _calls(stream=False)
+    assert _calls(stream=False, concurrency=4) == serial
+    assert _calls(concurrency=4) == serial
+
+
+def test_classification_on_a_shared_loop(mock_problem, stimulus_gif):
+    generate = mock_problem("mdkg", "mdkg_1")
+    generate(stream=False)
+    frames_cells, frame_stack = load_gif_by_frame_and_cells(stimulus_gif("mdkg", "mdkg_1"), generate.context.config["grid_size"])
+    cell_ids = list(range(len(frame_stack.keys)))
+    assert len(cell_ids) > 2
+
+    def _classify(**kwargs):
+        with contextlib.redirect_stdout(io.StringIO()):
+            return classify_unique_cells(generate.client, None, frame_stack, frames_cells, "mdkg", "mdkg_1", [], context=generate.context, **kwargs)
+
+    serial = _classify()
+    assert _classify(concurrency=4) == serial
+
+    loop = asyncio.new_event_loop()
+    try:
+        shared = _classify(cell_ids=cell_ids[:2], concurrency=4, loop=loop)
+        shared.update(_classify(cell_ids=cell_ids[2:], concurrency=4, loop=loop))
+        # The loop stays open for the caller, with the client it opened for the first call
+        assert not loop.is_closed()
+        assert generate.client.aio() is generate.client.aio()
+    finally:
+        close_classification_loop(generate.client, loop)
+    assert loop.is_closed()
+    assert shared == serial
+
+
+def test_parse_batch_response_keeps_complete_entries_of_requested_cells():
+    response = "```json\n" + json.dumps([
+        {"cell_id": 3, "cell_type": "road"},
+        {"cell_id": "5", "cell_type": "building"},
+        {"cell_id": 7},
+        {"cell_id": 9, "cell_type": "road"},
+        {"cell_id": "x", "cell_type": "road"},
+        {"cell_type": "road"},
+        "road",
+    ]) + "\n```"
+    parsed = _parse_batch_response(response, [3, 5, 7], ("cell_type",))
+    assert parsed == {3: {"cell_id": 3, "cell_type": "road"}, 5: {"cell_id": "5", "cell_type": "building"}}
+
+
+@pytest.mark.parametrize("response", ['[{"cell_id": 3, "cell_type": "ro', '{"cell_id": 3, "cell_type": "road"}', "", "null"])
+def test_parse_batch_response_of_malformed_batches_is_empty(response):
+    assert _parse_batch_response(response, [3], ("cell_type",)) == {}
+
+
+@pytest.mark.parametrize("domain_name, problem_name", [("dkg_single", "dkg_single_1"), ("mdkg", "mdkg_1")])
+def test_batched_classification_matches_serial_classification(mock_problem, domain_name, problem_name):
+    generate = mock_problem(domain_name, problem_name)
+    serial = generate(stream=False)
+    assert generate(stream=False, batch_size=4) == serial
+    assert generate(batch_size=4, concurrency=2) == serial
+
+
+@pytest.mark.parametrize("damage", ["drop", "truncate"])
+def test_cells_left_out_of_a_batch_are_classified_one_at_a_time(mock_problem, monkeypatch, damage):
+    generate = mock_problem("mdkg", "mdkg_1")
+    serial = generate(stream=False)
+    cell_responses = MockBackend._cell_responses
+
+    def _damaged_cell_responses(contents, respond):
+        text = cell_responses(contents, respond)
+        if len(contents) == 2:
+            return text
+        if damage == "truncate":
+            return text[:len(text) // 2]
+        return json.dumps(json.loads(text)[1:])
+    monkeypatch.setattr(MockBackend, "_cell_responses", staticmethod(_damaged_cell_responses))
+    assert generate(stream=False, batch_size=4) == serial
@@ -0,0 +1,29 @@
+import numpy as np
+from compare_frame_encodings import compare_problem, literal_encode_frame_pddl
+from pddl_problem import parse_sexprs
+from segment_cells import bit_matrix_literal, bit_matrix_term
+
+
+def test_bit_matrix_literal_round_trip():
+    matrix = np.array([[True, False, False], [False, True, True]])
+    (term,) = parse_sexprs(bit_matrix_literal(matrix))
+    assert term == bit_matrix_term(matrix)
+    # bit-mat stacks its bit-vecs as columns, so the literal transposes the rows
+    assert term == ("transpose", ("bit-mat", ("bit-vec", "1", "0", "0"), ("bit-vec", "0", "1", "1")))
+
+
+def test_literal_rewrite_matches_literal_encoding(tmp_path, mock_problem):
+    generate = mock_problem("dkg_single", "dkg_single_1")
+    set_index_frames = generate(bit_matrix_encoding="set-index")
+    literal_frames = generate(bit_matrix_encoding="literal")
+    assert set_index_frames.keys() == literal_frames.keys()
+    for name, pddl_str in set_index_frames.items():
+        assert "set-index" in pddl_str
+        assert literal_encode_frame_pddl(pddl_str) == literal_frames[name]
+
+    for name, pddl_str in set_index_frames.items():
+        (tmp_path / name).write_text(pddl_str)
+    num_frames, set_index_stats, literal_stats = compare_problem(str(tmp_path), repeats=1)
+    assert num_frames == len(set_index_frames)
+    assert literal_stats["bytes"] < set_index_stats["bytes"]
+    assert literal_stats["lines"] < set_index_stats["lines"]
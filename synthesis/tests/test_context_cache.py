@@ -0,0 +1,113 @@
+import asyncio
+import contextlib
+import io
+import time
+import pytest
+import context_cache
+from context_cache import ContextCache
+from llm_providers import GeminiProvider
+from mock_llm import MockBackend, MockGeminiClient
+from rate_limiter import DEFAULT_RATE_LIMIT_DIR, configure_rate_limits
+
+MODEL = "gemini-2.0-flash"
+PREFIX = ["Classify the cell. The domain declares these cell types: building, road."]
+
+
+@pytest.fixture
+def client(monkeypatch):
+    # The mock caches prefixes of any length
+    monkeypatch.setattr(context_cache, "MIN_CACHED_TOKENS", 0)
+    return MockGeminiClient(MockBackend())
+
+
+def _lookup(cache: ContextCache, prefix=PREFIX):
+    with contextlib.redirect_stdout(io.StringIO()):
+        return cache.lookup(MODEL, prefix)
+
+
+def test_prefix_is_uploaded_once(client):
+    cache = ContextCache(client)
+    cached = _lookup(cache)
+    assert cached is not None and cached.model == context_cache.CACHED_MODEL_VERSIONS[MODEL]
+    assert _lookup(cache) is cached
+    assert _lookup(cache, PREFIX + ["more"]) is not cached
+    assert len(client.caches._cached) == 2
+
+
+def test_refresh_deletes_the_replaced_upload(client):
+    cache = ContextCache(client)
+    cached = _lookup(cache)
+    cached.expires = time.monotonic() + context_cache.CONTEXT_CACHE_REFRESH_SECONDS / 2
+    refreshed = _lookup(cache)
+    assert refreshed is not cached
+    assert list(client.caches._cached) == [refreshed.name]
+
+
+def test_discard_of_a_replaced_upload_is_ignored(client):
+    cache = ContextCache(client)
+    cached = _lookup(cache)
+    cached.expires = time.monotonic()
+    refreshed = _lookup(cache)
+    cache.discard(MODEL, PREFIX, cached)
+    assert _lookup(cache) is refreshed
+    cache.discard(MODEL, PREFIX, refreshed)
+    # A rejected prefix is sent inline from then on
+    assert _lookup(cache) is None
+    assert len(client.caches._cached) == 1
+
+
+def test_concurrent_lookups_share_one_upload(client):
+    cache = ContextCache(client)
+
+    async def _lookups():
+        return await asyncio.gather(*[cache.lookup_async(MODEL, PREFIX) for _ in range(8)])
+    with contextlib.redirect_stdout(io.StringIO()):
+        uploads = asyncio.run(_lookups())
+    assert uploads[0] is not None
+    assert all(cached is uploads[0] for cached in uploads)
+    assert client.caches._created == 1
+
+
+def test_short_prefix_and_disabled_cache_send_the_prefix_inline(client, monkeypatch):
+    monkeypatch.setattr(context_cache, "MIN_CACHED_TOKENS", 1024)
+    assert _lookup(ContextCache(client)) is None
+    monkeypatch.setattr(context_cache, "MIN_CACHED_TOKENS", 0)
+    assert _lookup(ContextCache(client, enabled=False)) is None
+    assert client.caches._created == 0
+
+
+def test_failed_upload_is_not_tried_again(client, monkeypatch):
+    cache = ContextCache(client)
+
+    def _create(model, config=None):
+        raise RuntimeError("caching unavailable")
+    monkeypatch.setattr(client.caches, "create", _create)
+    assert _lookup(cache) is None
+    monkeypatch.undo()
+    assert _lookup(cache) is None
+
+
+def test_close_deletes_the_uploads(client):
+    cache = ContextCache(client)
+    _lookup(cache)
+    _lookup(cache, PREFIX + ["more"])
+    cache.close()
+    assert client.caches._cached == {}
+
+
+def test_rejected_upload_is_replaced_by_the_inline_prefix(client, tmp_path):
+    configure_rate_limits(str(tmp_path))
+    provider = GeminiProvider(client=client)
+    contents = PREFIX + ["Cell (1, 1)."]
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            expected = provider.generate(MODEL, contents).text
+            assert provider.generate(MODEL, contents, cache_prefix=1).text == expected
+            (cached_name,) = client.caches._cached
+            # The cached content expires early: the request is sent inline and the prefix is not cached again
+            client.caches.delete(cached_name)
+            assert provider.generate(MODEL, contents, cache_prefix=1).text == expected
+            assert provider.context_cache.lookup(MODEL, PREFIX) is None
+    finally:
+        provider.close()
+        configure_rate_limits(DEFAULT_RATE_LIMIT_DIR)
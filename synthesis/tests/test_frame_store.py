@@ -0,0 +1,51 @@
+import json
+import os
+import numpy as np
+from PIL import Image, ImageSequence
+from frame_store import FRAME_STORE_VERSION, frame_store_paths, is_frame_store_fresh, load_frames, read_frame_store_header
+
+
+def test_frame_store_round_trip(stimulus_gif):
+    gif_path = stimulus_gif("foodtruck", "foodtruck_1")
+    assert not is_frame_store_fresh(gif_path)
+    frames = load_frames(gif_path)
+    assert is_frame_store_fresh(gif_path)
+    assert not frames.flags.writeable
+
+    with Image.open(gif_path) as gif:
+        decoded = [np.asarray(frame.convert("RGB")) for frame in ImageSequence.Iterator(gif)]
+    assert frames.shape == (len(decoded),) + decoded[0].shape
+    for frame_array, decoded_frame in zip(frames, decoded):
+        np.testing.assert_array_equal(frame_array, decoded_frame)
+
+    header = read_frame_store_header(gif_path)
+    assert header["version"] == FRAME_STORE_VERSION
+    assert (header["num_frames"], header["height"], header["width"]) == frames.shape[:3]
+    assert len(header["durations"]) == len(decoded)
+
+
+def test_frame_store_is_rebuilt_when_stale(stimulus_gif):
+    gif_path = stimulus_gif("foodtruck", "foodtruck_1")
+    load_frames(gif_path)
+    npy_path, meta_path = frame_store_paths(gif_path)
+
+    # A GIF replaced after its store was written
+    stat = os.stat(gif_path)
+    os.utime(gif_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+    assert not is_frame_store_fresh(gif_path)
+    load_frames(gif_path)
+    assert is_frame_store_fresh(gif_path)
+
+    # A store written by another version of the format
+    header = read_frame_store_header(gif_path)
+    with open(meta_path, "w") as f:
+        json.dump({**header, "version": FRAME_STORE_VERSION + 1}, f)
+    assert not is_frame_store_fresh(gif_path)
+
+    # A truncated header
+    with open(meta_path, "w") as f:
+        f.write("{")
+    assert not is_frame_store_fresh(gif_path)
+    assert load_frames(gif_path).shape[0] == header["num_frames"]
+    assert is_frame_store_fresh(gif_path)
+    assert os.path.exists(npy_path)
@@ -0,0 +1,40 @@
+import numpy as np
+import pytest
+from frame_store import load_frames
+from grid_detection import check_grid_size, detect_grid_size
+
+
+def _grid_frame(rows: int, cols: int, cell_px: int) -> np.ndarray:
+    """A gridworld frame: light cells separated by dark gridlines, one cell filled."""
+    frame = np.full((rows * cell_px, cols * cell_px, 3), 230, dtype=np.uint8)
+    frame[::cell_px] = 40
+    frame[:, ::cell_px] = 40
+    frame[cell_px + 4:2 * cell_px - 4, 2 * cell_px + 4:3 * cell_px - 4] = (200, 30, 30)
+    return frame
+
+
+def test_detect_grid_size_of_drawn_grid():
+    assert detect_grid_size(_grid_frame(5, 7, 40)[None]) == (5, 7)
+
+
+def test_detect_grid_size_of_flat_frame_is_inconclusive():
+    assert detect_grid_size(np.full((1, 200, 300, 3), 128, dtype=np.uint8)) is None
+
+
+@pytest.mark.parametrize("domain_name, problem_name, dim", [
+    ("dkg_single", "dkg_single_1", (10, 12)),
+    ("foodtruck", "foodtruck_1", (5, 15)),
+    ("astronaut", "astronaut_1", (7, 7)),
+])
+def test_detect_grid_size_of_stimulus(stimulus_gif, domain_name, problem_name, dim):
+    assert detect_grid_size(load_frames(stimulus_gif(domain_name, problem_name))) == dim
+
+
+def test_check_grid_size_modes(stimulus_gif):
+    gif_path = stimulus_gif("dkg_single", "dkg_single_1")
+    assert check_grid_size(gif_path, [8, 8], mode="override") == [10, 12]
+    assert check_grid_size(gif_path, [8, 8], mode="validate") == [8, 8]
+    assert check_grid_size(gif_path, [8, 8], mode="off") == [8, 8]
+    assert check_grid_size(gif_path, [10, 12], mode="override") == [10, 12]
+    with pytest.raises(ValueError):
+        check_grid_size(gif_path, [8, 8], mode="guess")
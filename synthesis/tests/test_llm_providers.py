@@ -0,0 +1,53 @@
+import asyncio
+from llm_providers import GeminiProvider, gemini_provider
+from mock_llm import MockBackend, MockGeminiClient
+
+
+def test_event_loop_reuses_its_client():
+    provider = GeminiProvider(api_key="test-key", context_caching=False)
+
+    async def _clients():
+        first = provider.aio()
+        second = provider.aio()
+        loop_http_client = provider._loop_clients[asyncio.get_running_loop()][1]
+        await provider.aclose()
+        return first, second, loop_http_client
+    first, second, loop_http_client = asyncio.run(_clients())
+    assert first is second
+    # aclose closed the loop's connections and forgot its client
+    assert loop_http_client.is_closed
+    assert provider._loop_clients == {}
+
+
+def test_event_loops_get_clients_of_their_own():
+    provider = GeminiProvider(api_key="test-key", context_caching=False)
+
+    async def _client():
+        return provider.aio()
+    loop = asyncio.new_event_loop()
+    other_loop = asyncio.new_event_loop()
+    try:
+        client = loop.run_until_complete(_client())
+        assert other_loop.run_until_complete(_client()) is not client
+        assert loop.run_until_complete(_client()) is client
+        assert set(provider._loop_clients) == {loop, other_loop}
+    finally:
+        other_loop.run_until_complete(provider.aclose())
+        other_loop.close()
+        loop.close()
+    # The client of a loop closed without aclose is dropped when another loop asks for one
+    asyncio.run(_client())
+    assert loop not in provider._loop_clients
+
+
+def test_wrapped_client_is_shared_by_every_loop():
+    client = MockGeminiClient(MockBackend())
+    provider = gemini_provider(client)
+    assert gemini_provider(client) is provider
+    assert gemini_provider(provider) is provider
+
+    async def _client():
+        return provider.aio()
+    assert asyncio.run(_client()) is client.aio
+    assert asyncio.run(_client()) is client.aio
+    assert provider._loop_clients == {}
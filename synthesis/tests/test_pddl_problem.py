@@ -0,0 +1,62 @@
+import pytest
+from pddl_problem import CellTemplate, PDDLProblem, cell_template, group_objects, parse_objects, parse_sexprs, serialize_objects, serialize_term
+
+
+def test_sexprs_round_trip():
+    text = "(= (xloc student) 3) (at student parkinglot2) (= (building) (transpose (bit-mat (bit-vec 0 1) (bit-vec 1 0))))"
+    terms = parse_sexprs(text)
+    assert terms[0] == ("=", ("xloc", "student"), "3")
+    assert terms[2][2] == ("transpose", ("bit-mat", ("bit-vec", "0", "1"), ("bit-vec", "1", "0")))
+    assert " ".join(serialize_term(term) for term in terms) == text
+    assert parse_sexprs(" ".join(serialize_term(term) for term in terms)) == terms
+
+
+def test_parse_sexprs_skips_comments_and_whitespace():
+    assert parse_sexprs("(at  a\n b) ; (not this)\n(c)") == [("at", "a", "b"), ("c",)]
+
+
+@pytest.mark.parametrize("text", ["(at a b", "(at a b))", ")"])
+def test_parse_sexprs_rejects_unbalanced(text):
+    with pytest.raises(ValueError):
+        parse_sexprs(text)
+
+
+def test_objects_round_trip():
+    objects = group_objects(["parkinglot10", "parkinglot2", "koreantruck", "parkinglot1", "parkinglot2"])
+    assert objects == {"parkinglot": ["parkinglot1", "parkinglot2", "parkinglot10"], "koreantruck": ["koreantruck"]}
+    assert parse_objects(serialize_objects(objects)) == objects
+    assert parse_objects("(:objects\nparkinglot1 parkinglot2 - parkinglot\n)\n") == {"parkinglot": ["parkinglot1", "parkinglot2"]}
+    assert parse_objects("(:objects a b)") == {"object": ["a", "b"]}
+
+
+def test_problem_serialize_round_trip():
+    init = [("=", ("gridheight",), "5"), ("at", "student", "parkinglot1"), ("=", ("xloc", "student"), "2")]
+    problem = PDDLProblem("foodtruck_1", "foodtruck", objects={"parkinglot": ["parkinglot1"]}, init=init)
+    (define,) = parse_sexprs(problem.serialize())
+    assert define[:3] == ("define", ("problem", "foodtruck_1"), (":domain", "foodtruck"))
+    assert define[3] == (":objects", "parkinglot1", "-", "parkinglot")
+    assert define[4] == (":init",) + tuple(init)
+    assert define[5] == (":goal", ("true",))
+
+
+def test_cell_template_instantiates_slots_and_renames():
+    template = CellTemplate("(= (xloc parkinglot) $j) (= (yloc parkinglot) $i) (at student parkinglot)")
+    assert template.raw is None
+    assert template.instantiate(1, 4, {"parkinglot": "parkinglot2"}) == (
+        ("=", ("xloc", "parkinglot2"), "5"),
+        ("=", ("yloc", "parkinglot2"), "2"),
+        ("at", "student", "parkinglot2"),
+    )
+    assert template.instantiate(0, 0)[0] == ("=", ("xloc", "parkinglot"), "1")
+
+
+def test_cell_template_keeps_unparsable_text():
+    template = CellTemplate("(= (xloc parkinglot) $j) (= (yloc parkinglot) $i")
+    assert template.facts == ()
+    assert template.instantiate(2, 3, {"parkinglot": "parkinglot1"}) == ("(= (xloc parkinglot1) 4) (= (yloc parkinglot1) 3",)
+    # Only whole atoms are substituted
+    assert CellTemplate("(at $i $ij").instantiate(0, 0) == ("(at 1 $ij",)
+
+
+def test_cell_template_is_shared():
+    assert cell_template("(at student $i $j)") is cell_template("(at student $i $j)")
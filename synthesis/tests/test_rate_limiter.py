@@ -0,0 +1,165 @@
+import asyncio
+import threading
+import time
+import pytest
+import rate_limiter as rate_limiter_module
+from llm_providers import GeminiProvider, RetryPolicy, _Attempts
+from mock_llm import MockBackend, MockGeminiClient
+from rate_limiter import CallSlot, IMAGE_TOKENS, INITIAL_BACKOFF_SECONDS, POLL_SECONDS, RateLimiter, _bucket_wait, estimate_tokens, retry_after_seconds
+
+
+class RateLimitError(Exception):
+    code = 429
+
+
+def _limiter(tmp_path, requests_per_minute=600, tokens_per_minute=60_000, **kwargs) -> RateLimiter:
+    return RateLimiter("test-model", requests_per_minute, tokens_per_minute, state_dir=str(tmp_path), **kwargs)
+
+
+def test_bucket_wait():
+    assert _bucket_wait(5, 1, 60) == 0.0
+    assert _bucket_wait(0, 1, 60) == pytest.approx(1.0)
+    assert _bucket_wait(100, 400, 600) == pytest.approx(30.0)
+
+
+def test_estimate_tokens():
+    assert estimate_tokens("x" * 40) == 11
+    assert estimate_tokens(["x" * 40, b"image bytes"]) == 11 + IMAGE_TOKENS
+    assert estimate_tokens([{"role": "user", "content": [{"type": "text", "text": "x" * 40}, {"type": "image_url", "image_url": {"url": ""}}]}]) == 2 + 2 + 11 + IMAGE_TOKENS
+
+
+def test_retry_after_seconds():
+    assert retry_after_seconds(Exception("429 RESOURCE_EXHAUSTED {'retryDelay': '7s'}")) == 7.0
+    assert retry_after_seconds(Exception("429")) is None
+
+
+def test_requests_wait_for_the_bucket_to_refill(tmp_path):
+    limiter = _limiter(tmp_path, requests_per_minute=2, initial_concurrency=10)
+    assert limiter._try_acquire(1) == 0.0
+    assert limiter._try_acquire(1) == 0.0
+    assert limiter._try_acquire(1) == pytest.approx(30.0, abs=0.5)
+
+
+def test_tokens_wait_and_settle_against_usage(tmp_path):
+    limiter = _limiter(tmp_path, tokens_per_minute=600)
+    with limiter.slot(500) as slot:
+        slot.used_tokens = 100
+    # The 400 unused tokens went back into the bucket, leaving 500
+    assert limiter._try_acquire(500) == 0.0
+    assert limiter._try_acquire(100) == pytest.approx(10.0, abs=0.5)
+    # A request larger than the whole budget waits for a full bucket instead of forever
+    assert limiter._tokens_for(10_000) == 600
+
+
+def test_concurrency_is_limited(tmp_path):
+    limiter = _limiter(tmp_path, initial_concurrency=2)
+    assert limiter._try_acquire(1) == 0.0
+    assert limiter._try_acquire(1) == 0.0
+    assert limiter._try_acquire(1) == POLL_SECONDS
+
+
+def test_concurrency_grows_additively_and_halves_on_rate_limits(tmp_path):
+    limiter = _limiter(tmp_path, initial_concurrency=4)
+    with limiter.slot(1):
+        pass
+    assert limiter.concurrency_limit() == pytest.approx(4.25)
+
+    with pytest.raises(RateLimitError):
+        with limiter.slot(1):
+            raise RateLimitError("429")
+    assert limiter.concurrency_limit() == pytest.approx(2.125)
+    # The backoff has started: no call may start until it has passed
+    assert 0 < limiter._try_acquire(1) <= INITIAL_BACKOFF_SECONDS
+
+    # Calls in flight when the quota ran out do not halve the limit again
+    with limiter._state() as state:
+        state["in_flight"] = {}
+    limiter._release(CallSlot(1), False)
+    assert limiter.concurrency_limit() == pytest.approx(2.125)
+
+
+def test_rate_limit_honors_the_requested_delay(tmp_path):
+    limiter = _limiter(tmp_path)
+    limiter._release(CallSlot(1), False, retry_after=20.0)
+    assert limiter._try_acquire(1) == pytest.approx(20.0, abs=0.5)
+
+
+def test_concurrency_stays_within_bounds(tmp_path):
+    limiter = _limiter(tmp_path, max_concurrency=5, initial_concurrency=5)
+    limiter._release(CallSlot(1), True)
+    assert limiter.concurrency_limit() == 5
+    for _ in range(5):
+        with limiter._state() as state:
+            state["cooldown_until"] = 0.0
+        limiter._release(CallSlot(1), False)
+    assert limiter.concurrency_limit() == 1.0
+
+
+def test_slot_async_polls_the_state_off_the_event_loop(tmp_path, monkeypatch):
+    limiter = _limiter(tmp_path, initial_concurrency=1)
+    try_acquire = limiter._try_acquire
+    acquiring_threads = set()
+
+    def _try_acquire(tokens):
+        acquiring_threads.add(threading.get_ident())
+        return try_acquire(tokens)
+    monkeypatch.setattr(limiter, "_try_acquire", _try_acquire)
+
+    async def _call(seconds):
+        async with limiter.slot_async(1):
+            await asyncio.sleep(seconds)
+
+    async def _calls():
+        # The second call polls for the only slot while the first one holds it
+        await asyncio.gather(_call(0.1), _call(0))
+    asyncio.run(_calls())
+    assert len(acquiring_threads) >= 1
+    assert threading.get_ident() not in acquiring_threads
+    assert limiter._try_acquire(1) == 0.0
+
+
+def test_rate_limited_retries_are_bounded(tmp_path):
+    rate_limiter_module.configure_rate_limits(str(tmp_path))
+    try:
+        provider = GeminiProvider(client=MockGeminiClient(MockBackend()))
+        attempts = _Attempts(provider, "test-model", "prompt", None, RetryPolicy(max_rate_limited=3), None, None)
+        assert attempts.failed(RateLimitError("429")) == 0.0
+        assert attempts.failed(RateLimitError("429")) == 0.0
+        with pytest.raises(RateLimitError):
+            attempts.failed(RateLimitError("429"))
+        assert attempts.failures == 0
+
+        unbounded = _Attempts(provider, "test-model", "prompt", None, RetryPolicy(max_rate_limited=None), None, None)
+        for _ in range(50):
+            assert unbounded.failed(RateLimitError("429")) == 0.0
+        provider.close()
+    finally:
+        rate_limiter_module.configure_rate_limits(rate_limiter_module.DEFAULT_RATE_LIMIT_DIR)
+
+
+def test_rate_limiter_registry_creates_one_limiter_per_model(tmp_path, monkeypatch):
+    rate_limiter_module.configure_rate_limits(str(tmp_path))
+
+    class SlowRateLimiter(RateLimiter):
+        def __init__(self, *args, **kwargs):
+            # Widens the window in which an unguarded registry creates a second limiter
+            time.sleep(0.01)
+            super().__init__(*args, **kwargs)
+    monkeypatch.setattr(rate_limiter_module, "RateLimiter", SlowRateLimiter)
+
+    barrier = threading.Barrier(8)
+    limiters = []
+
+    def _get():
+        barrier.wait()
+        limiters.append(rate_limiter_module.rate_limiter("registry-model"))
+    threads = [threading.Thread(target=_get) for _ in range(8)]
+    try:
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert len(limiters) == 8
+        assert all(limiter is limiters[0] for limiter in limiters)
+    finally:
+        rate_limiter_module.configure_rate_limits(rate_limiter_module.DEFAULT_RATE_LIMIT_DIR)
@@ -0,0 +1,53 @@
+import pytest
+from google.genai import types
+from response_cache import ResponseCache, ResponseCacheMiss, request_hash
+
+MODEL = "gemini-2.0-flash"
+CONFIG = types.GenerateContentConfig(temperature=1.0)
+
+
+def test_identical_requests_get_consecutive_samples(tmp_path):
+    path = str(tmp_path / "responses.sqlite")
+    cache = ResponseCache("record", path)
+    first, second = cache.entry_key(MODEL, ["prompt"], CONFIG), cache.entry_key(MODEL, ["prompt"], CONFIG)
+    assert first[0] == second[0]
+    assert (first[1], second[1]) == (0, 1)
+    assert cache.entry_key(MODEL, ["other prompt"], CONFIG)[1] == 0
+    # An explicit sample does not advance the count
+    assert cache.entry_key(MODEL, ["prompt"], CONFIG, sample=5)[1] == 5
+    assert cache.entry_key(MODEL, ["prompt"], CONFIG)[1] == 2
+
+    assert cache.get(first) is None
+    cache.put(first, MODEL, "answer 0", tokens=10)
+    cache.put(second, MODEL, "answer 1", tokens=12)
+    assert (cache.hits, cache.misses) == (0, 1)
+    cache.close()
+
+    # A rerun asking the same questions in the same order gets the same answers back
+    replay = ResponseCache("replay", path)
+    assert replay.get(replay.entry_key(MODEL, ["prompt"], CONFIG)) == ("answer 0", 10)
+    assert replay.get(replay.entry_key(MODEL, ["prompt"], CONFIG)) == ("answer 1", 12)
+    with pytest.raises(ResponseCacheMiss):
+        replay.get(replay.entry_key(MODEL, ["prompt"], CONFIG))
+    replay.close()
+
+
+def test_off_cache_has_no_entries(tmp_path):
+    cache = ResponseCache("off", str(tmp_path / "responses.sqlite"))
+    assert cache.entry_key(MODEL, ["prompt"], CONFIG) is None
+    assert cache.get(None) is None
+    cache.put(None, MODEL, "answer")
+    assert not (tmp_path / "responses.sqlite").exists()
+
+
+def test_unknown_mode_is_rejected(tmp_path):
+    with pytest.raises(ValueError):
+        ResponseCache("write", str(tmp_path / "responses.sqlite"))
+
+
+def test_request_hash_ignores_formatting_and_transport_settings():
+    assert request_hash(MODEL, [" a\r\nb "], CONFIG) == request_hash(MODEL, ["a\nb"], CONFIG)
+    with_transport = types.GenerateContentConfig(temperature=1.0, http_options=types.HttpOptions(timeout=5000), cached_content="cachedContents/1")
+    assert request_hash(MODEL, ["a"], with_transport) == request_hash(MODEL, ["a"], CONFIG)
+    assert request_hash(MODEL, ["a"], CONFIG) != request_hash(MODEL, ["a"], types.GenerateContentConfig(temperature=0.2))
+    assert request_hash(MODEL, [b"image"], None) != request_hash(MODEL, [b"other image"], None)
@@ -0,0 +1,92 @@
+import numpy as np
+import pytest
+from cell_grid import OBJECT_STD_THRESHOLD, FrameStack
+from frame_store import load_frames
+from segment_cells import ENGINE_MEAN_TOLERANCE, ENGINE_STD_TOLERANCE, CellThumbnails, _segment_frame_numpy, _segment_frame_pil, changed_cell_mask, iter_gif_frames_and_cells, load_gif_by_frame_and_cells, segment_frame_array
+
+
+@pytest.mark.parametrize("domain_name, problem_name, dim", [
+    ("dkg_single", "dkg_single_1", (10, 12)),
+    ("foodtruck", "foodtruck_1", (5, 15)),
+    ("mdkg", "mdkg_1", (7, 13)),
+])
+def test_numpy_engine_matches_pil_engine(stimulus_gif, domain_name, problem_name, dim):
+    for frame_array in load_frames(stimulus_gif(domain_name, problem_name)):
+        numpy_means, numpy_stds = _segment_frame_numpy(np.asarray(frame_array), dim)
+        pil_means, pil_stds = _segment_frame_pil(np.asarray(frame_array), dim)
+        assert numpy_means.shape == pil_means.shape == dim
+        np.testing.assert_array_equal(numpy_stds > OBJECT_STD_THRESHOLD, pil_stds > OBJECT_STD_THRESHOLD)
+        assert np.abs(numpy_means.astype(int) - pil_means).max() <= ENGINE_MEAN_TOLERANCE
+        assert np.abs(numpy_stds - pil_stds).max() <= ENGINE_STD_TOLERANCE
+
+
+@pytest.mark.parametrize("domain_name, problem_name, dim", [
+    ("dkg_single", "dkg_single_1", (10, 12)),
+    ("foodtruck", "foodtruck_1", (5, 15)),
+])
+@pytest.mark.parametrize("key_scheme", ["fingerprint", "mean"])
+def test_delta_segmentation_matches_full(stimulus_gif, domain_name, problem_name, dim, key_scheme):
+    gif_path = stimulus_gif(domain_name, problem_name)
+    _, full = load_gif_by_frame_and_cells(gif_path, dim, key_scheme=key_scheme)
+    _, delta = load_gif_by_frame_and_cells(gif_path, dim, delta=True, key_scheme=key_scheme)
+
+    assert len(full) == len(delta) > 1
+    assert full.keys == delta.keys
+    for full_grid, delta_grid in zip(full.grids, delta.grids):
+        assert np.array_equal(full_grid.means, delta_grid.means)
+        assert np.array_equal(full_grid.stds, delta_grid.stds)
+        assert np.array_equal(full_grid.ids, delta_grid.ids)
+    assert delta.grids[0].changed_cells is None
+    assert all(grid.changed_cells is not None for grid in delta.grids[1:])
+
+
+def test_delta_segmentation_requires_numpy_engine(stimulus_gif):
+    with pytest.raises(ValueError):
+        load_gif_by_frame_and_cells(stimulus_gif("dkg_single", "dkg_single_1"), (10, 12), engine="pil", delta=True)
+
+
+def test_changed_cell_mask_selects_changed_cells():
+    rng = np.random.default_rng(0)
+    prev_frame = rng.integers(0, 256, (60, 90, 3), dtype=np.uint8)
+    frame = prev_frame.copy()
+    frame[25, 70] += 1  # inside cell (1, 2) of 20x30 cells
+    mask = changed_cell_mask(frame, prev_frame, (3, 3))
+    assert mask.tolist() == [[False] * 3, [False, False, True], [False] * 3]
+
+    means, stds, signatures = segment_frame_array(frame, (3, 3))
+    masked_means, masked_stds, masked_signatures = segment_frame_array(frame, (3, 3), mask)
+    assert masked_means.tolist() == [means[1, 2]]
+    assert masked_stds.tolist() == [stds[1, 2]]
+    assert masked_signatures.tolist() == [signatures[1, 2]]
+
+
+@pytest.mark.parametrize("domain_name, problem_name", [("dkg_single", "dkg_single_1"), ("mdkg", "mdkg_1")])
+@pytest.mark.parametrize("output_format", ["frames", "trajectory"])
+def test_streamed_output_matches_batch_output(mock_problem, domain_name, problem_name, output_format):
+    generate = mock_problem(domain_name, problem_name)
+    streamed = generate(output_format=output_format)
+    assert streamed
+    assert generate(stream=False, output_format=output_format) == streamed
+
+
+def test_windowed_stacks_keep_only_recent_frames(stimulus_gif):
+    frame_stack = FrameStack((10, 12), window=1)
+    frames_cells = CellThumbnails((10, 12), window=1)
+    num_frames = 0
+    for frame_array, grid in iter_gif_frames_and_cells(stimulus_gif("dkg_single", "dkg_single_1"), frame_stack):
+        frames_cells.append(frame_array)
+        frames_cells.get(grid.frame_idx, 0, 0)
+        num_frames += 1
+        assert frame_stack[grid.frame_idx] is grid
+        assert len(frame_stack.grids) == len(frames_cells.frames) == 1
+        assert all(key[0] == grid.frame_idx for key in frames_cells._encoded)
+    assert len(frame_stack) == len(frames_cells) == num_frames > 1
+
+
+@pytest.mark.parametrize("domain_name, problem_name", [("dkg_single", "dkg_single_1"), ("mdkg", "mdkg_1")])
+@pytest.mark.parametrize("options", [{}, {"delta": True}, {"output_format": "trajectory", "keyframe_interval": 3}])
+def test_parallel_emission_matches_serial_emission(mock_problem, domain_name, problem_name, options):
+    generate = mock_problem(domain_name, problem_name)
+    serial = generate(stream=False, **options)
+    assert serial
+    assert generate(workers=3, **options) == serial
@@ -0,0 +1,90 @@
+import asyncio
+import json
+import pytest
+from telemetry import _percentile, configure_telemetry, payload_bytes, read_trace, record_call, record_parse_failure, summarize_trace, telemetry, trace_context
+
+
+@pytest.fixture
+def trace_path(tmp_path):
+    path = str(tmp_path / "trace.jsonl")
+    yield path
+    configure_telemetry(None)
+
+
+def test_tracing_is_off_until_configured(trace_path):
+    configure_telemetry(None)
+    record_call(stage="classify_cell", attempts=1)
+    assert telemetry() is None
+    configure_telemetry(trace_path)
+    record_call(stage="classify_cell", attempts=1)
+    configure_telemetry(None)
+    assert [record["stage"] for record in read_trace(trace_path)] == ["classify_cell"]
+
+
+def test_trace_context_adds_fields_to_records_of_its_tasks(trace_path):
+    writer = configure_telemetry(trace_path)
+
+    async def _call(stage):
+        record_call(stage=stage, status="ok", cached_tokens=None)
+
+    async def _calls():
+        with trace_context(domain="foodtruck"):
+            with trace_context(problem="foodtruck_1"):
+                await asyncio.gather(_call("classify_cell"), _call("classify_object"))
+            record_parse_failure("objects", "invalid objects")
+        record_call(stage="domain")
+    asyncio.run(_calls())
+    configure_telemetry(None)
+
+    records = read_trace(trace_path)
+    assert [(r["event"], r.get("domain"), r.get("problem")) for r in records] == [
+        ("call", "foodtruck", "foodtruck_1"), ("call", "foodtruck", "foodtruck_1"), ("parse_failure", "foodtruck", None), ("call", None, None),
+    ]
+    assert all(r["run"] == writer.run for r in records)
+    # Fields without a value are left out of the record
+    assert "cached_tokens" not in records[0]
+
+
+def test_read_trace_skips_cut_lines_and_filters_runs(tmp_path):
+    path = tmp_path / "trace.jsonl"
+    lines = [json.dumps({"event": "call", "run": "a"}), "", json.dumps({"event": "call", "run": "b"}), '{"event": "call", "ru']
+    path.write_text("\n".join(lines))
+    assert [r["run"] for r in read_trace(str(path))] == ["a", "b"]
+    assert [r["run"] for r in read_trace(str(path), runs=["b"])] == ["b"]
+
+
+def test_summarize_trace_counts_and_percentiles():
+    records = [
+        {"event": "call", "stage": "classify_cell", "attempts": 1, "status": "ok", "input_tokens": 10, "output_tokens": 2, "total_tokens": 12, "image_bytes": 100, "images": 1, "latency_seconds": latency}
+        for latency in (0.1, 0.2, 0.3, 0.4)
+    ] + [
+        {"event": "call", "stage": "classify_cell", "attempts": 0, "cached": True, "latency_seconds": 0.0},
+        {"event": "call", "stage": "domain", "attempts": 3, "status": "ServerError: 503", "latency_seconds": 5.0},
+        {"event": "parse_failure", "stage": "domain", "reason": "unparsable"},
+    ]
+    summary = summarize_trace(records)
+    assert list(summary) == [("classify_cell",), ("domain",)]
+    cells = summary[("classify_cell",)]
+    assert (cells["calls"], cells["cached"], cells["attempts"], cells["errors"], cells["parse_failures"]) == (5, 1, 4, 0, 0)
+    assert (cells["input_tokens"], cells["total_tokens"], cells["image_bytes"], cells["images"]) == (40, 48, 400, 4)
+    assert cells["latency_seconds"] == pytest.approx(1.0)
+    assert cells["mean_latency_seconds"] == pytest.approx(0.2)
+    assert cells["p95_latency_seconds"] == pytest.approx(0.4)
+    domain = summary[("domain",)]
+    assert (domain["calls"], domain["attempts"], domain["errors"], domain["parse_failures"]) == (1, 3, 1, 1)
+
+    by_problem = summarize_trace([{**record, "problem": "p"} for record in records], group_by=("problem", "stage"))
+    assert list(by_problem) == [("p", "classify_cell"), ("p", "domain")]
+
+
+def test_percentile():
+    assert _percentile([], 0.95) == 0.0
+    assert _percentile([3.0, 1.0, 2.0], 0.5) == 2.0
+    assert _percentile(list(range(100)), 0.95) == 95
+
+
+def test_payload_bytes():
+    assert payload_bytes("abc") == (3, 0, 0)
+    assert payload_bytes(["ab", b"\x00" * 10]) == (2, 10, 1)
+    image_url = {"type": "image_url", "image_url": {"url": "data:image/jpeg;base64,AAAA"}}
+    assert payload_bytes([{"role": "user", "content": [{"type": "text", "text": "hi"}, image_url]}]) == (len("user") + len("text") + 2, 3, 1)
@@ -0,0 +1,73 @@
+import pytest
+from pddl_problem import PDDLProblem, parse_sexprs, serialize_term
+from segment_cells import emit_frame, load_gif_by_frame_and_cells, render_frame_facts
+from trajectory import TrajectoryWriter, read_trajectory, read_trajectory_frame
+
+OBJECT_CATEGORIES = {"agent": ["student"], "unique_objects": ["student", "koreantruck"], "generic_objects": ["parkinglot"]}
+
+
+def _problem_parts(pddl_str: str):
+    """A frame problem's blocks other than (:init ...), and its init facts in sorted order.
+
+    A trajectory keys facts by the fluent they assign, so a replayed frame holds the
+    frame's facts but not necessarily in the order they were written.
+    """
+    (define,) = parse_sexprs(pddl_str)
+    blocks = [block for block in define if isinstance(block, str) or block[0] != ":init"]
+    (init,) = [block for block in define if not isinstance(block, str) and block[0] == ":init"]
+    return blocks, sorted(serialize_term(fact) for fact in init[1:])
+
+
+def _check_updates_follow_new_matrices(pddl_str: str):
+    (define,) = parse_sexprs(pddl_str)
+    (init,) = [block for block in define if not isinstance(block, str) and block[0] == ":init"]
+    created = set()
+    for fact in init[1:]:
+        if fact[0] == "=" and fact[2][0] == "new-bit-matrix":
+            created.add(fact[1])
+        elif fact[0] == "=" and fact[2][0] == "set-index":
+            assert fact[1] in created, f"{serialize_term(fact)} comes before its new-bit-matrix"
+
+
+@pytest.mark.parametrize("bit_matrix_encoding", ["literal", "set-index"])
+@pytest.mark.parametrize("keyframe_interval", [0, 2])
+def test_trajectory_replays_the_written_frames(tmp_path, stimulus_gif, bit_matrix_encoding, keyframe_interval):
+    _, frame_stack = load_gif_by_frame_and_cells(stimulus_gif("dkg_single", "dkg_single_1"), (10, 12), delta=True)
+    # Alternate cell types and give every object cell a fact of its own
+    cell_types = {
+        key: {"type": ("building", "whitespace")[n % 2], "objects": ["student", "parkinglot"], "object_pddl_str": "(at student $i $j) (= (xloc parkinglot) $j)"}
+        for n, key in enumerate(frame_stack.keys)
+    }
+    problem_dir = str(tmp_path / "problem")
+    trajectory = TrajectoryWriter(problem_dir, PDDLProblem("dkg_single_1", "dkg_single").header, keyframe_interval=keyframe_interval)
+
+    frame_strs = []
+    cell_contents = None
+    for frame_number in range(len(frame_stack)):
+        facts, generic_objects, cell_contents = render_frame_facts(
+            frame_stack, frame_number, "dkg_single", cell_types, OBJECT_CATEGORIES,
+            previous_cell_contents=cell_contents, bit_matrix_encoding=bit_matrix_encoding
+        )
+        problem = PDDLProblem("dkg_single_1", "dkg_single", objects={"parkinglot": generic_objects}, init=facts)
+        emit_frame(problem_dir, frame_number, problem)
+        emit_frame(problem_dir, frame_number, problem, trajectory=trajectory)
+        with open(f"{problem_dir}/frame_{frame_number}.pddl", "r") as f:
+            frame_strs.append(f.read())
+    trajectory.close()
+
+    replayed = list(read_trajectory(problem_dir))
+    assert [frame_number for frame_number, _ in replayed] == list(range(len(frame_strs)))
+    for frame_number, frame_str in enumerate(frame_strs):
+        for replayed_str in (replayed[frame_number][1], read_trajectory_frame(problem_dir, frame_number)):
+            assert _problem_parts(replayed_str) == _problem_parts(frame_str)
+            _check_updates_follow_new_matrices(replayed_str)
+
+
+def test_trajectory_frames_must_be_added_in_order(tmp_path):
+    trajectory = TrajectoryWriter(str(tmp_path), PDDLProblem("p", "d").header)
+    trajectory.add_frame(0, "", ["(at a b)"])
+    with pytest.raises(ValueError):
+        trajectory.add_frame(2, "", ["(at a b)"])
+    trajectory.close()
+    with pytest.raises(IndexError):
+        read_trajectory_frame(str(tmp_path), 1)
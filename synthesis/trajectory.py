@@ -0,0 +1,157 @@
+import json
+import os
+from typing import Dict, Iterator, List, Optional, Tuple
+from pddl_problem import problem_str
+
+TRAJECTORY_VERSION = 1
+# Facts whose value updates a fluent in place depend on fact order, so they are kept whole and written last
+UPDATE_OPERATORS = ("set-index",)
+
+
+def trajectory_paths(problem_dir: str) -> Tuple[str, str]:
+    """Paths of the trajectory file and its frame index in a problem folder."""
+    return os.path.join(problem_dir, "trajectory.jsonl"), os.path.join(problem_dir, "trajectory.index.json")
+
+
+def _split_assignment(fact: str) -> Optional[Tuple[str, str]]:
+    """Split '(= (fluent args) value)' into the fluent term and its value."""
+    if not fact.startswith("(= ") or not fact.endswith(")"):
+        return None
+    body = fact[3:-1].strip()
+    if body.startswith("("):
+        depth = 0
+        for end, char in enumerate(body):
+            depth += {"(": 1, ")": -1}.get(char, 0)
+            if depth == 0:
+                break
+        term, value = body[:end + 1], body[end + 1:]
+    else:
+        term, _, value = body.partition(" ")
+    return term, value.strip()
+
+
+def _is_update(fact: str) -> bool:
+    return any(op in fact for op in UPDATE_OPERATORS)
+
+
+def fact_key(fact: str) -> Tuple[str, Optional[str]]:
+    """Key a fact by the fluent it assigns; predicates and in-place updates are keyed by the whole fact with value None."""
+    assignment = _split_assignment(fact)
+    if assignment is None or _is_update(fact):
+        return fact, None
+    return assignment
+
+
+def state_facts(state: Dict[str, Optional[str]]) -> List[str]:
+    facts = [key if value is None else f"(= {key} {value})" for key, value in state.items()]
+    return sorted(facts, key=_is_update)
+
+
+def frame_problem_str(problem_header: str, objects_str: str, state: Dict[str, Optional[str]]) -> str:
+    """The frame_k.pddl problem of a frame state."""
+    return problem_str(problem_header, objects_str, state_facts(state))
+
+
+class TrajectoryWriter:
+    """Writes the frames of a problem as one trajectory.jsonl instead of a frame_k.pddl per frame.
+
+    The first line holds the problem header. Every following line is one frame: keyframes
+    store the full state, other frames the facts added, removed and changed since the
+    previous frame (and the objects block if it changed). trajectory.index.json records
+    the byte offset of every frame line and the keyframes, so a loader can seek to the
+    keyframe before any frame. Only the previous frame's state is kept in memory.
+    """
+
+    def __init__(self, problem_dir: str, problem_header: str, keyframe_interval: int = 0):
+        os.makedirs(problem_dir, exist_ok=True)
+        self.path, self.index_path = trajectory_paths(problem_dir)
+        self.keyframe_interval = keyframe_interval
+        self.offsets: List[int] = []
+        self.keyframes: List[int] = []
+        self._prev_state: Optional[Dict[str, Optional[str]]] = None
+        self._prev_objects_str = ""
+        # Write to a temporary file so readers never see a partial trajectory
+        self._file = open(f"{self.path}.{os.getpid()}.tmp", "w")
+        self._write_line({"version": TRAJECTORY_VERSION, "problem_header": problem_header})
+
+    def _write_line(self, record: dict) -> int:
+        offset = self._file.tell()
+        self._file.write(json.dumps(record) + "\n")
+        return offset
+
+    def add_frame(self, frame_number: int, objects_str: str, facts: List[str]):
+        if frame_number != len(self.offsets):
+            raise ValueError(f"Frames must be added in order: expected frame {len(self.offsets)}, got {frame_number}.")
+        state = {}
+        for fact in facts:
+            key, value = fact_key(fact)
+            state[key] = value
+
+        if self._prev_state is None or (self.keyframe_interval and frame_number % self.keyframe_interval == 0):
+            record = {"frame": frame_number, "objects": objects_str, "facts": list(state.items())}
+            self.keyframes.append(frame_number)
+        else:
+            prev_state = self._prev_state
+            record = {
+                "frame": frame_number,
+                "added": [[key, value] for key, value in state.items() if key not in prev_state],
+                "removed": [key for key in prev_state if key not in state],
+                "changed": [[key, value] for key, value in state.items() if key in prev_state and prev_state[key] != value],
+            }
+            if objects_str != self._prev_objects_str:
+                record["objects"] = objects_str
+
+        self.offsets.append(self._write_line(record))
+        self._prev_state = state
+        self._prev_objects_str = objects_str
+
+    def close(self):
+        tmp_path = self._file.name
+        self._file.close()
+        index = {"version": TRAJECTORY_VERSION, "num_frames": len(self.offsets), "offsets": self.offsets, "keyframes": self.keyframes}
+        tmp_index_path = f"{self.index_path}.{os.getpid()}.tmp"
+        with open(tmp_index_path, "w") as f:
+            json.dump(index, f)
+        os.replace(tmp_path, self.path)
+        os.replace(tmp_index_path, self.index_path)
+
+
+def _apply_frame_record(record: dict, state: Dict[str, Optional[str]], objects_str: str) -> Tuple[Dict[str, Optional[str]], str]:
+    if "facts" in record:
+        state = {key: value for key, value in record["facts"]}
+    else:
+        for key in record["removed"]:
+            del state[key]
+        for key, value in record["changed"] + record["added"]:
+            state[key] = value
+    return state, record.get("objects", objects_str)
+
+
+def read_trajectory(problem_dir: str) -> Iterator[Tuple[int, str]]:
+    """Yield (frame_number, frame problem string) for every frame of a trajectory."""
+    path, _ = trajectory_paths(problem_dir)
+    state, objects_str = {}, ""
+    with open(path, "r") as f:
+        header = json.loads(f.readline())
+        for line in f:
+            record = json.loads(line)
+            state, objects_str = _apply_frame_record(record, state, objects_str)
+            yield record["frame"], frame_problem_str(header["problem_header"], objects_str, state)
+
+
+def read_trajectory_frame(problem_dir: str, frame_number: int) -> str:
+    """Rebuild one frame's problem string, replaying only from the closest keyframe before it."""
+    path, index_path = trajectory_paths(problem_dir)
+    with open(index_path, "r") as f:
+        index = json.load(f)
+    if not 0 <= frame_number < index["num_frames"]:
+        raise IndexError(f"Frame {frame_number} out of range for a trajectory of {index['num_frames']} frames.")
+    keyframe = max(k for k in index["keyframes"] if k <= frame_number)
+
+    state, objects_str = {}, ""
+    with open(path, "r") as f:
+        header = json.loads(f.readline())
+        f.seek(index["offsets"][keyframe])
+        for _ in range(keyframe, frame_number + 1):
+            state, objects_str = _apply_frame_record(json.loads(f.readline()), state, objects_str)
+    return frame_problem_str(header["problem_header"], objects_str, state)
@@ -7,8 +7,14 @@ from google.genai import types
 from google import genai
 import re
 import time
-from google.genai import errors as genai_errors
 import pylcs
+from grid_detection import check_grid_size
+from problem_context import ProblemContext
+from pddl_domain import domain_index
+from call_budget import CallBudget
+from llm_providers import RetryPolicy, gemini_provider
+from telemetry import record_parse_failure
+from typing import Optional
 
 def find_LCS(s1, s2):
     res = pylcs.lcs_string_idx(s1, s2)
@@ -21,31 +27,50 @@ def call_gemini_with_retry(
     contents: any,
     config: types.GenerateContentConfig,
     initial_delay_seconds: int = 1,
-    max_delay_seconds: int = 20
+    max_delay_seconds: int = 20,
+    budget: Optional[CallBudget] = None,
+    stage: Optional[str] = None,
+    cache_prefix: int = 0
 ) -> str:
-    """Calls the Gemini API with indefinite retry logic for transient errors."""
-    num_attempts = 0
-    current_delay = initial_delay_seconds
-    while True:
-        try:
-            num_attempts += 1
-            response = client.models.generate_content(
-                model=model_name,
-                contents=contents,
-                config=config
-            )
+    """Calls the Gemini API with retry logic for transient errors.
+
+    client is a GeminiProvider or a genai client, which is wrapped in one. The call goes
+    through the provider layer (see llm_providers.py): the response cache, the model's
+    shared rate limiter, and retries of 5xx errors and timed out attempts until the
+    model's circuit breaker opens (CircuitOpen) or, with a budget, until the problem's
+    deadline, calls or tokens run out (BudgetExceeded; see call_budget.py). The call is
+    traced under stage and problem_name when tracing is on (see telemetry.py). The first
+    cache_prefix parts of contents are uploaded once as Gemini cached content and
+    referenced by every later call that starts with them (see context_cache.py).
+    """
+    retry = RetryPolicy(initial_delay_seconds=initial_delay_seconds, max_delay_seconds=max_delay_seconds)
+    return gemini_provider(client).generate(model_name, contents, config, budget=budget, retry=retry, trace={"stage": stage, "problem": problem_name}, cache_prefix=cache_prefix).text
+
+
+async def call_gemini_with_retry_async(
+    client,
+    problem_name: str,
+    model_name: str,
+    contents: any,
+    config: types.GenerateContentConfig,
+    initial_delay_seconds: int = 1,
+    max_delay_seconds: int = 20,
+    budget: Optional[CallBudget] = None,
+    stage: Optional[str] = None,
+    cache_prefix: int = 0
+) -> str:
+    """call_gemini_with_retry on the client's async surface (client.aio), so many calls can be in flight at once."""
+    retry = RetryPolicy(initial_delay_seconds=initial_delay_seconds, max_delay_seconds=max_delay_seconds)
+    return (await gemini_provider(client).generate_async(model_name, contents, config, budget=budget, retry=retry, trace={"stage": stage, "problem": problem_name}, cache_prefix=cache_prefix)).text
+
 
-            if num_attempts > 1:
-                print(f"API call succeeded on attempt {num_attempts}.")
-            return response.text
-        except genai_errors.ServerError as e:
-            error_status_code = -1
-            if hasattr(e, 'args') and e.args and isinstance(e.args[0], int):
-                error_status_code = e.args[0]
-            print(f"API ServerError ({e.__class__.__name__}, status: {error_status_code if error_status_code != -1 else 'N/A'}). Attempt {num_attempts}. Retrying in {current_delay}s...")
-            time.sleep(current_delay)
-            current_delay = min(current_delay * 1.1, max_delay_seconds)
-    return "" 
+def _parse_json(text: str, stage: str, problem_name: str) -> any:
+    """json.loads of a model response; a response that is not JSON is traced before the error is raised."""
+    try:
+        return json.loads(text)
+    except ValueError as e:
+        record_parse_failure(stage, f"invalid JSON: {e}", problem=problem_name)
+        raise
 
 
 def save_pddl_to_file(pddl_content, path):
@@ -59,16 +84,14 @@ def encode_image(image_path):
     with open(image_path, "rb") as image_file:
         return base64.b64encode(image_file.read()).decode('utf-8')
     
-def synthesize_domain(client, destination_folder, domain_name, problem_name):
+def synthesize_domain(client, destination_folder, domain_name, problem_name, context=None):
     base_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
-    with open(f"{base_dir}/dataset/stimuli/{domain_name}/{problem_name}/{problem_name}.txt", "r") as f:
-        instructions = f.read()
+    context = context or ProblemContext(destination_folder, domain_name, problem_name)
+    instructions = context.description
 
-    with open(f"{base_dir}/{destination_folder}/{domain_name}/{problem_name}/objects.json", "r") as f:
-        object_type = json.load(f)
+    object_type = context.objects
 
-    with open(f"{base_dir}/synthesis/prompts/pddl_domain_prompt.txt", "r") as f:
-        prompt = f.read()
+    prompt = context.prompt_template("pddl_domain_prompt.txt")
 
     # print(instructions)
 
@@ -87,13 +110,15 @@ def synthesize_domain(client, destination_folder, domain_name, problem_name):
             contents="Please count the number of actions that can be performed by the agent, based on the text below. Only return a json file in the format of {\"action_name\": [action1, action2,...], \"action_count\": N} and nothing else \n\n" + instructions + "\n\nobjects = " + str(object_type),
             config=types.GenerateContentConfig(
                 temperature=1.0
-            )
+            ),
+            budget=context.budget,
+            stage="domain_actions"
         )
         actions = actions_text.replace("```json", "").strip("`")
             
         # print(actions)
 
-        actions = json.loads(actions)
+        actions = _parse_json(actions, "domain_actions", problem_name)
         print(actions)
 
         pddl_domain = call_gemini_with_retry(
@@ -103,7 +128,9 @@ def synthesize_domain(client, destination_folder, domain_name, problem_name):
             contents=prompt +"\n\nobjects = " + str(object_type) + "\n\n" + "Please generate a PDDL domain file based on the text above. Only return the PDDL domain file and nothing else." +  instructions ,
             config=types.GenerateContentConfig(
                 temperature=1.0
-            )
+            ),
+            budget=context.budget,
+            stage="domain"
         ).replace("```pddl", "").strip("`")
 
         if "whitespace" in object_type["background_cells"]:
@@ -112,7 +139,12 @@ def synthesize_domain(client, destination_folder, domain_name, problem_name):
         if "whitesquare" in object_type["background_cells"]:
             pddl_domain = pddl_domain.replace("whitespace", "whitesquare")
         
-        action_names = re.findall(r'\(:action\s+([^\s\)]+)', pddl_domain)
+        try:
+            action_names = list(domain_index(pddl_domain).actions)
+        except ValueError as e:
+            print(f"Could not parse the synthesized domain ({e}). Regenerating domain...")
+            record_parse_failure("domain", f"unparseable domain: {e}", problem=problem_name)
+            continue
 
         print("action_names: ", action_names)
 
@@ -121,6 +153,7 @@ def synthesize_domain(client, destination_folder, domain_name, problem_name):
         if len(action_names)!= len(actions["action_name"]) and len([action for action in action_names if all(a not in action for a in actions["action_name"])]) > 0:
             print(pddl_domain)
             print("Extra actions found. Regenerating domain...")
+            record_parse_failure("domain", "extra actions", problem=problem_name)
             
             continue
 
@@ -146,23 +179,21 @@ def synthesize_domain(client, destination_folder, domain_name, problem_name):
     output_path = f"{base_dir}/{destination_folder}/{domain_name}/{problem_name}/objects.json"
     with open(output_path, "w") as json_file:
         json.dump(object_type, json_file, indent=4)
+    context.invalidate("domain", "objects")
 
     return pddl_domain
 
 
-def synthesize_config(client, destination_folder, domain_name, problem_name):
+def synthesize_config(client, destination_folder, domain_name, problem_name, grid_check: str = "override", context=None):
     base_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
-    with open(f"{base_dir}/dataset/stimuli/{domain_name}/{problem_name}/{problem_name}.txt", "r") as f:
-        description = f.read()
+    context = context or ProblemContext(destination_folder, domain_name, problem_name)
+    description = context.description
 
-    with open(f"{base_dir}/synthesis/prompts/nipe_config_prompt.txt", "r") as f:
-        prompt = f.read()
+    prompt = context.prompt_template("nipe_config_prompt.txt")
 
-    with open(f"{base_dir}/{destination_folder}/{domain_name}/{problem_name}/objects.json", "r") as f:
-        object_type_str = f.read() # Renamed to avoid conflict with type keyword
+    object_type_str = context.objects_json # Renamed to avoid conflict with type keyword
 
-    with open(f"{base_dir}/{destination_folder}/{domain_name}/{problem_name}/domain.pddl", "r") as f:
-        domain_description = f.read()
+    domain_description = context.domain_pddl
 
     response_text = call_gemini_with_retry(
         client=client,
@@ -172,12 +203,19 @@ def synthesize_config(client, destination_folder, domain_name, problem_name):
         config=types.GenerateContentConfig(
             temperature=1.0,
             response_mime_type = "application/json"
-        )
+        ),
+        budget=context.budget,
+        stage="config"
     )
     
-    config_data = json.loads(response_text.strip("`"))
+    config_data = _parse_json(response_text.strip("`"), "config", problem_name)
     print(json.dumps(config_data, indent=4))
 
+    # The LLM's grid_size is checked against the GIF so a wrong value does not send segmentation off the rails
+    image_path = context.gif_path
+    if grid_check != "off" and os.path.exists(image_path):
+        config_data["grid_size"] = check_grid_size(image_path, config_data.get("grid_size"), mode=grid_check)
+
     # all the goal objects are unique objects so no need to modify them
 
     # try:
@@ -215,16 +253,16 @@ def synthesize_config(client, destination_folder, domain_name, problem_name):
     os.makedirs(os.path.dirname(output_path), exist_ok=True)
     with open(output_path, "w") as json_file:
         json.dump(config_data, json_file, indent=4)
+    context.invalidate("config")
     return config_data
 
 
-def extract_objects(client, destination_folder, domain_name, problem_name):
+def extract_objects(client, destination_folder, domain_name, problem_name, context=None):
     base_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
-    with open(f"{base_dir}/synthesis/prompts/nipe_object_prompt.txt", "r") as f:
-        prompt = f.read()
+    context = context or ProblemContext(destination_folder, domain_name, problem_name)
+    prompt = context.prompt_template("nipe_object_prompt.txt")
 
-    with open(f"{base_dir}/dataset/stimuli/{domain_name}/{problem_name}/{problem_name}.txt", "r") as f:
-        description = f.read()
+    description = context.description
 
     # with open(f"{base_dir}/{destination_folder}/{domain_name}/{problem_name}/domain.pddl", "r") as f:
     #     domain = f.read()
@@ -242,13 +280,15 @@ def extract_objects(client, destination_folder, domain_name, problem_name):
                 config=types.GenerateContentConfig(
                     temperature=1.0,
                     response_mime_type = "application/json"
-                )
+                ),
+                budget=context.budget,
+                stage="objects"
             )
             objects = response_text.strip("`")
 
             print(objects)
 
-            objects_json = json.loads(objects)
+            objects_json = _parse_json(objects, "objects", problem_name)
 
             if "generic_objects" in objects_json and "unique_objects" in objects_json and "background_cells" in objects_json and "agent" in objects_json:
                 if all(agent not in objects_json["generic_objects"] and agent not in objects_json["unique_objects"] for agent in objects_json["agent"]) and all(g_obj not in obj for obj in objects_json["unique_objects"] for g_obj in objects_json["generic_objects"]):    
@@ -259,6 +299,9 @@ def extract_objects(client, destination_folder, domain_name, problem_name):
                 print("No unique objects found. Regenerating...")
                 valid_objects = False
 
+            if not valid_objects:
+                record_parse_failure("objects", "invalid objects", problem=problem_name)
+
         # except:
         #     print("Error in generating objects. Retrying...")
         #     continue
@@ -267,52 +310,57 @@ def extract_objects(client, destination_folder, domain_name, problem_name):
     os.makedirs(os.path.dirname(output_path), exist_ok=True)
     with open(output_path, "w") as json_file:
         json.dump(objects_json, json_file, indent=4)
+    context.invalidate("objects")
 
     return objects_json
 
-def check_valid_synthesis(destination_folder, domain_name, problem_name):
-    base_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
-    with open(f"{base_dir}/{destination_folder}/{domain_name}/{problem_name}/domain.pddl", "r") as f:
-        domain = f.read()
-        domain_script = domain.split("(:type")[1].split("(:action")[0]
+def check_valid_synthesis(destination_folder, domain_name, problem_name, context=None):
+    context = context or ProblemContext(destination_folder, domain_name, problem_name)
+    domain = context.domain_pddl
+    try:
+        index = context.domain_index
+    except ValueError as e:
+        print(f"domain could not be parsed: {e}")
+        return False
 
-    with open(f"{base_dir}/{destination_folder}/{domain_name}/{problem_name}/config.json", "r") as f:
-        config = json.load(f)
+    config = context.config
 
-    with open(f"{base_dir}/{destination_folder}/{domain_name}/{problem_name}/objects.json", "r") as f:
-        objects = json.load(f)
+    objects = context.objects
 
 
-        if any(len(val) < 2 for val in config["belief_config"].values()):
-            print("belief_config name too short")
-            return False
+    if any(len(val) < 2 for val in config["belief_config"].values()):
+        print("belief_config name too short")
+        return False
 
-        
-        domain_type = domain.split("(:types")[1].split("(:predicates")[0]
-        print(domain)
+    
+    print(domain)
 
-        if "agent" not in domain:
-            print("agent name not existent in domain")
-            return False
+    if not index.types:
+        print("no types declared in domain")
+        return False
 
-        for obj in objects["background_cells"]:
-            if obj not in domain:
-                print(f'{obj} name not existent in domain')
-                return False
+    if not index.declares("agent"):
+        print("agent name not existent in domain")
+        return False
 
-        if config["observability"]=="partial":
+    for obj in objects["background_cells"]:
+        if not index.declares(obj):
+            print(f'{obj} name not existent in domain')
+            return False
 
-            if config["belief_config"]["belief_object"] not in domain_type:
-                print(f'{config["belief_config"]["belief_object"]} name not existent in domain')
-                return False
+    if config["observability"]=="partial":
 
-            if config["belief_config"]["belief_container"] not in domain_type:
-                print(f'{config["belief_config"]["belief_container"]} name not existent in domain')
-                return False
-            
-            if config["belief_config"]["belief_container"] not in objects["generic_objects"]:
-                print(f'{config["belief_config"]["belief_container"]} name not existent in object')
-                return False
+        if config["belief_config"]["belief_object"] not in index.types:
+            print(f'{config["belief_config"]["belief_object"]} name not existent in domain')
+            return False
+
+        if config["belief_config"]["belief_container"] not in index.types:
+            print(f'{config["belief_config"]["belief_container"]} name not existent in domain')
+            return False
+        
+        if config["belief_config"]["belief_container"] not in objects["generic_objects"]:
+            print(f'{config["belief_config"]["belief_container"]} name not existent in object')
+            return False
 
     return True
 